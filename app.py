@@ -5,8 +5,11 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+from log_config import configure_logging
+
+# Set up logging (LOG_LEVEL, LOG_FORMAT, ... see log_config.py)
+configure_logging()
+logger = logging.getLogger(__name__)
 
 class Base(DeclarativeBase):
     pass
@@ -34,6 +37,72 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 # Strava API settings
 app.config["STRAVA_CLIENT_ID"] = os.environ.get("STRAVA_CLIENT_ID")
 app.config["STRAVA_CLIENT_SECRET"] = os.environ.get("STRAVA_CLIENT_SECRET")
+# Maximum number of activity detail/stream fetches in flight during a sync
+app.config["STRAVA_FETCH_CONCURRENCY"] = int(os.environ.get("STRAVA_FETCH_CONCURRENCY", 4))
+# Shared HTTP client (see strava_http.py): base URL, timeouts in seconds and retries
+app.config["STRAVA_BASE_URL"] = os.environ.get("STRAVA_BASE_URL", "https://www.strava.com")
+app.config["STRAVA_CONNECT_TIMEOUT"] = float(os.environ.get("STRAVA_CONNECT_TIMEOUT", 5))
+app.config["STRAVA_READ_TIMEOUT"] = float(os.environ.get("STRAVA_READ_TIMEOUT", 30))
+app.config["STRAVA_HTTP_RETRIES"] = int(os.environ.get("STRAVA_HTTP_RETRIES", 3))
+app.config["STRAVA_HTTP_BACKOFF"] = float(os.environ.get("STRAVA_HTTP_BACKOFF", 0.5))
+app.config["STRAVA_HTTP_POOL_SIZE"] = int(os.environ.get("STRAVA_HTTP_POOL_SIZE", 10))
+# Activity list paging: Strava allows up to 200 per page
+app.config["STRAVA_PAGE_SIZE"] = int(os.environ.get("STRAVA_PAGE_SIZE", 100))
+app.config["STRAVA_MAX_PAGES"] = int(os.environ.get("STRAVA_MAX_PAGES", 50))
+# Skip the activity detail request during sync when the list summary already
+# says whether there is heart rate data, halving the requests per activity
+app.config["STRAVA_SKIP_DETAILS"] = os.environ.get("STRAVA_SKIP_DETAILS", "1").lower() in ("1", "true", "yes")
+# Heart rate stream resolutions: "low", "medium" or "high" (~100, ~1000,
+# ~10000 samples) or "full", downsampled along the "time" or "distance" series.
+# Activity pages show STRAVA_DETAIL_STREAM_RESOLUTION streams, which sync
+# fetches right away with STRAVA_STREAM_HYDRATION "eager". With "lazy" sync
+# only fetches STRAVA_STREAM_RESOLUTION for the zone totals, activity pages
+# fetch the detail stream on first view and activities of the last
+# STRAVA_PREFETCH_DAYS are fetched in the background (see hydration.py)
+app.config["STRAVA_STREAM_HYDRATION"] = os.environ.get("STRAVA_STREAM_HYDRATION", "eager")
+app.config["STRAVA_DETAIL_STREAM_RESOLUTION"] = os.environ.get("STRAVA_DETAIL_STREAM_RESOLUTION", "high")
+app.config["STRAVA_STREAM_RESOLUTION"] = os.environ.get("STRAVA_STREAM_RESOLUTION", "medium")
+app.config["STRAVA_STREAM_SERIES_TYPE"] = os.environ.get("STRAVA_STREAM_SERIES_TYPE", "time")
+app.config["STRAVA_PREFETCH_DAYS"] = int(os.environ.get("STRAVA_PREFETCH_DAYS", 14))
+# How far back the first sync of a new user reaches, and the default backfill horizon
+app.config["STRAVA_INITIAL_SYNC_DAYS"] = int(os.environ.get("STRAVA_INITIAL_SYNC_DAYS", 90))
+app.config["STRAVA_BACKFILL_DAYS"] = int(os.environ.get("STRAVA_BACKFILL_DAYS", 365))
+# Strava API quota shared by all processes (see rate_limit.py). The limits are
+# only the starting point, Strava's X-RateLimit-Limit headers replace them.
+# Backfills leave STRAVA_RATE_LIMIT_RESERVE of each window to interactive syncs.
+app.config["STRAVA_RATE_LIMIT_ENABLED"] = os.environ.get("STRAVA_RATE_LIMIT_ENABLED", "1").lower() in ("1", "true", "yes")
+app.config["STRAVA_RATE_LIMIT_15MIN"] = int(os.environ.get("STRAVA_RATE_LIMIT_15MIN", 100))
+app.config["STRAVA_RATE_LIMIT_DAILY"] = int(os.environ.get("STRAVA_RATE_LIMIT_DAILY", 1000))
+app.config["STRAVA_RATE_LIMIT_RESERVE"] = float(os.environ.get("STRAVA_RATE_LIMIT_RESERVE", 0.25))
+
+# Default number of samples returned by the heart rate chart API
+app.config["HR_CHART_MAX_POINTS"] = int(os.environ.get("HR_CHART_MAX_POINTS", 1000))
+
+# Memory budget of the per-process cache of decoded streams (0 disables it)
+app.config["STREAM_CACHE_MAX_BYTES"] = int(os.environ.get("STREAM_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Dashboard aggregate cache: "memory", "none", "sqlite:////path/to/cache.db" or "redis://host:6379/0"
+app.config["DASHBOARD_CACHE"] = os.environ.get("DASHBOARD_CACHE", "memory")
+app.config["DASHBOARD_CACHE_TTL"] = int(os.environ.get("DASHBOARD_CACHE_TTL", 300))  # seconds
+
+# Request timing, Server-Timing headers and /metrics (see instrumentation.py)
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")  # bearer token required by /metrics and /api/cache/stats if set
+
+# Background sync settings
+# SYNC_WORKER is "thread" to run a worker thread inside each web process,
+# or "external" when jobs are processed by worker.py
+app.config["SYNC_WORKER"] = os.environ.get("SYNC_WORKER", "thread")
+app.config["SYNC_MIN_INTERVAL"] = int(os.environ.get("SYNC_MIN_INTERVAL", 60))  # seconds between dashboard syncs
+app.config["SYNC_POLL_INTERVAL"] = float(os.environ.get("SYNC_POLL_INTERVAL", 2))
+app.config["SYNC_JOB_TIMEOUT"] = int(os.environ.get("SYNC_JOB_TIMEOUT", 900))  # requeue jobs running longer
+# Strava webhooks (see webhooks.py). STRAVA_WEBHOOK_VERIFY_TOKEN answers the
+# subscription handshake, events of other subscriptions than
+# STRAVA_WEBHOOK_SUBSCRIPTION_ID are rejected. With a subscription dashboard
+# visits only poll Strava every SYNC_WEBHOOK_POLL_INTERVAL seconds
+app.config["STRAVA_WEBHOOK_VERIFY_TOKEN"] = os.environ.get("STRAVA_WEBHOOK_VERIFY_TOKEN")
+app.config["STRAVA_WEBHOOK_SUBSCRIPTION_ID"] = os.environ.get("STRAVA_WEBHOOK_SUBSCRIPTION_ID")
+app.config["SYNC_WEBHOOK_POLL_INTERVAL"] = int(os.environ.get("SYNC_WEBHOOK_POLL_INTERVAL", 6 * 3600))
 # Set the redirect URI for Strava
 import urllib.parse
 
@@ -42,33 +111,60 @@ import urllib.parse
 production_domain = "zone-wizard-malcolmmcdonal1.replit.app"
 replit_domain = production_domain
 
-# Keep this logging just for debugging
-print(f"Using hard-coded domain: {replit_domain}")
-print(f"Is deployed: {os.environ.get('REPL_DEPLOYMENT_ID') is not None}")
-
 # Build and URL-encode the callback URI
 callback_path = "/callback"
 full_callback_url = f"https://{replit_domain}{callback_path}"
 app.config["STRAVA_REDIRECT_URI"] = full_callback_url
-print(f"Using Replit domain: {replit_domain}")
-print(f"Full callback URL: {full_callback_url}")
-print(f"For Strava settings, use domain: {replit_domain} (without https:// or /callback)")
+logger.debug("Strava callback configured", extra={
+    "domain": replit_domain,
+    "callback_url": full_callback_url,
+    "deployed": os.environ.get('REPL_DEPLOYMENT_ID') is not None
+})
 
 # Initialize the app with the extension
 db.init_app(app)
 
-with app.app_context():
-    # Import the models here so their tables will be created
-    import models  # noqa: F401
-    
-    db.create_all()
+# Import the models so they are registered with the extension. The schema is
+# created and upgraded by migrations.py (flask --app main db-upgrade), not here,
+# so starting a worker doesn't touch the database
+import models  # noqa: F401
 
-# Import and register blueprints
-from auth import auth_bp
-app.register_blueprint(auth_bp)
+_app_ready = False
 
-# Import routes after app is created to avoid circular imports
-import routes
+def create_app():
+    """
+    Register blueprints, views, CLI commands and the sync worker hook
+    Entry point for main.py; worker.py and scripts only need the app and
+    models imported above. Safe to call more than once
+    Returns the app
+    """
+    global _app_ready
+    if _app_ready:
+        return app
+    _app_ready = True
+    
+    # Registered first so request timing covers the other hooks
+    from instrumentation import init_instrumentation
+    init_instrumentation(app)
+    
+    # Import and register blueprints
+    from auth import auth_bp
+    app.register_blueprint(auth_bp)
+    
+    # routes.py is imported on the first request to one of its views
+    from urls import register_routes
+    register_routes(app)
+    
+    # Register CLI commands (flask --app main <command>)
+    import commands  # noqa: F401
+    
+    # Process queued Strava syncs in this process unless a worker.py process does it.
+    # Started on the first request so CLI commands and worker.py don't spawn it.
+    if app.config["SYNC_WORKER"] == "thread":
+        @app.before_request
+        def start_sync_worker():
+            from sync_queue import ensure_worker_thread
+            ensure_worker_thread()
+    
+    return app
 
-# Print the Strava redirect URI for reference
-print(f"Strava redirect URI: {app.config['STRAVA_REDIRECT_URI']}")
@@ -1,4 +1,3 @@
-import os
 import logging
 from datetime import datetime, timedelta
 from flask import Blueprint, request, redirect, url_for, session, flash, render_template
@@ -6,6 +5,10 @@ from flask_login import LoginManager, login_user, logout_user, login_required, c
 import requests
 from app import app, db
 from models import User
+from instrumentation import timed
+from strava_http import get_session
+
+logger = logging.getLogger(__name__)
 
 # Set up LoginManager
 login_manager = LoginManager()
@@ -45,9 +48,7 @@ def login():
     
     auth_url = f"https://www.strava.com/oauth/authorize?client_id={client_id}&response_type=code&redirect_uri={encoded_redirect_uri}&approval_prompt=force&scope={scope}"
     
-    print(f"Generated Strava auth URL: {auth_url}")
-    print(f"Is deployed: {os.environ.get('REPL_DEPLOYMENT_ID') is not None}")
-    print(f"Using redirect URI: {redirect_uri}")
+    logger.debug("Generated Strava auth URL", extra={"redirect_uri": redirect_uri, "auth_url": auth_url})
     return render_template('login.html', auth_url=auth_url)
 
 # Make sure our callback route exactly matches Strava's expectations
@@ -66,11 +67,10 @@ def callback():
     # Exchange code for token
     client_id = app.config['STRAVA_CLIENT_ID']
     client_secret = app.config['STRAVA_CLIENT_SECRET']
-    token_url = "https://www.strava.com/oauth/token"
     
     try:
-        response = requests.post(
-            token_url,
+        response = get_session().post(
+            "/oauth/token",
             data={
                 'client_id': client_id,
                 'client_secret': client_secret,
@@ -131,7 +131,7 @@ def callback():
         
     except requests.exceptions.RequestException as e:
         flash(f"Error exchanging authorization code: {str(e)}", 'danger')
-        logging.error(f"Strava token request error: {str(e)}")
+        logger.error(f"Strava token request error: {str(e)}")
         return redirect(url_for('auth.login'))
 
 @auth_bp.route('/logout')
@@ -141,36 +141,59 @@ def logout():
     flash('You have been logged out.', 'info')
     return redirect(url_for('index'))
 
+@timed("token_refresh")
 def refresh_strava_token(user):
     """Refresh Strava access token if expired"""
     if not user.token_expired():
         return True
     
-    client_id = app.config['STRAVA_CLIENT_ID']
-    client_secret = app.config['STRAVA_CLIENT_SECRET']
-    token_url = "https://www.strava.com/oauth/token"
-    
     try:
-        response = requests.post(
-            token_url,
-            data={
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'refresh_token': user.refresh_token,
-                'grant_type': 'refresh_token'
-            }
-        )
-        response.raise_for_status()
-        
-        token_data = response.json()
-        user.access_token = token_data.get('access_token')
-        user.refresh_token = token_data.get('refresh_token')
-        user.token_expiry = datetime.fromtimestamp(token_data.get('expires_at'))
-        
-        db.session.add(user)
-        db.session.commit()
+        request_new_token(user)
         return True
         
     except requests.exceptions.RequestException as e:
-        logging.error(f"Token refresh error: {str(e)}")
+        logger.error(f"Token refresh error: {str(e)}")
         return False
+
+@timed("token_refresh")
+def strava_token_revoked(user):
+    """
+    Check with Strava whether the user revoked our access
+    Refreshes the user's tokens when Strava still accepts them
+    Raises requests exceptions when Strava couldn't answer
+    Returns True if Strava rejected the refresh token
+    """
+    if not user.refresh_token:
+        return True
+    
+    try:
+        request_new_token(user)
+        return False
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code in (400, 401):
+            return True
+        raise
+
+def request_new_token(user):
+    """
+    Exchange the user's refresh token for a new access token and store both
+    Raises requests exceptions for failed requests
+    """
+    response = get_session().post(
+        "/oauth/token",
+        data={
+            'client_id': app.config['STRAVA_CLIENT_ID'],
+            'client_secret': app.config['STRAVA_CLIENT_SECRET'],
+            'refresh_token': user.refresh_token,
+            'grant_type': 'refresh_token'
+        }
+    )
+    response.raise_for_status()
+    
+    token_data = response.json()
+    user.access_token = token_data.get('access_token')
+    user.refresh_token = token_data.get('refresh_token')
+    user.token_expiry = datetime.fromtimestamp(token_data.get('expires_at'))
+    
+    db.session.add(user)
+    db.session.commit()
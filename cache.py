@@ -0,0 +1,229 @@
+# Cache for per-user dashboard aggregates
+#
+# Zone totals and the activity type list are cached under keys that include a
+# per-user generation number. Syncing new activities or recalculating zones
+# bumps the generation, so every cached aggregate of that user is bypassed at
+# once and the old entries simply expire.
+#
+# The backend is chosen with DASHBOARD_CACHE:
+#   "memory"              per process, invalidations only reach the process
+#                         that made them (other workers see them after the TTL)
+#   "sqlite:////path.db"  a SQLite file shared by all workers on one host
+#   "redis://host:6379/0" Redis or any server speaking its protocol, needs
+#                         the optional redis package
+#   "none"                caching disabled
+import json
+import logging
+import sqlite3
+import threading
+import time
+from app import app
+
+try:
+    import redis
+except ImportError:  # Optional, only needed for the redis backend
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+class MemoryBackend:
+    """Dictionary backed cache local to this process"""
+
+    def __init__(self):
+        self._data = {}  # key -> (value, expires_at or None)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.time():
+                del self._data[key]
+                return None
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._data.get(key, (0, None))[0]) + 1
+            self._data[key] = (str(value), None)
+            return value
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._data.items() if expires_at is not None and expires_at <= now]
+            for key in expired:
+                del self._data[key]
+            return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class SQLiteBackend:
+    """Cache stored in a SQLite file, shared by the processes on one host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+
+    def _connection(self):
+        """Return this thread's connection, sqlite3 connections can't be shared between threads"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl else None)
+        )
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def incr(self, key):
+        connection = self._connection()
+        connection.execute(
+            "INSERT INTO cache (key, value, expires_at) VALUES (?, '1', NULL) "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+            (key,)
+        )
+        return int(connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()[0])
+
+    def purge(self):
+        return self._connection().execute(
+            "DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+        ).rowcount
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+
+class RedisBackend:
+    """Cache stored in Redis, shared by every process, expiry is handled by the server"""
+
+    def __init__(self, url=None, client=None, prefix="zw:"):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The redis package is required for a redis:// DASHBOARD_CACHE")
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key):
+        return int(self.client.incr(self.prefix + key))
+
+    def purge(self):
+        return 0  # Redis expires keys itself
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+def create_backend(setting):
+    """Create the backend described by a DASHBOARD_CACHE value, None disables caching"""
+    if not setting or setting == "none":
+        return None
+    if setting == "memory":
+        return MemoryBackend()
+    if setting.startswith("sqlite:///"):
+        return SQLiteBackend(setting[len("sqlite:///"):])
+    if setting.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(setting)
+    raise ValueError(f"Unknown DASHBOARD_CACHE setting: {setting}")
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """Return the configured backend, created on first use"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend(app.config["DASHBOARD_CACHE"]) or False
+    return _backend or None
+
+def _generation(backend, user_id):
+    """Return the user's current cache generation"""
+    return int(backend.get(f"gen:{user_id}") or 0)
+
+def cached(user_id, name, params, compute, ttl=None):
+    """
+    Return compute() for a user's aggregate, cached under name and params
+    The result must be JSON serializable. Cache failures are logged and
+    the value is computed instead
+    """
+    backend = get_backend()
+    if backend is None:
+        return compute()
+
+    try:
+        key = ":".join(str(part) for part in (name, user_id, _generation(backend, user_id), *params))
+        value = backend.get(key)
+        if value is not None:
+            return json.loads(value)
+    except Exception as e:
+        logger.error(f"Error reading dashboard cache: {str(e)}")
+        return compute()
+
+    result = compute()
+    try:
+        backend.set(key, json.dumps(result), ttl or app.config["DASHBOARD_CACHE_TTL"])
+    except Exception as e:
+        logger.error(f"Error writing dashboard cache: {str(e)}")
+    return result
+
+def invalidate_user(user_id):
+    """Make every cached aggregate of a user stale, called when their activities or zones change"""
+    backend = get_backend()
+    if backend is None:
+        return
+
+    try:
+        backend.incr(f"gen:{user_id}")
+    except Exception as e:
+        logger.error(f"Error invalidating dashboard cache for user {user_id}: {str(e)}")
+
+def purge_expired():
+    """Delete expired entries, returns how many were removed"""
+    backend = get_backend()
+    return backend.purge() if backend is not None else 0
+
+def clear_cache():
+    """Delete every cached entry, including the generation counters"""
+    backend = get_backend()
+    if backend is not None:
+        backend.clear()
@@ -0,0 +1,145 @@
+import click
+from app import app, db
+from models import User
+
+@app.cli.command("db-upgrade")
+@click.option("--to", "target", type=int, help="Stop after this migration version (default: apply all)")
+def db_upgrade(target):
+    """Apply pending schema and data migrations"""
+    from migrations import upgrade
+
+    applied = upgrade(target, log=click.echo)
+    click.echo(f"Done: applied {len(applied)} migrations")
+
+@app.cli.command("db-status")
+def db_status():
+    """List migrations and whether they have been applied"""
+    from migrations import MIGRATIONS, get_applied_versions
+
+    applied = get_applied_versions()
+    for version, description, _ in sorted(MIGRATIONS, key=lambda m: m[0]):
+        state = "applied" if version in applied else "pending"
+        click.echo(f"{version:4d}  {state:8s} {description}")
+
+@app.cli.command("convert-hr-data")
+@click.option("--batch-size", default=500, show_default=True, help="Rows converted per transaction")
+def convert_hr_data(batch_size):
+    """Convert legacy JSON heart rate streams to the binary format"""
+    from migrations import convert_hr_data as convert
+
+    converted, skipped = convert(batch_size, log=click.echo)
+    click.echo(f"Done: converted {converted} activities, skipped {skipped}")
+
+@app.cli.command("backfill-zone-columns")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows updated per transaction")
+def backfill_zone_columns(batch_size):
+    """Populate the per-zone time columns from existing zone_data"""
+    from migrations import backfill_zone_columns as backfill
+
+    updated = backfill(batch_size, log=click.echo)
+    click.echo(f"Done: updated {updated} activities")
+
+@app.cli.command("rebuild-rollups")
+@click.option("--user-id", type=int, help="Only rebuild this user (default: all users)")
+def rebuild_rollups(user_id):
+    """Rebuild the daily zone rollup table from activities"""
+    from rollups import rebuild_user_rollups
+
+    user_ids = [user_id] if user_id else [uid for (uid,) in db.session.query(User.id).order_by(User.id)]
+    for uid in user_ids:
+        rebuild_user_rollups(uid)
+        db.session.commit()
+        click.echo(f"Rebuilt rollups for user {uid}")
+
+@app.cli.command("backfill-activities")
+@click.option("--user-id", type=int, help="Only backfill this user (default: all users)")
+@click.option("--days", type=int, help="How many days of history to fetch (default: STRAVA_BACKFILL_DAYS)")
+@click.option("--inline", is_flag=True, help="Run the backfill now instead of queueing it for the sync worker")
+def backfill_activities(user_id, days, inline):
+    """Fetch historical Strava activities beyond the incremental sync watermark"""
+    from rate_limit import BACKGROUND, RateLimitExceeded, request_priority
+    from strava_client import sync_activities
+    from sync_queue import enqueue_sync
+
+    days = days or app.config["STRAVA_BACKFILL_DAYS"]
+    query = User.query.order_by(User.id)
+    if user_id:
+        query = query.filter_by(id=user_id)
+
+    for user in query.all():
+        if inline:
+            try:
+                with request_priority(BACKGROUND):
+                    new_count = sync_activities(user, backfill_days=days)
+            except RateLimitExceeded as e:
+                click.echo(f"User {user.id}: stopped, {str(e)}")
+                break
+            click.echo(f"User {user.id}: synced {new_count} activities from the last {days} days")
+        else:
+            job = enqueue_sync(user.id, kind="backfill", payload={"days": days})
+            click.echo(f"User {user.id}: backfill job {job.id} {job.status}")
+
+@app.cli.command("strava-rate-limit")
+def strava_rate_limit():
+    """Show the Strava API quota used in the current windows"""
+    from rate_limit import get_budget
+
+    budget = get_budget()
+    if budget is None:
+        click.echo("No Strava requests recorded yet")
+        return
+    click.echo(f"15 minutes from {budget['window_start']:%H:%M} UTC: {budget['usage_15min']}/{budget['limit_15min']}")
+    click.echo(f"Day {budget['day']}: {budget['usage_daily']}/{budget['limit_daily']}")
+
+@app.cli.command("purge-cache")
+@click.option("--all", "purge_all", is_flag=True, help="Delete every entry instead of only expired ones")
+def purge_cache(purge_all):
+    """Remove expired (or all) dashboard cache entries"""
+    from cache import clear_cache, purge_expired
+
+    if purge_all:
+        clear_cache()
+        click.echo("Cleared the dashboard cache")
+    else:
+        click.echo(f"Removed {purge_expired()} expired cache entries")
+
+@app.cli.command("webhook-subscribe")
+@click.option("--callback-url", help="Public URL of the /webhook view (default: next to the OAuth callback)")
+def webhook_subscribe(callback_url):
+    """Create the Strava push subscription, the app must be reachable to answer the handshake"""
+    from strava_http import get_session
+
+    if not app.config["STRAVA_WEBHOOK_VERIFY_TOKEN"]:
+        raise click.ClickException("Set STRAVA_WEBHOOK_VERIFY_TOKEN first")
+
+    callback_url = callback_url or app.config["STRAVA_REDIRECT_URI"].rsplit("/", 1)[0] + "/webhook"
+    response = get_session().post("/api/v3/push_subscriptions", data={
+        "client_id": app.config["STRAVA_CLIENT_ID"],
+        "client_secret": app.config["STRAVA_CLIENT_SECRET"],
+        "callback_url": callback_url,
+        "verify_token": app.config["STRAVA_WEBHOOK_VERIFY_TOKEN"]
+    })
+    if not response.ok:
+        raise click.ClickException(f"Strava refused the subscription: {response.text}")
+    click.echo(f"Subscribed {callback_url}, set STRAVA_WEBHOOK_SUBSCRIPTION_ID={response.json()['id']}")
+
+@app.cli.command("webhook-status")
+def webhook_status():
+    """Show the Strava push subscription and the webhook event queue"""
+    from sqlalchemy import func
+    from models import StravaEvent
+    from strava_http import get_session
+
+    response = get_session().get("/api/v3/push_subscriptions", params={
+        "client_id": app.config["STRAVA_CLIENT_ID"],
+        "client_secret": app.config["STRAVA_CLIENT_SECRET"]
+    })
+    if response.ok:
+        for subscription in response.json():
+            click.echo(f"Subscription {subscription['id']}: {subscription['callback_url']}")
+    else:
+        click.echo(f"Could not list subscriptions: {response.text}")
+
+    counts = db.session.query(StravaEvent.status, func.count(StravaEvent.id)).group_by(StravaEvent.status).all()
+    for status, count in sorted(counts):
+        click.echo(f"{status}: {count} events")
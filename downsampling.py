@@ -0,0 +1,117 @@
+import numpy as np
+
+# The first and last samples plus at least one bucket
+MIN_POINTS = 3
+
+def lttb_indices(x, y, max_points):
+    """
+    Pick the indices of at most max_points samples using Largest-Triangle-Three-Buckets
+    The first and last samples are always kept. The inner samples are split
+    into max_points - 2 buckets and from each bucket the point forming the
+    largest triangle with the previously kept point and the average of the
+    next bucket is kept, which preserves peaks and dips of the curve.
+    Returns a sorted array of indices into x and y
+    Raises ValueError if max_points is below MIN_POINTS
+    """
+    if max_points < MIN_POINTS:
+        raise ValueError(f"LTTB needs max_points of at least {MIN_POINTS}, got {max_points}")
+    n = len(x)
+    if max_points >= n:
+        return np.arange(n)
+
+    return _lttb(n, lambda: [(x, y)], max_points)[0]
+
+def lttb_downsample(n, chunks, max_points):
+    """
+    Downsample a series of n samples with LTTB (see lttb_indices) without
+    holding it in memory. chunks() must yield the series as consecutive
+    (x, y) array pairs and is called twice, once to average the buckets and
+    once to pick their points, so memory is bounded by max_points and the
+    chunk size rather than by n.
+    Returns (x, y) arrays of the kept samples
+    Raises ValueError if max_points is below MIN_POINTS
+    """
+    if max_points < MIN_POINTS:
+        raise ValueError(f"LTTB needs max_points of at least {MIN_POINTS}, got {max_points}")
+    if max_points >= n:
+        pairs = list(chunks())
+        return (
+            np.concatenate([x for x, _ in pairs]) if pairs else np.array([]),
+            np.concatenate([y for _, y in pairs]) if pairs else np.array([])
+        )
+
+    _, selected_x, selected_y = _lttb(n, chunks, max_points)
+    return selected_x, selected_y
+
+def _lttb(n, chunks, max_points):
+    """
+    LTTB over n > max_points samples delivered by chunks()
+    Returns the indices, x and y values of the kept samples, the values in
+    the types of the input
+    """
+    # Bucket boundaries over the inner points 1 .. n-2
+    n_buckets = max_points - 2
+    edges = np.linspace(1, n - 1, n_buckets + 1).astype(np.int64)
+
+    # First pass: the average point of every bucket. The bucket after the
+    # last one is the final sample on its own
+    sum_x = np.zeros(n_buckets)
+    sum_y = np.zeros(n_buckets)
+    offset = 0
+    for x, y in chunks():
+        if offset == 0:
+            x_type, y_type = np.asarray(x).dtype, np.asarray(y).dtype
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if offset == 0:
+            first_x, first_y = x[0], y[0]
+        # Sum the inner points of the chunk per bucket they fall in
+        low, high = max(offset, 1), min(offset + len(x), n - 1)
+        if low < high:
+            first_bucket = np.searchsorted(edges, low, side="right") - 1
+            starts = np.concatenate(([low], edges[(edges > low) & (edges < high)]))
+            buckets = slice(first_bucket, first_bucket + len(starts))
+            sum_x[buckets] += np.add.reduceat(x[low - offset:high - offset], starts - low)
+            sum_y[buckets] += np.add.reduceat(y[low - offset:high - offset], starts - low)
+        offset += len(x)
+    last_x, last_y = x[-1], y[-1]
+
+    counts = np.diff(edges)
+    next_x = np.append((sum_x / counts)[1:], last_x)
+    next_y = np.append((sum_y / counts)[1:], last_y)
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected_x = np.empty(max_points)
+    selected_y = np.empty(max_points)
+    selected[0], selected_x[0], selected_y[0] = 0, first_x, first_y
+    selected[-1], selected_x[-1], selected_y[-1] = n - 1, last_x, last_y
+
+    # Second pass: a bucket may span chunks, so keep its best point so far
+    bucket = 0
+    best_area = -1.0
+    offset = 0
+    for x, y in chunks():
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        end = offset + len(x)
+        position = max(offset, 1)
+        while bucket < n_buckets and position < end:
+            segment_end = min(edges[bucket + 1], end)
+            bx = x[position - offset:segment_end - offset]
+            by = y[position - offset:segment_end - offset]
+            prev_x, prev_y = selected_x[bucket], selected_y[bucket]
+            # Twice the triangle area, the constant factor doesn't change the argmax
+            areas = np.abs((prev_x - next_x[bucket]) * (by - prev_y) - (prev_x - bx) * (next_y[bucket] - prev_y))
+            i = int(np.argmax(areas))
+            if areas[i] > best_area:
+                best_area = areas[i]
+                selected[bucket + 1], selected_x[bucket + 1], selected_y[bucket + 1] = position + i, bx[i], by[i]
+
+            position = segment_end
+            if position == edges[bucket + 1]:
+                bucket += 1
+                best_area = -1.0
+        offset = end
+
+    # The kept values are exact in float64, so they convert back losslessly
+    return selected, selected_x.astype(x_type), selected_y.astype(y_type)
@@ -0,0 +1,154 @@
+import struct
+import zlib
+import numpy as np
+
+# Binary layout of a stored heart rate stream:
+#   header: magic "ZWHR", format version, flags, sample count (little endian)
+#   body:   time deltas (first delta is the first time value), then HR values
+# The narrow format uses uint16 deltas and uint8 HR; streams that do not fit
+# (long pauses, HR above 255) fall back to uint32 deltas and uint16 HR.
+# The body is zlib compressed when FLAG_ZLIB is set.
+MAGIC = b"ZWHR"
+FORMAT_VERSION = 1
+FLAG_ZLIB = 0x01
+FLAG_WIDE = 0x02
+HEADER = struct.Struct("<4sBBI")
+
+def encode_hr_stream(times, hr_values, compress=True):
+    """
+    Encode time and heart rate arrays into the compact binary format
+    Raises ValueError if the stream can't be represented (non-integer or
+    decreasing times, negative HR values)
+    """
+    times = np.asarray(times)
+    hr_values = np.asarray(hr_values)
+
+    if len(times) != len(hr_values):
+        raise ValueError("Time and heart rate streams differ in length")
+
+    if len(times) and not (np.all(times == np.round(times)) and np.all(hr_values == np.round(hr_values))):
+        raise ValueError("Heart rate streams must contain whole numbers")
+
+    deltas = np.diff(times.astype(np.int64), prepend=0)
+    hr_values = hr_values.astype(np.int64)
+    if len(times) and (deltas.min() < 0 or hr_values.min() < 0):
+        raise ValueError("Heart rate stream times must be increasing and values positive")
+
+    flags = 0
+    delta_type, hr_type = np.uint16, np.uint8
+    if len(times) and (deltas.max() > np.iinfo(np.uint16).max or hr_values.max() > np.iinfo(np.uint8).max):
+        flags |= FLAG_WIDE
+        delta_type, hr_type = np.uint32, np.uint16
+        if deltas.max() > np.iinfo(np.uint32).max or hr_values.max() > np.iinfo(np.uint16).max:
+            raise ValueError("Heart rate stream values out of range")
+
+    body = deltas.astype(delta_type).tobytes() + hr_values.astype(hr_type).tobytes()
+    if compress:
+        flags |= FLAG_ZLIB
+        body = zlib.compress(body)
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, flags, len(times)) + body
+
+def _read_header(blob):
+    """
+    Parse the header of a binary heart rate stream
+    Returns (flags, sample count, delta dtype, HR dtype)
+    """
+    magic, version, flags, count = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported heart rate stream format (version {version})")
+
+    delta_type, hr_type = (np.uint32, np.uint16) if flags & FLAG_WIDE else (np.uint16, np.uint8)
+    return flags, count, np.dtype(delta_type), np.dtype(hr_type)
+
+def decode_hr_stream(blob):
+    """
+    Decode a binary heart rate stream
+    Returns a (times, hr_values) tuple of NumPy arrays. The HR array is a
+    read-only view over the stored bytes.
+    """
+    flags, count, delta_type, hr_type = _read_header(blob)
+
+    body = memoryview(blob)[HEADER.size:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+
+    deltas = np.frombuffer(body, dtype=delta_type, count=count)
+    hr_values = np.frombuffer(body, dtype=hr_type, count=count, offset=count * deltas.itemsize)
+    times = np.cumsum(deltas, dtype=np.int64)
+
+    return times, hr_values
+
+def hr_stream_length(blob):
+    """Return the number of samples in a binary heart rate stream without decoding it"""
+    return _read_header(blob)[1]
+
+class _BodyReader:
+    """Sequential reader over the body of a stream, decompressing only what is read"""
+
+    def __init__(self, blob, flags):
+        self._input = memoryview(blob)[HEADER.size:]
+        self._decompressor = zlib.decompressobj() if flags & FLAG_ZLIB else None
+        self._buffer = bytearray()
+
+    def read(self, size):
+        """Return the next size bytes of the body, fewer at its end"""
+        while len(self._buffer) < size:
+            wanted = size - len(self._buffer)
+            if self._decompressor is None:
+                piece, self._input = self._input[:wanted], self._input[wanted:]
+            else:
+                piece = self._decompressor.decompress(self._input, wanted)
+                self._input = self._decompressor.unconsumed_tail
+            if not piece:
+                break
+            self._buffer += piece
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def skip(self, size, piece_size=65536):
+        """Advance past size bytes of the body"""
+        while size > 0:
+            size -= len(self.read(min(size, piece_size)))
+
+def iter_hr_stream(blob, chunk_size=4096):
+    """
+    Decode a binary heart rate stream chunk_size samples at a time
+    Yields (times, hr_values) array pairs. Only a chunk of the decoded stream
+    is in memory at once, whatever the length of the stream.
+    """
+    flags, count, delta_type, hr_type = _read_header(blob)
+
+    # The body holds all time deltas and then all HR values, so each column
+    # gets its own reader
+    deltas = _BodyReader(blob, flags)
+    hr_values = _BodyReader(blob, flags)
+    hr_values.skip(count * delta_type.itemsize)
+
+    last_time = 0
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+        times = last_time + np.cumsum(np.frombuffer(deltas.read(size * delta_type.itemsize), dtype=delta_type), dtype=np.int64)
+        last_time = times[-1]
+        yield times, np.frombuffer(hr_values.read(size * hr_type.itemsize), dtype=hr_type)
+
+def points_to_arrays(points):
+    """
+    Split a list of [time, hr] pairs into separate time and HR arrays
+    Each column keeps its own type, so integer times stay integers when
+    the HR values are floats
+    """
+    if len(points) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    times = np.asarray([point[0] for point in points])
+    hr_values = np.asarray([point[1] for point in points])
+    return times, hr_values
+
+def arrays_to_points(times, hr_values):
+    """
+    Join time and HR arrays into a list of [time, hr] pairs of Python numbers
+    """
+    return [list(point) for point in zip(np.asarray(times).tolist(), np.asarray(hr_values).tolist())]
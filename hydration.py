@@ -0,0 +1,170 @@
+# On-demand heart rate stream hydration
+#
+# With STRAVA_STREAM_HYDRATION=lazy, sync only fetches streams at the coarse
+# STRAVA_STREAM_RESOLUTION (default "medium", about 1000 samples instead of up
+# to 10000), enough for the zone totals and for recalculating them when the
+# zone settings change. "low" (about 100 samples) is an opt-in that moves
+# another tenth of the bytes but puts about 2% of the time in a different
+# zone, against 0.4% at "medium". Onboarding a user with years of history
+# still takes one stream request per activity, but moves and stores a
+# fraction of the bytes, and only viewed or recent activities cost a second
+# request. The STRAVA_DETAIL_STREAM_RESOLUTION stream is fetched the first
+# time the activity page or its chart API needs it, and the activity's zone
+# times are recalculated from it. With the default "eager" hydration sync
+# stores the detail stream right away, streams stored coarse before (by a
+# lazy sync, or by a sync with an older default) are still hydrated on first
+# view.
+#
+# Concurrent viewers of the same activity in one process share a single
+# Strava request: the first one fetches, the others wait for it and then read
+# the stored stream. Other processes may fetch the same stream once more,
+# which is harmless because hydrating is idempotent.
+#
+# Activities started within the last STRAVA_PREFETCH_DAYS are hydrated in the
+# background by a "hydrate" sync job queued after each sync.
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+import requests
+from app import app, db
+from cache import invalidate_user
+from models import Activity
+from rate_limit import BACKGROUND, INTERACTIVE, request_priority
+from rollups import add_activities_to_rollups, remove_activities_from_rollups
+
+logger = logging.getLogger(__name__)
+
+# Stream resolutions from coarsest to finest
+RESOLUTIONS = ("low", "medium", "high", "full")
+
+_inflight = {}  # activity id -> threading.Event set when its fetch finished
+_inflight_lock = threading.Lock()
+
+def lazy_hydration_enabled():
+    """Return whether sync leaves the detail streams to be fetched on demand"""
+    return app.config["STRAVA_STREAM_HYDRATION"] == "lazy"
+
+def sync_stream_resolution():
+    """
+    Return the resolution sync fetches heart rate streams at
+    Activity pages show the stored stream, so that is the detail resolution
+    unless lazy hydration fetches it later
+    """
+    if lazy_hydration_enabled():
+        return app.config["STRAVA_STREAM_RESOLUTION"]
+    return app.config["STRAVA_DETAIL_STREAM_RESOLUTION"]
+
+def coarse_resolutions():
+    """Return the stream resolutions below STRAVA_DETAIL_STREAM_RESOLUTION"""
+    detail = app.config["STRAVA_DETAIL_STREAM_RESOLUTION"]
+    return RESOLUTIONS[:RESOLUTIONS.index(detail)]
+
+def needs_hydration(activity):
+    """
+    Check if the activity's stored stream is coarser than detail views want
+    Also true in eager mode for streams a lazy or older sync stored coarse,
+    streams stored before their resolution was recorded count as complete
+    """
+    return bool(activity.has_heartrate and activity.stream_resolution in coarse_resolutions())
+
+def hydrate_activity(activity, priority=INTERACTIVE):
+    """
+    Fetch and store the detail resolution stream of an activity
+    Callers in this process that ask for an activity already being fetched
+    wait for that fetch instead of starting another one
+    Raises RateLimitExceeded when the Strava quota is used up
+    Returns True if the activity has its detail stream afterwards
+    """
+    with _inflight_lock:
+        done = _inflight.get(activity.id)
+        leader = done is None
+        if leader:
+            done = _inflight[activity.id] = threading.Event()
+
+    if not leader:
+        done.wait(app.config["STRAVA_CONNECT_TIMEOUT"] + app.config["STRAVA_READ_TIMEOUT"])
+        db.session.refresh(activity)
+        return not needs_hydration(activity)
+
+    try:
+        return _fetch_detail_stream(activity, priority)
+    finally:
+        with _inflight_lock:
+            del _inflight[activity.id]
+        done.set()
+
+def _fetch_detail_stream(activity, priority):
+    """Replace the coarse stream and the zone times derived from it"""
+    from auth import refresh_strava_token
+    from strava_client import fetch_hr_stream
+    from zone_calculator import calculate_activity_zones
+
+    user = activity.user
+    resolution = app.config["STRAVA_DETAIL_STREAM_RESOLUTION"]
+    if not refresh_strava_token(user):
+        logger.error(f"Failed to refresh token for user {user.id}")
+        return False
+
+    started = time.perf_counter()
+    try:
+        with request_priority(priority):
+            hr_stream = fetch_hr_stream(user.access_token, activity.strava_id, resolution)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error fetching stream of activity {activity.id}: {str(e)}")
+        return False
+
+    # Recorded even without a stream, so views don't ask Strava again
+    activity.stream_resolution = resolution
+    if hr_stream:
+        remove_activities_from_rollups([activity])
+        activity.set_hr_data(hr_stream)
+        zone_data = calculate_activity_zones(user, hr_stream)
+        if zone_data:
+            activity.set_zone_data(zone_data)
+        add_activities_to_rollups([activity])
+        # The zone times moved, so dashboard ETags and cached totals must change
+        user.activities_changed_at = datetime.utcnow()
+    db.session.commit()
+    invalidate_user(user.id)
+
+    logger.info("Activity stream hydrated", extra={
+        "activity_id": activity.id,
+        "resolution": resolution,
+        "samples": len(hr_stream) if hr_stream else 0,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+    })
+    return True
+
+def _prefetch_query(user_id):
+    """Query the user's recent activities that still have a coarse stream"""
+    since = datetime.utcnow() - timedelta(days=app.config["STRAVA_PREFETCH_DAYS"])
+    return Activity.query.filter(
+        Activity.user_id == user_id,
+        Activity.has_heartrate == True,
+        Activity.start_date >= since,
+        Activity.stream_resolution.in_(coarse_resolutions())
+    )
+
+def queue_prefetch(user_id):
+    """Queue a background hydrate job if the user has recent activities to hydrate"""
+    from sync_queue import enqueue_sync
+
+    if not lazy_hydration_enabled() or not app.config["STRAVA_PREFETCH_DAYS"]:
+        return None
+    if _prefetch_query(user_id).first() is None:
+        return None
+    return enqueue_sync(user_id, kind="hydrate")
+
+def prefetch_streams(user):
+    """
+    Hydrate the user's recent activities, newest first
+    Raises RateLimitExceeded when the Strava quota is used up, activities
+    hydrated up to then are kept
+    Returns the number of hydrated activities
+    """
+    hydrated = 0
+    for activity in _prefetch_query(user.id).order_by(Activity.start_date.desc()).all():
+        if hydrate_activity(activity, priority=BACKGROUND):
+            hydrated += 1
+    return hydrated
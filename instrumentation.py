@@ -0,0 +1,182 @@
+# Request timing and hot-path instrumentation
+#
+# With METRICS_ENABLED set, the time spent in database queries, Strava HTTP
+# calls, token refreshes, zone calculation, stream decoding and template
+# rendering is recorded:
+#   - per request, in a Server-Timing response header (visible in the
+#     browser's network panel)
+#   - per process, as Prometheus histograms served at /metrics
+# When it is off, timed() returns functions unchanged and no hooks are
+# installed, so there is no overhead at all.
+#
+# Metrics are kept per process; with several gunicorn workers each scrape
+# sees the worker that served it, so aggregate them with sum() by instance.
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from flask import Response, abort, g, has_request_context, request
+from app import app
+
+ENABLED = app.config["METRICS_ENABLED"]
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """Prometheus style histogram with one series per label value"""
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._series = {}  # label value -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def render(self):
+        """Return the histogram in the Prometheus text exposition format"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for label_value, values in sorted(series.items()):
+            labels = f'{self.label}="{label_value}"'
+            for bound, count in zip(BUCKETS, values):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {values[-2]}')
+            lines.append(f"{self.name}_count{{{labels}}} {values[-2]}")
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-1]:.6f}")
+        return lines
+
+REQUEST_DURATION = Histogram("zw_request_duration_seconds", "Time to handle a request", "endpoint")
+OPERATION_DURATION = Histogram("zw_operation_duration_seconds", "Time spent in instrumented operations", "operation")
+_status_counts = defaultdict(int)
+_status_lock = threading.Lock()
+
+def record(operation, seconds):
+    """Add a timed operation to the metrics and to the current request's Server-Timing"""
+    OPERATION_DURATION.observe(operation, seconds)
+    if has_request_context() and "timings" in g:
+        timing = g.timings[operation]
+        timing[0] += seconds
+        timing[1] += 1
+
+def timed(operation):
+    """
+    Decorator recording the duration of every call under operation
+    Returns the function itself when instrumentation is disabled
+    """
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(operation, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+def _before_request():
+    g.request_started = time.perf_counter()
+    g.timings = defaultdict(lambda: [0.0, 0])  # operation -> [seconds, calls]
+
+def _after_request(response):
+    if "request_started" not in g:
+        return response
+
+    total = time.perf_counter() - g.request_started
+    REQUEST_DURATION.observe(request.endpoint or "unknown", total)
+    with _status_lock:
+        _status_counts[(request.endpoint or "unknown", response.status_code)] += 1
+
+    entries = [
+        f'{operation};dur={seconds * 1000:.1f};desc="{calls} calls"'
+        for operation, (seconds, calls) in g.timings.items()
+    ]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    response.headers.add("Server-Timing", ", ".join(entries))
+    return response
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's execution context rather than the connection,
+    # so nothing is left behind when the statement raises
+    context.query_started = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record("db", time.perf_counter() - context.query_started)
+
+def _install_sqlalchemy_hooks():
+    """Time every SQL statement through engine events"""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+def _install_template_hooks(app):
+    """Time Jinja rendering through Flask's template signals"""
+    from flask import before_render_template, template_rendered
+
+    def before_render(sender, template, context, **extra):
+        g.setdefault("render_started", []).append(time.perf_counter())
+
+    def rendered(sender, template, context, **extra):
+        if g.get("render_started"):
+            record("render", time.perf_counter() - g.render_started.pop())
+
+    before_render_template.connect(before_render, app, weak=False)
+    template_rendered.connect(rendered, app, weak=False)
+
+def render_metrics():
+    """Return all metrics in the Prometheus text exposition format"""
+    from stream_cache import stream_cache
+
+    lines = REQUEST_DURATION.render() + OPERATION_DURATION.render()
+
+    lines += ["# HELP zw_requests_total Requests by endpoint and status", "# TYPE zw_requests_total counter"]
+    with _status_lock:
+        counts = dict(_status_counts)
+    for (endpoint, status), count in sorted(counts.items()):
+        lines.append(f'zw_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+    stats = stream_cache.stats()
+    for key in ["hits", "misses", "evictions"]:
+        lines += [f"# TYPE zw_stream_cache_{key}_total counter", f"zw_stream_cache_{key}_total {stats[key]}"]
+    lines += ["# TYPE zw_stream_cache_bytes gauge", f"zw_stream_cache_bytes {stats['bytes']}"]
+    return "\n".join(lines) + "\n"
+
+def require_metrics_token():
+    """Abort with 401 unless the request has METRICS_TOKEN as its bearer token, when it is set"""
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        abort(401)
+
+def metrics_view():
+    """Prometheus scrape endpoint, protected by METRICS_TOKEN when it is set"""
+    require_metrics_token()
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+def init_instrumentation(app):
+    """Install the request, database and template hooks if METRICS_ENABLED is set"""
+    if not ENABLED:
+        return
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    _install_sqlalchemy_hooks()
+    _install_template_hooks(app)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,88 @@
+# Logging setup
+#
+# Modules log through their own logger (logging.getLogger(__name__)) and pass
+# structured values as extra fields, e.g.
+#   logger.info("Sync finished", extra={"user_id": user.id, "new_activities": 3})
+# Settings come from the environment:
+#   LOG_LEVEL        root level, default INFO
+#   LOG_LEVELS       per-logger overrides, e.g. "strava_client=DEBUG,urllib3=WARNING"
+#   LOG_FORMAT       "text" (default) or "json" for one JSON object per line
+#   LOG_SAMPLE_RATE  fraction of records logged with extra={"sampled": True}
+#                    that are kept, for messages inside hot loops (default 0.01)
+import json
+import logging
+import os
+import random
+import sys
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has, anything else was passed through extra
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled"}
+
+def _extra_fields(record):
+    """Return the structured fields passed to a log call through extra"""
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **_extra_fields(record)
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Human readable format with the extra fields appended as key=value pairs"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+class SamplingFilter(logging.Filter):
+    """Keep only a random fraction of records marked with extra={"sampled": True}"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False):
+            return random.random() < self.rate
+        return True
+
+def _parse_levels(value):
+    """Parse "name=LEVEL,name=LEVEL" into a dictionary"""
+    levels = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def configure_logging():
+    """Set up the root logger from the LOG_* environment variables"""
+    handler = logging.StreamHandler(sys.stderr)
+    if os.environ.get("LOG_FORMAT", "text").lower() == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter())
+    handler.addFilter(SamplingFilter(float(os.environ.get("LOG_SAMPLE_RATE", 0.01))))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    for name, level in _parse_levels(os.environ.get("LOG_LEVELS")).items():
+        logging.getLogger(name).setLevel(level)
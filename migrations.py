@@ -0,0 +1,186 @@
+# Versioned schema and data migrations
+#
+# Migrations run from the CLI (flask --app main db-upgrade) before the web
+# processes start, so importing the app never touches the database. Applied
+# versions are recorded in the schema_migration table.
+#
+# Every migration must be safe to run again: migration 1 creates missing
+# tables from the current models, so later DDL steps check the database before
+# changing it (see schema.py), and data backfills only select rows that still
+# need work. Large tables are changed online: columns are added as nullable,
+# indexes are built concurrently on PostgreSQL and backfills commit in batches.
+import json
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Activity, SchemaMigration, StravaEvent, StravaRateLimit, User, hr_arrays_from_columns, zone_time_columns
+from hr_stream import encode_hr_stream
+from schema import add_column, create_index
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """Register a migration function under a version number"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+def convert_hr_data(batch_size=500, log=logger.info):
+    """
+    Convert legacy JSON heart rate streams to the binary format in batches
+    Returns the number of converted and skipped activities
+    """
+    converted = 0
+    skipped = 0
+    last_id = 0
+
+    while True:
+        # Keyset pagination so rows that can't be converted are not revisited
+        rows = db.session.query(Activity.id, Activity.hr_data).filter(
+            Activity.id > last_id,
+            Activity.hr_stream.is_(None),
+            Activity.hr_data.isnot(None)
+        ).order_by(Activity.id).limit(batch_size).all()
+        if not rows:
+            break
+
+        updates = []
+        for activity_id, hr_data in rows:
+            try:
+                times, hr_values = hr_arrays_from_columns(None, hr_data)
+                updates.append({
+                    "id": activity_id,
+                    "hr_stream": encode_hr_stream(times, hr_values),
+                    "hr_data": None
+                })
+            except ValueError as e:
+                log(f"Skipping activity {activity_id}: {str(e)}")
+                skipped += 1
+
+        if updates:
+            db.session.execute(update(Activity), updates)
+        db.session.commit()
+
+        converted += len(updates)
+        last_id = rows[-1][0]
+        log(f"Converted {converted} activities so far")
+
+    return converted, skipped
+
+def backfill_zone_columns(batch_size=1000, log=logger.info):
+    """
+    Populate the per-zone time columns from existing zone_data in batches
+    Returns the number of updated activities
+    """
+    updated = 0
+    last_id = 0
+
+    while True:
+        rows = db.session.query(Activity.id, Activity.zone_data).filter(
+            Activity.id > last_id,
+            Activity.total_s.is_(None),
+            Activity.zone_data.isnot(None)
+        ).order_by(Activity.id).limit(batch_size).all()
+        if not rows:
+            break
+
+        updates = [
+            {"id": activity_id, **zone_time_columns(json.loads(zone_data))}
+            for activity_id, zone_data in rows
+        ]
+        db.session.execute(update(Activity), updates)
+        db.session.commit()
+
+        updated += len(updates)
+        last_id = rows[-1][0]
+        log(f"Updated {updated} activities so far")
+
+    return updated
+
+@migration(1, "Create missing tables")
+def create_tables():
+    db.create_all()
+
+@migration(2, "Add sync watermark, binary stream, zone time and zone version columns")
+def add_columns():
+    add_column("user", "sync_watermark")
+    add_column("activity", "hr_stream")
+    for column in ["zone1_s", "zone2_s", "zone3_s", "zone4_s", "zone5_s", "below_s", "total_s"]:
+        add_column("activity", column)
+    add_column("heart_rate_zones", "version")
+
+@migration(3, "Convert JSON heart rate streams to the binary format")
+def convert_streams():
+    convert_hr_data()
+
+@migration(4, "Backfill per-zone time columns")
+def backfill_zone_times():
+    backfill_zone_columns()
+
+@migration(5, "Rebuild daily zone rollups")
+def rebuild_rollups():
+    from rollups import rebuild_user_rollups
+
+    for (user_id,) in db.session.query(User.id).order_by(User.id).all():
+        rebuild_user_rollups(user_id)
+        db.session.commit()
+
+@migration(6, "Create dashboard activity indexes")
+def create_activity_indexes():
+    for index_name in ["ix_activity_user_hr_start", "ix_activity_user_hr_type_start", "ix_activity_user_id"]:
+        create_index("activity", index_name)
+
+@migration(7, "Add deferred sync jobs and the shared Strava rate limit budget")
+def add_rate_limit_budget():
+    add_column("sync_job", "run_after")
+    StravaRateLimit.__table__.create(db.engine, checkfirst=True)
+
+@migration(8, "Add the Strava webhook event queue")
+def add_webhook_events():
+    add_column("user", "activities_changed_at")
+    StravaEvent.__table__.create(db.engine, checkfirst=True)
+
+@migration(9, "Record the resolution of stored streams")
+def add_stream_resolution():
+    add_column("activity", "stream_resolution")
+
+def get_applied_versions():
+    """Return the set of applied migration versions"""
+    if not inspect(db.engine).has_table(SchemaMigration.__tablename__):
+        return set()
+    return {version for (version,) in db.session.query(SchemaMigration.version)}
+
+def get_pending_migrations(target=None):
+    """Return the (version, description, func) tuples not applied yet, in order"""
+    applied = get_applied_versions()
+    return [
+        (version, description, func)
+        for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0])
+        if version not in applied and (target is None or version <= target)
+    ]
+
+def upgrade(target=None, log=logger.info):
+    """
+    Apply pending migrations up to target (default: all) in version order
+    Returns the list of applied versions
+    """
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    applied = []
+
+    for version, description, func in get_pending_migrations(target):
+        log(f"Applying migration {version}: {description}")
+        func()
+        try:
+            db.session.add(SchemaMigration(version=version, description=description, applied_at=datetime.utcnow()))
+            db.session.commit()
+        except IntegrityError:
+            # Another process applied it at the same time, migrations are idempotent
+            db.session.rollback()
+        applied.append(version)
+
+    return applied
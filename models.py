@@ -2,11 +2,20 @@ from datetime import datetime
 from app import db
 from flask_login import UserMixin
 import json
-import numpy as np
+import logging
+from stream_cache import stream_cache
+from instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
+# NumPy and hr_stream (which needs it) are imported where they are used, so
+# loading the models at startup doesn't pay for importing NumPy
 
 # Custom JSON encoder to handle NumPy types
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
+        import numpy as np
+        
         if isinstance(obj, np.integer):
             return int(obj)
         elif isinstance(obj, np.floating):
@@ -26,6 +35,8 @@ class User(UserMixin, db.Model):
     access_token = db.Column(db.String(255))
     refresh_token = db.Column(db.String(255))
     token_expiry = db.Column(db.DateTime)
+    sync_watermark = db.Column(db.DateTime)  # Start date of the newest synced Strava activity
+    activities_changed_at = db.Column(db.DateTime)  # Last time a webhook edited or deleted a stored activity
     activities = db.relationship('Activity', backref='user', lazy='dynamic')
     
     def token_expired(self):
@@ -51,28 +62,159 @@ class Activity(db.Model):
     average_hr = db.Column(db.Float)
     max_hr = db.Column(db.Float)
     has_heartrate = db.Column(db.Boolean, default=False)
-    hr_data = db.Column(db.Text)  # Stored as JSON string
-    zone_data = db.Column(db.Text)  # Stored as JSON string
+    # The stream and zone blobs are the largest fields, so they are deferred and
+    # only loaded when accessed or explicitly undeferred by a query
+    hr_data = db.deferred(db.Column(db.Text), group="stream")  # Legacy JSON string, see hr_stream
+    hr_stream = db.deferred(db.Column(db.LargeBinary), group="stream")  # Compact binary stream, see hr_stream.py
+    stream_resolution = db.Column(db.String(8))  # Strava resolution of the stored stream, None if not recorded (see hydration.py)
+    zone_data = db.deferred(db.Column(db.Text))  # Stored as JSON string
+    
+    # Seconds per zone, copied from zone_data so dashboard totals can be summed in SQL
+    zone1_s = db.Column(db.Float)
+    zone2_s = db.Column(db.Float)
+    zone3_s = db.Column(db.Float)
+    zone4_s = db.Column(db.Float)
+    zone5_s = db.Column(db.Float)
+    below_s = db.Column(db.Float)
+    total_s = db.Column(db.Float)
+    
+    def has_hr_stream(self):
+        """Check if heart rate data is stored for this activity without loading it"""
+        return bool(self.has_stored_stream)
+    
+    def get_zone_percentages(self):
+        """Return the percentage of time in each zone from the zone time columns"""
+        if not self.total_s:
+            return {}
+        return {
+            zone: round((getattr(self, column) or 0) / self.total_s * 100, 1)
+            for zone, column in ZONE_TIME_COLUMNS.items()
+            if zone != "total"
+        }
+    
+    def get_hr_array(self):
+        """
+        Return heart rate data as a (times, hr_values) tuple of read-only NumPy arrays
+        Decoded streams are cached per process, see stream_cache.py
+        """
+        stored = self.hr_stream if self.hr_stream is not None else self.hr_data
+        return stream_cache.get_or_load(
+            "hr", self.id, stored,
+            lambda: hr_arrays_from_columns(self.hr_stream, self.hr_data)
+        )
+    
+    def get_hr_chunks(self):
+        """
+        Return heart rate data as (sample count, chunks), where chunks() yields
+        (times, hr_values) array pairs and can be called repeatedly
+        Binary streams are decoded a chunk at a time and bypass the stream
+        cache; legacy JSON rows are decoded whole
+        """
+        from hr_stream import hr_stream_length, iter_hr_stream
+        
+        blob = self.hr_stream
+        if blob is not None:
+            return hr_stream_length(blob), lambda: iter_hr_stream(blob)
+        times, hr_values = self.get_hr_array()
+        return len(times), lambda: iter([(times, hr_values)] if len(times) else [])
     
     def get_hr_data(self):
-        """Return heart rate data as a list"""
-        if self.hr_data:
-            return json.loads(self.hr_data)
-        return []
+        """Return heart rate data as a list of [time, hr] pairs"""
+        from hr_stream import arrays_to_points
+        
+        times, hr_values = self.get_hr_array()
+        return arrays_to_points(times, hr_values)
     
     def set_hr_data(self, hr_data):
-        """Store heart rate data as a JSON string"""
-        self.hr_data = json.dumps(hr_data, cls=NumpyEncoder)
+        """Store heart rate data in the binary format, falling back to JSON"""
+        import numpy as np
+        from hr_stream import arrays_to_points, encode_hr_stream, points_to_arrays
+        
+        if isinstance(hr_data, tuple) and len(hr_data) == 2 and isinstance(hr_data[0], np.ndarray):
+            times, hr_values = hr_data
+        else:
+            times, hr_values = points_to_arrays(hr_data)
+        
+        try:
+            self.hr_stream = encode_hr_stream(times, hr_values)
+            self.hr_data = None
+        except ValueError as e:
+            logger.warning(f"Storing activity {self.strava_id} stream as JSON: {str(e)}")
+            self.hr_stream = None
+            self.hr_data = json.dumps(arrays_to_points(times, hr_values))
+        stream_cache.invalidate(self.id, "hr")
     
     def get_zone_data(self):
-        """Return zone data as a dictionary"""
+        """Return zone data as a dictionary, shared through the stream cache so it must not be modified"""
         if self.zone_data:
-            return json.loads(self.zone_data)
+            return stream_cache.get_or_load("zones", self.id, self.zone_data, lambda: json.loads(self.zone_data))
         return {}
     
     def set_zone_data(self, zone_data):
-        """Store zone data as a JSON string"""
+        """Store zone data as a JSON string along with the per-zone time columns"""
         self.zone_data = json.dumps(zone_data, cls=NumpyEncoder)
+        stream_cache.invalidate(self.id, "zones")
+        for column, value in zone_time_columns(zone_data).items():
+            setattr(self, column, value)
+
+# Whether a stream is stored, computed in SQL so the blobs themselves stay unloaded
+Activity.has_stored_stream = db.column_property(
+    Activity.__table__.c.hr_stream.isnot(None) | Activity.__table__.c.hr_data.isnot(None),
+    deferred=True
+)
+
+# Indexes for the dashboard queries, which filter a user's heart rate
+# activities by date range (and optionally type) and list them newest first
+db.Index(
+    'ix_activity_user_hr_start',
+    Activity.user_id, Activity.start_date.desc(),
+    sqlite_where=Activity.has_heartrate == True,
+    postgresql_where=Activity.has_heartrate == True
+)
+# Also answers the distinct activity types query from the index alone
+db.Index(
+    'ix_activity_user_hr_type_start',
+    Activity.user_id, Activity.type, Activity.start_date,
+    sqlite_where=Activity.has_heartrate == True,
+    postgresql_where=Activity.has_heartrate == True
+)
+# Every activity of a user, e.g. for sync watermarks and the ETag fingerprint
+db.Index('ix_activity_user_id', Activity.user_id, Activity.id)
+
+ZONE_TIME_COLUMNS = {
+    "zone1": "zone1_s",
+    "zone2": "zone2_s",
+    "zone3": "zone3_s",
+    "zone4": "zone4_s",
+    "zone5": "zone5_s",
+    "below": "below_s",
+    "total": "total_s"
+}
+
+def zone_time_columns(zone_data):
+    """
+    Map the "times" of zone data onto Activity's zone time columns
+    Returns a dictionary of column name to seconds, None where unknown
+    """
+    times = (zone_data or {}).get("times", {})
+    return {
+        column: float(times[zone]) if zone in times else None
+        for zone, column in ZONE_TIME_COLUMNS.items()
+    }
+
+@timed("decode")
+def hr_arrays_from_columns(hr_stream, hr_data):
+    """
+    Decode heart rate arrays from the stored column values
+    Prefers the binary stream and falls back to legacy JSON rows
+    """
+    from hr_stream import decode_hr_stream, points_to_arrays
+    
+    if hr_stream is not None:
+        return decode_hr_stream(hr_stream)
+    if hr_data:
+        return points_to_arrays(json.loads(hr_data))
+    return points_to_arrays([])
 
 class HeartRateZones(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -80,6 +222,7 @@ class HeartRateZones(db.Model):
     max_hr = db.Column(db.Integer)  # Maximum heart rate
     resting_hr = db.Column(db.Integer)  # Resting heart rate
     zone_method = db.Column(db.String(64), default="percentage")  # percentage or karvonen
+    version = db.Column(db.Integer, default=1)  # Bumped whenever the zones change, used in ETags
     
     # Zone thresholds (percentages of max HR)
     zone1_threshold = db.Column(db.Integer, default=60)  # 50-60% of max HR - Very Light
@@ -128,3 +271,91 @@ class HeartRateZones(db.Model):
         }
         
         return zones
+
+class DailyZoneRollup(db.Model):
+    """Time in each zone per user, day and activity type, maintained by rollups.py"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    activity_type = db.Column(db.String(64), primary_key=True)
+    activity_count = db.Column(db.Integer, default=0, nullable=False)
+    zone1_s = db.Column(db.Float, default=0, nullable=False)
+    zone2_s = db.Column(db.Float, default=0, nullable=False)
+    zone3_s = db.Column(db.Float, default=0, nullable=False)
+    zone4_s = db.Column(db.Float, default=0, nullable=False)
+    zone5_s = db.Column(db.Float, default=0, nullable=False)
+    below_s = db.Column(db.Float, default=0, nullable=False)
+    total_s = db.Column(db.Float, default=0, nullable=False)
+
+class SyncJob(db.Model):
+    """A queued Strava sync for one user, processed by sync_queue workers"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(32), default="sync", nullable=False)
+    status = db.Column(db.String(16), default="queued", nullable=False)  # queued, running, done or failed
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    payload = db.Column(db.Text)  # JSON options, e.g. {"days": 365} for a backfill
+    new_activities = db.Column(db.Integer)
+    error = db.Column(db.Text)
+    run_after = db.Column(db.DateTime)  # Deferred until then, e.g. when the Strava rate limit is used up
+    
+    def get_payload(self):
+        """Return the job options as a dictionary"""
+        if self.payload:
+            return json.loads(self.payload)
+        return {}
+    
+    __table_args__ = (
+        db.Index('ix_sync_job_status_created', 'status', 'created_at'),
+        # At most one active job of each kind per user
+        db.Index(
+            'ux_sync_job_active_user_kind', 'user_id', 'kind', unique=True,
+            sqlite_where=db.text("status IN ('queued', 'running')"),
+            postgresql_where=db.text("status IN ('queued', 'running')")
+        ),
+    )
+
+class StravaEvent(db.Model):
+    """A Strava webhook event, queued for the sync workers by webhooks.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    object_type = db.Column(db.String(16), nullable=False)  # activity or athlete
+    object_id = db.Column(db.BigInteger, nullable=False)  # Strava activity or athlete id
+    aspect_type = db.Column(db.String(16), nullable=False)  # create, update or delete
+    owner_id = db.Column(db.BigInteger, nullable=False)  # Strava athlete id
+    event_time = db.Column(db.BigInteger, nullable=False)  # Unix time Strava reported for the event
+    updates = db.Column(db.Text)  # JSON, e.g. {"title": "Morning Run"} for an update
+    status = db.Column(db.String(16), default="queued", nullable=False)  # queued, running, done, ignored or failed
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    processed_at = db.Column(db.DateTime)
+    run_after = db.Column(db.DateTime)  # Deferred until then by the Strava rate limit
+    error = db.Column(db.Text)
+    
+    def get_updates(self):
+        """Return the changed fields as a dictionary"""
+        if self.updates:
+            return json.loads(self.updates)
+        return {}
+    
+    __table_args__ = (
+        # Strava retries deliveries, a repeated event is stored only once
+        db.UniqueConstraint('object_type', 'object_id', 'aspect_type', 'event_time', name='ux_strava_event_delivery'),
+        db.Index('ix_strava_event_status_received', 'status', 'received_at'),
+    )
+
+class StravaRateLimit(db.Model):
+    """Strava API quota usage shared by all processes, a single row maintained by rate_limit.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    window_start = db.Column(db.DateTime, nullable=False)  # Start of the current 15 minute window (UTC)
+    day = db.Column(db.Date, nullable=False)  # Current UTC day of the daily limit
+    usage_15min = db.Column(db.Integer, default=0, nullable=False)
+    usage_daily = db.Column(db.Integer, default=0, nullable=False)
+    limit_15min = db.Column(db.Integer, nullable=False)
+    limit_daily = db.Column(db.Integer, nullable=False)
+
+class SchemaMigration(db.Model):
+    """Applied versions of migrations.py"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255))
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
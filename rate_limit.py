@@ -0,0 +1,210 @@
+# Strava API rate limit scheduler
+#
+# Strava limits the whole application to a number of requests per 15 minute
+# window (starting at :00, :15, :30 and :45) and per UTC day, and reports the
+# limits and current usage with every response, e.g.
+#   X-RateLimit-Limit: 100,1000
+#   X-RateLimit-Usage: 34,412
+# Every API request takes a token from a budget kept in the strava_rate_limit
+# table, so all gunicorn workers and worker.py processes draw from the same
+# quota, and the headers of each response correct the budget afterwards.
+#
+# Requests have a priority. Interactive work (the incremental sync of a user
+# who is looking at the dashboard) may use the whole quota, background work
+# (backfills) stops STRAVA_RATE_LIMIT_RESERVE short of it so it never starves
+# interactive syncs. When no token is left acquire() raises RateLimitExceeded
+# with the time the budget refills, and sync_queue defers the job until then
+# instead of failing it.
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+from sqlalchemy import case, insert, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from app import app, db
+from models import StravaRateLimit
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+ROW_ID = 1
+limits_table = StravaRateLimit.__table__
+
+class RateLimitExceeded(Exception):
+    """The Strava API budget is used up until retry_at"""
+
+    def __init__(self, retry_at, window):
+        super().__init__(f"Strava {window} rate limit reached, retry after {retry_at:%Y-%m-%d %H:%M} UTC")
+        self.retry_at = retry_at
+        self.window = window
+
+_local = threading.local()
+
+def current_priority():
+    """Return the priority of Strava requests made by this thread"""
+    return getattr(_local, "priority", INTERACTIVE)
+
+@contextmanager
+def request_priority(priority):
+    """Make the Strava requests of this thread inside the block use priority"""
+    previous = current_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+def window_bounds(now):
+    """Return the start of the 15 minute window and the UTC day containing now"""
+    return now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0), now.date()
+
+def _engine():
+    """
+    Return the database engine, also from threads without an app context
+    The budget is updated on its own connection so it never commits the
+    caller's session
+    """
+    with app.app_context():
+        return db.engine
+
+def _create_row(connection, window_start, day):
+    """Insert the budget row with the configured limits unless another process did"""
+    try:
+        with connection.begin_nested():
+            connection.execute(insert(limits_table).values(
+                id=ROW_ID,
+                window_start=window_start,
+                day=day,
+                usage_15min=0,
+                usage_daily=0,
+                limit_15min=app.config["STRAVA_RATE_LIMIT_15MIN"],
+                limit_daily=app.config["STRAVA_RATE_LIMIT_DAILY"]
+            ))
+    except IntegrityError:
+        pass
+
+def _try_acquire(connection, priority, now):
+    """
+    Take a token with a single conditional UPDATE
+    Returns None when a token was taken, otherwise the exhausted budget row
+    """
+    window_start, day = window_bounds(now)
+    share = 1.0 if priority == INTERACTIVE else 1.0 - app.config["STRAVA_RATE_LIMIT_RESERVE"]
+    same_window = limits_table.c.window_start == window_start
+    same_day = limits_table.c.day == day
+
+    result = connection.execute(
+        update(limits_table)
+        .where(
+            limits_table.c.id == ROW_ID,
+            ~same_window | (limits_table.c.usage_15min < limits_table.c.limit_15min * share),
+            ~same_day | (limits_table.c.usage_daily < limits_table.c.limit_daily * share)
+        )
+        .values(
+            usage_15min=case((same_window, limits_table.c.usage_15min + 1), else_=1),
+            usage_daily=case((same_day, limits_table.c.usage_daily + 1), else_=1),
+            window_start=window_start,
+            day=day
+        )
+    )
+    if result.rowcount == 1:
+        return None
+
+    row = connection.execute(select(limits_table).where(limits_table.c.id == ROW_ID)).first()
+    if row is None:
+        _create_row(connection, window_start, day)
+        return _try_acquire(connection, priority, now)
+    return row
+
+def acquire(priority=None):
+    """
+    Take one request from the shared budget before calling the Strava API
+    priority defaults to the one set with request_priority() for this thread
+    Raises RateLimitExceeded when the budget for that priority is used up
+    """
+    if not app.config["STRAVA_RATE_LIMIT_ENABLED"]:
+        return
+
+    priority = priority or current_priority()
+    now = datetime.utcnow()
+    try:
+        with _engine().begin() as connection:
+            row = _try_acquire(connection, priority, now)
+    except SQLAlchemyError as e:
+        # Don't stop syncing because the budget can't be read, Strava's 429s still stop us
+        logger.error(f"Error updating Strava rate limit budget: {str(e)}")
+        return
+
+    if row is None:
+        return
+
+    window_start, day = window_bounds(now)
+    share = 1.0 if priority == INTERACTIVE else 1.0 - app.config["STRAVA_RATE_LIMIT_RESERVE"]
+    if row.day == day and row.usage_daily >= row.limit_daily * share:
+        raise RateLimitExceeded(datetime.combine(day + timedelta(days=1), time.min), "daily")
+    raise RateLimitExceeded(window_start + timedelta(minutes=15), "15 minute")
+
+def parse_rate_limit_header(value):
+    """Parse a "15 minute,daily" header value, returns an (int, int) tuple or None"""
+    try:
+        short_term, daily = (int(part) for part in value.split(","))
+    except (AttributeError, ValueError):
+        return None
+    return short_term, daily
+
+def record_response(response):
+    """
+    Correct the shared budget from the rate limit headers of a Strava response
+    Raises RateLimitExceeded if Strava rejected the request with a 429
+    """
+    if not app.config["STRAVA_RATE_LIMIT_ENABLED"]:
+        return
+
+    limits = parse_rate_limit_header(response.headers.get("X-RateLimit-Limit"))
+    usage = parse_rate_limit_header(response.headers.get("X-RateLimit-Usage"))
+    now = datetime.utcnow()
+    window_start, day = window_bounds(now)
+    same_window = limits_table.c.window_start == window_start
+    same_day = limits_table.c.day == day
+
+    values = {}
+    if limits and usage:
+        # Strava's count includes other apps sharing the client id and our
+        # requests from before a restart, ours includes requests still in flight
+        values = {
+            "limit_15min": limits[0],
+            "limit_daily": limits[1],
+            "usage_15min": case(
+                (same_window & (limits_table.c.usage_15min > usage[0]), limits_table.c.usage_15min),
+                else_=usage[0]
+            ),
+            "usage_daily": case(
+                (same_day & (limits_table.c.usage_daily > usage[1]), limits_table.c.usage_daily),
+                else_=usage[1]
+            ),
+            "window_start": window_start,
+            "day": day
+        }
+    elif response.status_code == 429:
+        # No headers to go by, assume the current window is used up
+        values = {"usage_15min": limits_table.c.limit_15min, "window_start": window_start}
+
+    if values:
+        try:
+            with _engine().begin() as connection:
+                connection.execute(update(limits_table).where(limits_table.c.id == ROW_ID).values(**values))
+        except SQLAlchemyError as e:
+            logger.error(f"Error updating Strava rate limit budget: {str(e)}")
+
+    if response.status_code == 429:
+        if limits and usage and usage[1] >= limits[1]:
+            raise RateLimitExceeded(datetime.combine(day + timedelta(days=1), time.min), "daily")
+        raise RateLimitExceeded(window_start + timedelta(minutes=15), "15 minute")
+
+def get_budget():
+    """Return the shared budget as a dictionary, None if no request was made yet"""
+    with _engine().connect() as connection:
+        row = connection.execute(select(limits_table).where(limits_table.c.id == ROW_ID)).first()
+    return dict(row._mapping) if row else None
@@ -0,0 +1,177 @@
+# Response helpers for the chart APIs
+#
+# Large arrays are serialized in chunks from a generator, so a worker never
+# holds the full JSON text (or a Python list per sample) in memory, and the
+# chunks are compressed on the fly when the client accepts gzip or brotli.
+# Chart data can also be sent as a columnar binary payload of float32 arrays.
+import hashlib
+import json
+import struct
+import zlib
+import numpy as np
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # Optional, gzip is used when it isn't installed
+    brotli = None
+
+CHUNK_SIZE = 4096  # Array elements serialized per chunk
+BINARY_MIMETYPE = "application/octet-stream"
+
+class ChunkedArray:
+    """
+    An array of a known length produced piece by piece by chunks(), a
+    callable yielding NumPy arrays, so it is serialized without ever
+    being held in memory as a whole
+    """
+
+    def __init__(self, length, chunks):
+        self.length = length
+        self.chunks = chunks
+
+    def __len__(self):
+        return self.length
+
+def _array_pieces(values):
+    """Yield an ndarray or ChunkedArray in pieces of at most CHUNK_SIZE elements"""
+    chunks = values.chunks() if isinstance(values, ChunkedArray) else [values]
+    for chunk in chunks:
+        for start in range(0, len(chunk), CHUNK_SIZE):
+            yield chunk[start:start + CHUNK_SIZE]
+
+def iter_json(obj):
+    """
+    Serialize obj as JSON, yielding text fragments
+    NumPy arrays and ChunkedArrays are written CHUNK_SIZE elements at a time
+    """
+    if isinstance(obj, (np.ndarray, ChunkedArray)):
+        yield "["
+        for i, piece in enumerate(_array_pieces(obj)):
+            if i:
+                yield ","
+            yield json.dumps(piece.tolist())[1:-1]
+        yield "]"
+    elif isinstance(obj, dict):
+        yield "{"
+        for i, (key, value) in enumerate(obj.items()):
+            yield ("," if i else "") + json.dumps(str(key)) + ":"
+            yield from iter_json(value)
+        yield "}"
+    elif isinstance(obj, (list, tuple)):
+        yield "["
+        for i, value in enumerate(obj):
+            if i:
+                yield ","
+            yield from iter_json(value)
+        yield "]"
+    elif isinstance(obj, np.generic):
+        yield json.dumps(obj.item())
+    else:
+        yield json.dumps(obj)
+
+def negotiate_encoding():
+    """Pick "br", "gzip" or None from the request's Accept-Encoding header"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+def wants_binary():
+    """Check if the client asked for the columnar binary format"""
+    if request.args.get("format") == "binary":
+        return True
+    return request.accept_mimetypes.best_match(["application/json", BINARY_MIMETYPE]) == BINARY_MIMETYPE
+
+def _compress(chunks, encoding):
+    """Compress a stream of byte chunks with the given content encoding"""
+    if encoding == "br":
+        compressor = brotli.Compressor()
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+def _buffered(fragments, size=16384):
+    """Join small text fragments into byte chunks of roughly size bytes"""
+    buffer = []
+    length = 0
+    for fragment in fragments:
+        buffer.append(fragment)
+        length += len(fragment)
+        if length >= size:
+            yield "".join(buffer).encode()
+            buffer = []
+            length = 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+def _streamed_response(chunks, mimetype, status):
+    """Build a streaming response, compressed if the client supports it"""
+    encoding = negotiate_encoding()
+    if encoding:
+        chunks = _compress(chunks, encoding)
+
+    response = Response(chunks, status=status, mimetype=mimetype)
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+def make_etag(*parts):
+    """Build a strong ETag value from the parts that determine a response"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def set_cache_headers(response, etag):
+    """
+    Mark a per-user response as revalidated through its ETag
+    private keeps shared caches out, no-cache makes browsers send If-None-Match
+    """
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def not_modified(etag):
+    """Return a 304 response if the request's If-None-Match matches etag, else None"""
+    if not request.if_none_match.contains(etag):
+        return None
+
+    response = Response(status=304)
+    response.vary.add("Accept-Encoding")
+    return set_cache_headers(response, etag)
+
+def json_response(obj, status=200):
+    """Stream obj as JSON, compressed according to Accept-Encoding"""
+    return _streamed_response(_buffered(iter_json(obj)), "application/json", status)
+
+def iter_columnar(columns, meta):
+    """
+    Yield the columnar binary encoding of named arrays
+    Layout: uint32 header length, JSON header ({"columns": [{"name", "length"}],
+    "meta": meta}) padded with spaces to a multiple of 4 bytes, then each column
+    as little-endian float32 values in header order
+    """
+    header = json.dumps({
+        "columns": [{"name": name, "length": len(values)} for name, values in columns.items()],
+        "meta": meta
+    }, default=lambda value: value.item() if isinstance(value, np.generic) else str(value)).encode()
+    header += b" " * (-len(header) % 4)
+    yield struct.pack("<I", len(header)) + header
+
+    for values in columns.values():
+        for piece in _array_pieces(values):
+            yield np.asarray(piece, dtype="<f4").tobytes()
+
+def columnar_response(columns, meta=None, status=200):
+    """Stream named arrays in the columnar binary format (see iter_columnar)"""
+    return _streamed_response(iter_columnar(columns, meta or {}), BINARY_MIMETYPE, status)
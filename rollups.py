@@ -0,0 +1,172 @@
+# Daily per-user zone rollups
+#
+# DailyZoneRollup holds the summed zone times of a user's heart rate
+# activities per (date, activity type). Rows are incremented as sync stores
+# new activities and rebuilt from Activity when all zones are recalculated,
+# so dashboard windows read at most one row per day and type.
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Activity, DailyZoneRollup, ZONE_TIME_COLUMNS
+
+def add_activities_to_rollups(activities, sign=1):
+    """
+    Add newly stored activities to their users' daily rollups
+    With sign=-1 they are subtracted instead, see remove_activities_from_rollups
+    Activities without heart rate or zone times are ignored
+    """
+    increments = defaultdict(lambda: dict.fromkeys(["activity_count", *ZONE_TIME_COLUMNS.values()], 0))
+    for activity in activities:
+        if not activity.has_heartrate or activity.total_s is None or activity.start_date is None:
+            continue
+
+        key = (activity.user_id, activity.start_date.date(), activity.type or "")
+        increments[key]["activity_count"] += sign
+        for column in ZONE_TIME_COLUMNS.values():
+            increments[key][column] += sign * (getattr(activity, column) or 0)
+
+    for (user_id, day, activity_type), values in increments.items():
+        _increment_rollup(user_id, day, activity_type, values)
+
+def remove_activities_from_rollups(activities):
+    """Subtract activities that are deleted or about to change date or type from their rollups"""
+    add_activities_to_rollups(activities, sign=-1)
+
+def _increment_rollup(user_id, day, activity_type, values):
+    """Atomically add values to one rollup row, creating it if needed"""
+    key_filter = (
+        DailyZoneRollup.user_id == user_id,
+        DailyZoneRollup.date == day,
+        DailyZoneRollup.activity_type == activity_type
+    )
+    increment = {column: getattr(DailyZoneRollup, column) + value for column, value in values.items()}
+
+    result = db.session.execute(update(DailyZoneRollup).where(*key_filter).values(**increment))
+    if result.rowcount:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(DailyZoneRollup).values(
+                user_id=user_id, date=day, activity_type=activity_type, **values
+            ))
+    except IntegrityError:
+        # Another worker created the row first
+        db.session.execute(update(DailyZoneRollup).where(*key_filter).values(**increment))
+
+def rebuild_user_rollups(user_id):
+    """
+    Recompute all of a user's rollup rows from their activities
+    Runs as a DELETE plus a single INSERT ... SELECT ... GROUP BY
+    """
+    day = func.date(Activity.start_date)
+    activity_type = func.coalesce(Activity.type, "")
+    source = select(
+        Activity.user_id,
+        day,
+        activity_type,
+        func.count(Activity.id),
+        *[func.coalesce(func.sum(getattr(Activity, column)), 0) for column in ZONE_TIME_COLUMNS.values()]
+    ).where(
+        Activity.user_id == user_id,
+        Activity.has_heartrate == True,
+        Activity.total_s.isnot(None),
+        Activity.start_date.isnot(None)
+    ).group_by(Activity.user_id, day, activity_type)
+
+    db.session.execute(delete(DailyZoneRollup).where(DailyZoneRollup.user_id == user_id))
+    db.session.execute(insert(DailyZoneRollup).from_select(
+        ["user_id", "date", "activity_type", "activity_count", *ZONE_TIME_COLUMNS.values()],
+        source
+    ))
+
+def _rollup_filter(user_id, first_day, last_day, activity_type):
+    """Return the filter clauses for a user's rollup rows between two dates"""
+    clauses = [
+        DailyZoneRollup.user_id == user_id,
+        DailyZoneRollup.date >= first_day,
+        DailyZoneRollup.date <= last_day
+    ]
+    if activity_type != 'all':
+        clauses.append(DailyZoneRollup.activity_type == activity_type)
+    return clauses
+
+def get_activity_zone_totals(user_id, start_date, end_date, activity_type='all'):
+    """
+    Sum the time in each zone for a user's activities in SQL
+    Uses the per-zone time columns, so zone_data JSON is never loaded
+    Returns a dictionary of zone to seconds, including the total
+    """
+    query = db.session.query(
+        *[func.coalesce(func.sum(getattr(Activity, column)), 0) for column in ZONE_TIME_COLUMNS.values()]
+    ).filter(
+        Activity.user_id == user_id,
+        Activity.start_date >= start_date,
+        Activity.start_date <= end_date,
+        Activity.has_heartrate == True
+    )
+    
+    # Apply activity type filter if not 'all'
+    if activity_type != 'all':
+        query = query.filter(Activity.type == activity_type)
+    
+    return dict(zip(ZONE_TIME_COLUMNS.keys(), query.one()))
+
+def last_days_window(days):
+    """
+    Return the (start, end) datetimes of the last days whole UTC days, today included
+    The window only moves at midnight, so responses computed from it can be
+    revalidated by an ETag that includes its start
+    """
+    today = datetime.utcnow().date()
+    start = datetime.combine(today - timedelta(days=days - 1), time.min)
+    end = datetime.combine(today + timedelta(days=1), time.min) - timedelta(microseconds=1)
+    return start, end
+
+def get_rollup_zone_totals(user_id, start_date, end_date, activity_type='all'):
+    """
+    Sum the time in each zone between two datetimes
+    Whole days come from the rollup table; only the partial first day of the
+    window is summed from Activity, so results match a scan of the raw rows
+    Returns a dictionary of zone to seconds, including the total
+    """
+    row = db.session.query(
+        *[func.coalesce(func.sum(getattr(DailyZoneRollup, column)), 0) for column in ZONE_TIME_COLUMNS.values()]
+    ).filter(*_rollup_filter(user_id, start_date.date() + timedelta(days=1), end_date.date(), activity_type)).one()
+    totals = dict(zip(ZONE_TIME_COLUMNS.keys(), row))
+
+    first_day_end = datetime.combine(start_date.date() + timedelta(days=1), time.min) - timedelta(microseconds=1)
+    partial = get_activity_zone_totals(user_id, start_date, min(first_day_end, end_date), activity_type)
+    for zone, seconds in partial.items():
+        totals[zone] += seconds
+
+    return totals
+
+def get_zone_trends(user_id, start_date, end_date, activity_type='all', period='week'):
+    """
+    Group zone times into weekly (starting Monday) or monthly buckets
+    Returns a list of {"start": date, "activities": n, "times": {...}} in date order
+    """
+    rows = db.session.query(DailyZoneRollup).filter(
+        *_rollup_filter(user_id, start_date.date(), end_date.date(), activity_type)
+    ).order_by(DailyZoneRollup.date).all()
+
+    buckets = {}
+    for row in rows:
+        if period == 'month':
+            bucket_start = row.date.replace(day=1)
+        else:
+            bucket_start = row.date - timedelta(days=row.date.weekday())
+
+        bucket = buckets.setdefault(bucket_start, {
+            "start": bucket_start,
+            "activities": 0,
+            "times": dict.fromkeys(ZONE_TIME_COLUMNS.keys(), 0)
+        })
+        bucket["activities"] += row.activity_count
+        for zone, column in ZONE_TIME_COLUMNS.items():
+            bucket["times"][zone] += getattr(row, column)
+
+    return list(buckets.values())
@@ -1,32 +1,41 @@
+import json
 import logging
+import time
 from datetime import datetime, timedelta
-from flask import render_template, redirect, url_for, request, flash, jsonify
+from flask import render_template, redirect, url_for, request, flash, jsonify, abort
 from flask_login import login_required, current_user
-from sqlalchemy import desc, func
+from sqlalchemy import desc, func, update
+from sqlalchemy.orm import undefer, undefer_group
 from app import app, db
-from models import User, Activity, HeartRateZones
-from strava_client import sync_activities, get_activity_details
+from models import User, Activity, HeartRateZones, NumpyEncoder, hr_arrays_from_columns, zone_time_columns
+from sync_queue import request_sync, get_latest_job, ACTIVE_STATUSES
+from downsampling import MIN_POINTS, lttb_downsample
+from responses import ChunkedArray, json_response, columnar_response, wants_binary, negotiate_encoding, make_etag, not_modified, set_cache_headers
+from stream_cache import stream_cache
+from instrumentation import require_metrics_token
+from cache import cached, invalidate_user
+from hydration import hydrate_activity, needs_hydration
+from rate_limit import RateLimitExceeded
+from rollups import get_rollup_zone_totals, get_zone_trends, last_days_window, rebuild_user_rollups
 from zone_calculator import get_zone_colors, get_zone_labels, format_zone_times, calculate_max_hr
 
-@app.route('/')
+logger = logging.getLogger(__name__)
+
 def index():
     """Homepage route"""
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
     return render_template('index.html')
 
-@app.route('/dashboard')
 @login_required
 def dashboard():
     """Main dashboard showing activity summaries and zone data"""
-    # Sync latest activities
+    # Queue a background sync, the page renders from already stored activities
     try:
-        new_activities = sync_activities(current_user)
-        if new_activities > 0:
-            flash(f"Synced {new_activities} new activities from Strava", "success")
+        sync_job = request_sync(current_user.id)
     except Exception as e:
-        logging.error(f"Error syncing activities: {str(e)}")
-        flash("Failed to sync activities from Strava", "danger")
+        logger.error(f"Error queueing activity sync: {str(e)}")
+        sync_job = None
     
     # Get date filters or use defaults
     days = request.args.get('days', 30, type=int)
@@ -37,8 +46,7 @@ def dashboard():
     activity_type = request.args.get('type', 'all')
     
     # Calculate date range
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=days)
+    start_date, end_date = last_days_window(days)
     
     # Base query for activities within date range
     query = Activity.query.filter(
@@ -56,35 +64,16 @@ def dashboard():
     activities = query.order_by(desc(Activity.start_date)).all()
     
     # Get all unique activity types for the filter dropdown
-    all_activity_types = db.session.query(Activity.type).filter(
-        Activity.user_id == current_user.id,
-        Activity.has_heartrate == True
-    ).distinct().all()
-    activity_types = [t[0] for t in all_activity_types]
+    activity_types = cached(current_user.id, 'activity_types', (), lambda: get_activity_types(current_user.id))
     
     # If no activity types are found, use some defaults for testing
     if not activity_types:
         activity_types = ["Run", "Ride", "Workout"]
     
-    print(f"Activity types found: {activity_types}")
+    logger.debug("Dashboard activity types", extra={"user_id": current_user.id, "activity_types": activity_types})
     
     # Calculate total time in each zone across all activities
-    zone_totals = {
-        "zone1": 0,
-        "zone2": 0,
-        "zone3": 0,
-        "zone4": 0,
-        "zone5": 0,
-        "below": 0,
-        "total": 0
-    }
-    
-    for activity in activities:
-        zone_data = activity.get_zone_data()
-        if zone_data and "times" in zone_data:
-            for zone, time in zone_data["times"].items():
-                if zone in zone_totals:
-                    zone_totals[zone] += time
+    zone_totals = get_cached_zone_totals(current_user.id, start_date, end_date, activity_type)
     
     # Calculate percentages
     zone_percentages = {}
@@ -113,17 +102,23 @@ def dashboard():
         user_zones=user_zones,
         days=days,
         activity_type=activity_type,
-        activity_types=activity_types
+        activity_types=activity_types,
+        sync_in_progress=sync_job is not None and sync_job.status in ACTIVE_STATUSES
     )
 
-@app.route('/activity/<int:activity_id>')
 @login_required
 def activity_detail(activity_id):
     """Show detailed information about a specific activity"""
-    activity = Activity.query.filter_by(id=activity_id, user_id=current_user.id).first_or_404()
+    activity = Activity.query.options(
+        undefer(Activity.zone_data),
+        undefer(Activity.has_stored_stream)
+    ).filter_by(id=activity_id, user_id=current_user.id).first_or_404()
     
-    # Get heart rate data and zone information
-    hr_data = activity.get_hr_data()
+    # Fetch the detail stream first, its zone times replace the coarse ones
+    if needs_hydration(activity):
+        hydrate_for_view(activity)
+    
+    # Get zone information, the stream itself is loaded by the chart API
     zone_data = activity.get_zone_data()
     
     # Format zone times
@@ -139,7 +134,7 @@ def activity_detail(activity_id):
     return render_template(
         'activity_detail.html',
         activity=activity,
-        hr_data=hr_data,
+        has_hr_data=activity.has_hr_stream(),
         zone_data=zone_data,
         formatted_times=formatted_times,
         zone_colors=zone_colors,
@@ -147,7 +142,6 @@ def activity_detail(activity_id):
         user_zones=user_zones
     )
 
-@app.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
     """User profile and heart rate zone settings"""
@@ -173,18 +167,18 @@ def profile():
             if max_hr < 100 or max_hr > 230:
                 flash('Maximum heart rate must be between 100 and 230 bpm', 'danger')
             else:
+                # The new version invalidates cached chart ETags, so it is
+                # committed together with the recalculated zone data: a chart
+                # request during the recalculation still sees the old version
                 user_zones.max_hr = max_hr
-                db.session.commit()
+                user_zones.version = (user_zones.version or 1) + 1
                 
-                # Debug information
-                print(f"Setting max_hr to {max_hr}")
-                zones = user_zones.calculate_zones()
-                print(f"Calculated zones: {zones}")
+                # Recalculate zones for all activities, this commits both
+                recalculate_all_activity_zones(current_user.id)
                 
-                flash('Heart rate zone settings updated successfully!', 'success')
+                logger.info("Max heart rate updated", extra={"user_id": current_user.id, "max_hr": max_hr})
                 
-                # Recalculate zones for all activities
-                recalculate_all_activity_zones(current_user.id)
+                flash('Heart rate zone settings updated successfully!', 'success')
                 
                 return redirect(url_for('profile'))
         
@@ -203,15 +197,7 @@ def profile():
     
     # Calculate actual zone values
     zones = user_zones.calculate_zones()
-    print(f"Profile page - User max HR: {user_zones.max_hr}")
-    print(f"Profile page - Calculated zones: {zones}")
-    
-    # Explicitly ensure zone5 max is displayed correctly - not as a plus sign
-    if zones and 'zone5' in zones:
-        print(f"Zone 5 min: {zones['zone5']['min']}, max: {zones['zone5']['max']}")
-        # Ensure it's displayed as an actual range, not a plus
-        if zones['zone5']['max'] == user_zones.max_hr:
-            print(f"Zone 5 is set correctly to max: {zones['zone5']['max']}")
+    logger.debug("Profile zones", extra={"user_id": current_user.id, "max_hr": user_zones.max_hr, "zones": zones})
     
     # Get zone colors from zone_calculator
     zone_colors = get_zone_colors()
@@ -227,39 +213,140 @@ def profile():
         estimated_max_hr=estimated_max_hr
     )
 
-@app.route('/api/activities/<int:activity_id>/hr_data')
+def get_activity_types(user_id):
+    """Return the distinct types of a user's heart rate activities"""
+    all_activity_types = db.session.query(Activity.type).filter(
+        Activity.user_id == user_id,
+        Activity.has_heartrate == True
+    ).distinct().all()
+    return [t[0] for t in all_activity_types]
+
+def get_cached_zone_totals(user_id, start_date, end_date, activity_type):
+    """
+    Return the zone totals of a window, through the dashboard cache
+    The key also holds the activity and zone versions, so workers whose
+    cache missed an invalidation can't keep serving stale totals under a
+    new ETag
+    Returns a new dictionary of zone to seconds, including the total
+    """
+    def compute():
+        return get_rollup_zone_totals(user_id, start_date, end_date, activity_type)
+    
+    versions = (get_zones_version(user_id), *get_activities_version(user_id))
+    return cached(user_id, 'zone_totals', (start_date.date(), end_date.date(), activity_type, *versions), compute)
+
+def hydrate_for_view(activity):
+    """
+    Fetch an activity's detail stream for a page or chart request
+    Falls back to the stored coarse stream if Strava can't be reached
+    """
+    try:
+        hydrate_activity(activity)
+    except RateLimitExceeded as e:
+        logger.warning(f"Showing the coarse stream of activity {activity.id}: {str(e)}")
+
+def get_zones_version(user_id):
+    """Return the version of a user's zone settings, 0 if they have none yet"""
+    version = db.session.query(HeartRateZones.version).filter_by(user_id=user_id).scalar()
+    return version or 0
+
+def get_activities_version(user_id):
+    """
+    Return a cheap fingerprint of a user's stored activities
+    Changes whenever a sync or backfill adds activities, including ones
+    older than the sync watermark, and when a webhook edits or deletes one
+    """
+    changed_at = db.session.query(User.activities_changed_at).filter(User.id == user_id).scalar_subquery()
+    return db.session.query(func.count(Activity.id), func.max(Activity.id), changed_at).filter(
+        Activity.user_id == user_id
+    ).one()
+
+def dashboard_etag(name, *params):
+    """
+    Build the ETag of a dashboard API response for the current user
+    params must include the start of the response's window (see
+    last_days_window), which moves daily
+    """
+    return make_etag(
+        name,
+        current_user.id,
+        current_user.sync_watermark,
+        get_zones_version(current_user.id),
+        tuple(get_activities_version(current_user.id)),
+        *params
+    )
+
+def array_bounds(values):
+    """Return the first and last element of a NumPy array or ChunkedArray"""
+    if not isinstance(values, ChunkedArray):
+        return values[0].item(), values[-1].item()
+    
+    first = None
+    for chunk in values.chunks():
+        if len(chunk):
+            if first is None:
+                first = chunk[0].item()
+            last = chunk[-1].item()
+    return first, last
+
 @login_required
 def get_activity_hr_data(activity_id):
-    """API endpoint to get heart rate data for charts"""
-    activity = Activity.query.filter_by(id=activity_id, user_id=current_user.id).first_or_404()
-    
-    hr_data = activity.get_hr_data()
-    if not hr_data:
+    """
+    API endpoint to get heart rate data for charts
+    The stream is downsampled with LTTB to at most max_points samples
+    (default HR_CHART_MAX_POINTS, 0 returns every sample)
+    """
+    max_points = request.args.get('max_points', app.config['HR_CHART_MAX_POINTS'], type=int)
+    if max_points and max_points < MIN_POINTS:
+        abort(400)
+    
+    # Streams only change when a coarse one is hydrated, so the response only
+    # depends on the activity, its stream resolution, the zone settings and
+    # the requested representation
+    owned = db.session.query(Activity.id, Activity.has_heartrate, Activity.stream_resolution).filter_by(
+        id=activity_id, user_id=current_user.id
+    ).first()
+    if not owned:
+        abort(404)
+    stream_resolution = owned.stream_resolution
+    if needs_hydration(owned):
+        activity = db.session.get(Activity, activity_id)
+        hydrate_for_view(activity)
+        stream_resolution = activity.stream_resolution
+    etag = make_etag('hr_data', activity_id, stream_resolution, get_zones_version(current_user.id),
+                     max_points, wants_binary(), negotiate_encoding())
+    response_304 = not_modified(etag)
+    if response_304:
+        return response_304
+    
+    activity = Activity.query.options(
+        undefer_group("stream"),
+        undefer(Activity.zone_data)
+    ).filter_by(id=activity_id, user_id=current_user.id).first_or_404()
+    
+    # The stream is decoded in chunks, so memory use doesn't grow with its length
+    total_points, chunks = activity.get_hr_chunks()
+    if total_points == 0:
         return jsonify({'error': 'No heart rate data available'}), 404
     
-    # Convert to format needed for Chart.js
-    chart_data = {
-        'labels': [point[0] for point in hr_data],  # Time values in seconds
-        'datasets': [{
-            'label': 'Heart Rate',
-            'data': [point[1] for point in hr_data],  # HR values
-            'borderColor': '#FF6384',
-            'backgroundColor': 'rgba(255, 99, 132, 0.2)',
-            'fill': True,
-            'tension': 0.1
-        }]
-    }
+    if max_points and max_points < total_points:
+        times, hr_values = lttb_downsample(total_points, chunks, max_points)
+    else:
+        times = ChunkedArray(total_points, lambda: (chunk_times for chunk_times, _ in chunks()))
+        hr_values = ChunkedArray(total_points, lambda: (chunk_hr for _, chunk_hr in chunks()))
     
-    # Add zone lines if available
+    # Zone lines as two-point segments spanning the activity
+    zone_lines = []
     zone_data = activity.get_zone_data()
     if zone_data and 'zone_ranges' in zone_data:
         zones = zone_data['zone_ranges']
         zone_colors = get_zone_colors()
+        start, end = array_bounds(times)
         
         for zone, data in zones.items():
-            chart_data['datasets'].append({
+            zone_lines.append({
                 'label': f'{zone.capitalize()} Max',
-                'data': [data['max']] * len(hr_data),
+                'data': [{'x': start, 'y': data['max']}, {'x': end, 'y': data['max']}],
                 'borderColor': zone_colors[zone],
                 'borderDash': [5, 5],
                 'borderWidth': 1,
@@ -267,9 +354,29 @@ def get_activity_hr_data(activity_id):
                 'fill': False
             })
     
-    return jsonify(chart_data)
+    # Columnar float32 arrays for clients that decode them into typed arrays
+    if wants_binary():
+        return set_cache_headers(columnar_response(
+            {'time': times, 'heartrate': hr_values},
+            meta={'total_points': total_points, 'zone_lines': zone_lines}
+        ), etag)
+    
+    # Convert to format needed for Chart.js, arrays are streamed in chunks
+    chart_data = {
+        'labels': times,  # Time values in seconds
+        'datasets': [{
+            'label': 'Heart Rate',
+            'data': hr_values,  # HR values
+            'borderColor': '#FF6384',
+            'backgroundColor': 'rgba(255, 99, 132, 0.2)',
+            'fill': True,
+            'tension': 0.1
+        }] + zone_lines,
+        'total_points': total_points
+    }
+    
+    return set_cache_headers(json_response(chart_data), etag)
 
-@app.route('/api/dashboard/zone_summary')
 @login_required
 def zone_summary_data():
     """API endpoint to get zone summary data for dashboard charts"""
@@ -281,41 +388,15 @@ def zone_summary_data():
     # Get activity type filter
     activity_type = request.args.get('type', 'all')
     
-    # Calculate date range
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=days)
-    
-    # Base query for activities within date range
-    query = Activity.query.filter(
-        Activity.user_id == current_user.id,
-        Activity.start_date >= start_date,
-        Activity.start_date <= end_date,
-        Activity.has_heartrate == True
-    )
-    
-    # Apply activity type filter if not 'all'
-    if activity_type != 'all':
-        query = query.filter(Activity.type == activity_type)
-    
-    # Get the activities
-    activities = query.all()
+    start_date, end_date = last_days_window(days)
+    etag = dashboard_etag('zone_summary', start_date, activity_type, negotiate_encoding())
+    response_304 = not_modified(etag)
+    if response_304:
+        return response_304
     
     # Calculate total time in each zone across all activities
-    zone_totals = {
-        "zone1": 0,
-        "zone2": 0,
-        "zone3": 0,
-        "zone4": 0,
-        "zone5": 0,
-        "below": 0
-    }
-    
-    for activity in activities:
-        zone_data = activity.get_zone_data()
-        if zone_data and "times" in zone_data:
-            for zone, time in zone_data["times"].items():
-                if zone in zone_totals:
-                    zone_totals[zone] += time
+    zone_totals = get_cached_zone_totals(current_user.id, start_date, end_date, activity_type)
+    del zone_totals["total"]
     
     # Prepare data for Chart.js
     zone_labels = get_zone_labels()
@@ -330,33 +411,145 @@ def zone_summary_data():
         }]
     }
     
-    return jsonify(chart_data)
+    return set_cache_headers(json_response(chart_data), etag)
+
+@login_required
+def zone_trends_data():
+    """API endpoint with weekly or monthly zone time totals for trend charts"""
+    days = request.args.get('days', 365, type=int)
+    if days not in [7, 30, 90, 365]:
+        days = 365
+    
+    period = request.args.get('period', 'week')
+    if period not in ['week', 'month']:
+        period = 'week'
+    
+    activity_type = request.args.get('type', 'all')
+    
+    start_date, end_date = last_days_window(days)
+    etag = dashboard_etag('zone_trends', start_date, period, activity_type, negotiate_encoding())
+    response_304 = not_modified(etag)
+    if response_304:
+        return response_304
+    
+    buckets = get_zone_trends(current_user.id, start_date, end_date, activity_type, period)
+    
+    # Prepare stacked bar data for Chart.js, zone times in minutes
+    zone_labels = get_zone_labels()
+    zone_colors = get_zone_colors()
+    zones = ["zone1", "zone2", "zone3", "zone4", "zone5", "below"]
+    
+    return set_cache_headers(json_response({
+        'labels': [bucket['start'].isoformat() for bucket in buckets],
+        'activities': [bucket['activities'] for bucket in buckets],
+        'datasets': [{
+            'label': zone_labels[zone],
+            'data': [bucket['times'][zone] / 60 for bucket in buckets],
+            'backgroundColor': zone_colors[zone]
+        } for zone in zones]
+    }), etag)
+
+@login_required
+def sync_status():
+    """API endpoint reporting the state of the user's background Strava sync"""
+    job = get_latest_job(current_user.id)
+    if not job:
+        return jsonify({'status': 'idle', 'in_progress': False})
+    
+    return jsonify({
+        'status': job.status,
+        'in_progress': job.status in ACTIVE_STATUSES,
+        'new_activities': job.new_activities,
+        'finished_at': job.finished_at.isoformat() + 'Z' if job.finished_at else None,
+        # Set while the job waits for the Strava rate limit to reset
+        'deferred_until': job.run_after.isoformat() + 'Z' if job.status == 'queued' and job.run_after else None
+    })
+
+def strava_webhook():
+    """
+    Strava push subscription callback
+    GET answers the subscription handshake, POST queues an activity or
+    athlete event for the sync workers (see webhooks.py)
+    """
+    from webhooks import record_event, verify_subscription
+    
+    if request.method == 'GET':
+        challenge = verify_subscription(
+            request.args.get('hub.mode'),
+            request.args.get('hub.verify_token'),
+            request.args.get('hub.challenge')
+        )
+        if challenge is None:
+            abort(403)
+        return jsonify({'hub.challenge': challenge})
+    
+    try:
+        event = record_event(request.get_json(silent=True))
+    except ValueError as e:
+        logger.warning(f"Rejected Strava webhook event: {str(e)}")
+        abort(400)
+    
+    # Strava only needs a 200 within two seconds, duplicates are acknowledged too
+    return jsonify({'queued': event is not None})
+
+def cache_stats():
+    """
+    API endpoint with the stream cache counters of this worker process
+    Protected by METRICS_TOKEN like /metrics
+    """
+    require_metrics_token()
+    return jsonify(stream_cache.stats())
 
 def recalculate_all_activity_zones(user_id):
     """
     Recalculate zone data for all activities of a user
-    This is called when zone settings are updated
+    This is called when zone settings are updated, the pending settings
+    change is committed in the same transaction as the new zone data
     """
-    from zone_calculator import calculate_activity_zones
+    from zone_calculator import calculate_activity_zones_batch, get_or_create_user_zones
     
-    print(f"Recalculating zones for user_id: {user_id}")
+    started = time.perf_counter()
     
-    activities = Activity.query.filter_by(user_id=user_id, has_heartrate=True).all()
-    print(f"Found {len(activities)} activities with heart rate data")
+    # Only load the id and stream columns, no need for full Activity objects
+    rows = db.session.query(Activity.id, Activity.hr_stream, Activity.hr_data).filter(
+        Activity.user_id == user_id,
+        Activity.has_heartrate == True,
+        (Activity.hr_stream.isnot(None)) | (Activity.hr_data.isnot(None))
+    ).all()
     
     user = User.query.get(user_id)
-    user_zones = HeartRateZones.query.filter_by(user_id=user_id).first()
-    print(f"User max HR: {user_zones.max_hr}")
-    print(f"User zones: {user_zones.calculate_zones()}")
-    
-    for activity in activities:
-        hr_data = activity.get_hr_data()
-        if hr_data:
-            print(f"Recalculating zones for activity {activity.id} - {activity.name}")
-            zones = calculate_activity_zones(user, hr_data)
-            if zones:
-                activity.set_zone_data(zones)
-                print(f"New zone data: {zones}")
+    user_zones = get_or_create_user_zones(user)
+    zones = user_zones.calculate_zones()
+    
+    activity_ids = []
+    streams = []
+    for activity_id, hr_stream, hr_data in rows:
+        times, hr_values = hr_arrays_from_columns(hr_stream, hr_data)
+        if len(times):
+            activity_ids.append(activity_id)
+            streams.append((times, hr_values))
+    
+    # Bin every stream in one pass, then write all results with a single bulk UPDATE
+    results = calculate_activity_zones_batch(zones, streams)
+    updates = [
+        {"id": activity_id, "zone_data": json.dumps(zone_data, cls=NumpyEncoder), **zone_time_columns(zone_data)}
+        for activity_id, zone_data in zip(activity_ids, results)
+        if zone_data
+    ]
+    if updates:
+        db.session.execute(update(Activity), updates)
+    
+    # Zone times changed for every activity, so rebuild the daily rollups
+    rebuild_user_rollups(user_id)
     
     db.session.commit()
-    print("Zone recalculation complete!")
+    invalidate_user(user_id)
+    
+    # One summary line instead of per-activity output
+    logger.info("Zone recalculation complete", extra={
+        "user_id": user_id,
+        "max_hr": user_zones.max_hr,
+        "activities": len(rows),
+        "updated": len(updates),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+    })
@@ -0,0 +1,57 @@
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# DDL helpers for migrations.py. Each one checks the database first, so a
+# migration that was interrupted (or runs against a database created from the
+# current models) can simply be run again.
+
+def add_column(table_name, column_name):
+    """
+    Add a model column to an existing table if the database doesn't have it
+    The column is added as nullable without a default, which is a metadata
+    only change on PostgreSQL and doesn't rewrite large tables
+    Returns True if the column was added
+    """
+    engine = db.engine
+    table = db.metadata.tables[table_name]
+    column = table.columns[column_name]
+    existing = {c["name"] for c in inspect(engine).get_columns(table_name)}
+    if column_name in existing:
+        return False
+
+    preparer = engine.dialect.identifier_preparer
+    column_type = column.type.compile(dialect=engine.dialect)
+    logger.info(f"Adding column {table_name}.{column_name} ({column_type})")
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"ALTER TABLE {preparer.format_table(table)} "
+            f"ADD COLUMN {preparer.format_column(column)} {column_type}"
+        ))
+    return True
+
+def create_index(table_name, index_name, concurrently=True):
+    """
+    Create a model index if the database doesn't have it
+    On PostgreSQL it is built with CREATE INDEX CONCURRENTLY, which doesn't
+    block writes but has to run outside a transaction
+    Returns True if the index was created
+    """
+    engine = db.engine
+    table = db.metadata.tables[table_name]
+    index = next(index for index in table.indexes if index.name == index_name)
+    existing = {i["name"] for i in inspect(engine).get_indexes(table_name)}
+    if index_name in existing:
+        return False
+
+    statement = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+    if concurrently and engine.dialect.name == "postgresql":
+        statement = statement.replace("INDEX", "INDEX CONCURRENTLY", 1)
+
+    logger.info(f"Creating index {index_name} on {table_name}")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(statement))
+    return True
@@ -0,0 +1,72 @@
+# Startup benchmark
+#
+# Imports main in fresh interpreters with python -X importtime and reports
+# the median import time and the slowest modules. Exits with status 1 when
+# the median is over the budget or a module that should load lazily was
+# imported at startup, so it can run as a check before deploying:
+#   python startup_benchmark.py [--runs 5] [--budget-ms 800] [--top 15]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules that must not be imported by "import main", see urls.py and models.py
+LAZY_MODULES = ["numpy", "routes", "sync_queue", "strava_client", "zone_calculator"]
+
+def parse_importtime(output):
+    """Return {module: (self_us, cumulative_us)} from -X importtime output"""
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        times[module.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+def measure_once():
+    """Import main in a new interpreter, returns the parsed import times"""
+    env = dict(os.environ)
+    # Importing the app must not need a database or secrets
+    env.setdefault("DATABASE_URL", "sqlite://")
+    env.setdefault("SESSION_SECRET", "startup-benchmark")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return parse_importtime(result.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of main")
+    parser.add_argument("--runs", type=int, default=5, help="Number of interpreter starts to measure")
+    parser.add_argument("--budget-ms", type=float, default=float(os.environ.get("STARTUP_BUDGET_MS", 800)),
+                        help="Maximum median import time of main (default 800, or STARTUP_BUDGET_MS)")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest modules to list")
+    args = parser.parse_args()
+
+    runs = [measure_once() for _ in range(args.runs)]
+    totals = [run["main"][1] / 1000 for run in runs]
+    median_ms = statistics.median(totals)
+
+    print(f"import main: median {median_ms:.0f} ms over {args.runs} runs (min {min(totals):.0f}, max {max(totals):.0f})")
+    print("Slowest modules by self time (last run):")
+    for module, (self_us, cumulative_us) in sorted(runs[-1].items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f"  {self_us / 1000:8.1f} ms  {cumulative_us / 1000:8.1f} ms cumulative  {module}")
+
+    failures = []
+    eager = [module for module in LAZY_MODULES if module in runs[-1]]
+    if eager:
+        failures.append(f"imported at startup but should load lazily: {', '.join(eager)}")
+    if median_ms > args.budget_ms:
+        failures.append(f"median {median_ms:.0f} ms is over the {args.budget_ms:.0f} ms budget")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
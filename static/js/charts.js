@@ -25,6 +25,35 @@ if (Chart) {
     Chart.defaults.plugins.datalabels.display = false;
 }
 
+/**
+ * Fetches a columnar binary chart payload and decodes it into typed arrays
+ * Payload layout: uint32 header length, JSON header, then float32 columns
+ * @param {string} url - API URL, requested with Accept: application/octet-stream
+ * @returns {Promise<{meta: Object, columns: Object<string, Float32Array>}>}
+ */
+function fetchColumnarData(url) {
+    return fetch(url, { headers: { 'Accept': 'application/octet-stream' } })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Request failed with status ${response.status}`);
+            }
+            return response.arrayBuffer();
+        })
+        .then(buffer => {
+            const headerLength = new DataView(buffer).getUint32(0, true);
+            const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+            
+            const columns = {};
+            let offset = 4 + headerLength;
+            for (const column of header.columns) {
+                columns[column.name] = new Float32Array(buffer, offset, column.length);
+                offset += column.length * Float32Array.BYTES_PER_ELEMENT;
+            }
+            
+            return { meta: header.meta, columns: columns };
+        });
+}
+
 /**
  * Creates a heart rate zone chart
  * @param {string} elementId - Canvas element ID
@@ -1,32 +1,51 @@
+import calendar
 import requests
 import logging
-from datetime import datetime
-import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from app import app
 from auth import refresh_strava_token
+from cache import invalidate_user
+from hydration import sync_stream_resolution
+from strava_http import get_session
+from instrumentation import timed
 from models import Activity, db
-from zone_calculator import calculate_activity_zones
+from rate_limit import RateLimitExceeded, current_priority, request_priority
+from rollups import add_activities_to_rollups
+from zone_calculator import calculate_activity_zones, get_or_create_user_zones
 
-def get_athlete_activities(user, page=1, per_page=30):
+logger = logging.getLogger(__name__)
+
+@timed("strava")
+def get_athlete_activities(user, page=1, per_page=30, after=None):
     """
     Fetch activities from the Strava API for the given user
+    If after is a datetime only activities that started after it are returned
     Returns a list of activities
     """
     # Refresh token if needed
     if not refresh_strava_token(user):
-        logging.error(f"Failed to refresh token for user {user.id}")
+        logger.error(f"Failed to refresh token for user {user.id}")
         return None
     
+    params = {"page": page, "per_page": per_page}
+    if after is not None:
+        params["after"] = int(calendar.timegm(after.timetuple()))
+    
     try:
         headers = {"Authorization": f"Bearer {user.access_token}"}
-        response = requests.get(
-            "https://www.strava.com/api/v3/athlete/activities",
+        response = get_session().get(
+            "/api/v3/athlete/activities",
             headers=headers,
-            params={"page": page, "per_page": per_page}
+            params=params
         )
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching activities: {str(e)}")
+        logger.error(f"Error fetching activities: {str(e)}")
         return None
 
 def get_activity_details(user, activity_id):
@@ -36,102 +55,322 @@ def get_activity_details(user, activity_id):
     """
     # Refresh token if needed
     if not refresh_strava_token(user):
-        logging.error(f"Failed to refresh token for user {user.id}")
+        logger.error(f"Failed to refresh token for user {user.id}")
+        return None, None
+    
+    return fetch_activity_details(user.access_token, activity_id)
+
+@timed("strava")
+def fetch_activity(access_token, activity_id):
+    """
+    Fetch an activity's details with an already valid token
+    Raises requests exceptions for failed requests other than a 404
+    Returns the activity data, None if Strava doesn't show the activity to
+    this athlete (deleted, or another athlete's private activity)
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = get_session().get(
+        f"/api/v3/activities/{activity_id}",
+        headers=headers,
+        params={"include_all_efforts": False}
+    )
+    if response.status_code == 404:
         return None
+    response.raise_for_status()
+    return response.json()
+
+def stream_params(resolution=None):
+    """
+    Return the query parameters of a heart rate stream request
+    resolution is "low", "medium" or "high" (about 100, 1000 and 10000
+    samples, downsampled along STRAVA_STREAM_SERIES_TYPE) or "full" for
+    every recorded sample, default the resolution sync stores
+    """
+    resolution = resolution or sync_stream_resolution()
+    params = {"keys": "heartrate,time", "key_by_type": True}
+    if resolution != "full":
+        params["resolution"] = resolution
+        params["series_type"] = app.config["STRAVA_STREAM_SERIES_TYPE"]
+    return params
+
+@timed("strava")
+def fetch_hr_stream(access_token, activity_id, resolution=None):
+    """
+    Fetch an activity's heart rate stream at the given resolution
+    Raises requests exceptions for failed requests
+    Returns a list of (time, heart rate) pairs, None if the activity has none
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    stream_response = get_session().get(
+        f"/api/v3/activities/{activity_id}/streams",
+        headers=headers,
+        params=stream_params(resolution)
+    )
+    stream_response.raise_for_status()
+    streams = stream_response.json()
     
+    # Extract heart rate and time streams
+    hr_stream = streams.get('heartrate', {}).get('data', [])
+    time_stream = streams.get('time', {}).get('data', [])
+    
+    # Create a combined stream with time and heart rate
+    if hr_stream and time_stream and len(hr_stream) == len(time_stream):
+        return [(time_stream[i], hr_stream[i]) for i in range(len(hr_stream))]
+    return None
+
+def fetch_activity_details(access_token, activity_id, summary=None):
+    """
+    Fetch an activity and its heart rate stream with an already valid token
+    With the activity's summary from the activity list the detail request
+    is skipped (STRAVA_SKIP_DETAILS), the summary has every field we store
+    Only makes HTTP requests, so it is safe to call from worker threads
+    Returns an (activity_data, combined_stream) tuple
+    """
     try:
-        # First, get the activity details
-        headers = {"Authorization": f"Bearer {user.access_token}"}
-        response = requests.get(
-            f"https://www.strava.com/api/v3/activities/{activity_id}",
-            headers=headers,
-            params={"include_all_efforts": False}
-        )
-        response.raise_for_status()
-        activity_data = response.json()
+        if summary is not None and 'has_heartrate' in summary and app.config["STRAVA_SKIP_DETAILS"]:
+            activity_data = summary
+        else:
+            activity_data = fetch_activity(access_token, activity_id)
+            if activity_data is None:
+                logger.warning(f"Activity {activity_id} not found on Strava")
+                return None, None
         
         # Check if activity has heart rate data
         if not activity_data.get('has_heartrate'):
-            logging.info(f"Activity {activity_id} does not have heart rate data")
+            logger.debug("Activity has no heart rate data", extra={"activity_id": activity_id, "sampled": True})
             return activity_data, None
         
-        # Then get the heart rate stream
-        stream_response = requests.get(
-            f"https://www.strava.com/api/v3/activities/{activity_id}/streams",
-            headers=headers,
-            params={"keys": "heartrate,time", "key_by_type": True}
-        )
-        stream_response.raise_for_status()
-        streams = stream_response.json()
-        
-        # Extract heart rate and time streams
-        hr_stream = streams.get('heartrate', {}).get('data', [])
-        time_stream = streams.get('time', {}).get('data', [])
-        
-        # Create a combined stream with time and heart rate
-        combined_stream = None
-        if hr_stream and time_stream and len(hr_stream) == len(time_stream):
-            combined_stream = [(time_stream[i], hr_stream[i]) for i in range(len(hr_stream))]
-        
-        return activity_data, combined_stream
+        return activity_data, fetch_hr_stream(access_token, activity_id)
     
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching activity details: {str(e)}")
+        logger.error(f"Error fetching activity details: {str(e)}")
         return None, None
 
-def sync_activities(user, max_activities=30):
+def fetch_activity_details_concurrently(access_token, activities, max_workers):
+    """
+    Fetch details and streams for several activity summaries on a bounded thread pool
+    Yields (activity_data, combined_stream) tuples in the order of activities
+    as soon as each one is available, so the caller can store results while
+    later activities are still being fetched
+    """
+    if not activities:
+        return
+    
+    # The pool threads make their requests with the caller's rate limit priority
+    priority = current_priority()
+    
+    def fetch(summary):
+        with request_priority(priority):
+            return fetch_activity_details(access_token, summary['id'], summary)
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(activities)))) as executor:
+        yield from executor.map(fetch, activities)
+
+def parse_strava_date(value):
+    """Parse a Strava UTC timestamp such as 2025-04-18T10:11:24Z"""
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+
+def get_sync_watermark(user):
+    """
+    Return the start date after which Strava is asked for new activities
+    Users synced before the watermark existed fall back to their newest
+    stored activity, brand new users to STRAVA_INITIAL_SYNC_DAYS ago
+    """
+    if user.sync_watermark:
+        return user.sync_watermark
+    
+    newest = db.session.query(func.max(Activity.start_date)).filter(Activity.user_id == user.id).scalar()
+    if newest:
+        return newest
+    
+    return datetime.utcnow() - timedelta(days=app.config["STRAVA_INITIAL_SYNC_DAYS"])
+
+def sync_activities(user, backfill_days=None, concurrency=None):
     """
     Fetch and store the user's activities from Strava
+    Only activities after the user's sync watermark are requested, paging
+    until Strava has no more. With backfill_days the watermark is ignored and
+    everything from that many days ago onwards is fetched instead.
+    Detail and stream requests run concurrently (STRAVA_FETCH_CONCURRENCY),
+    all database writes stay on the calling thread
     Returns the number of new activities synced
+    Raises RateLimitExceeded when the Strava quota runs out, activities
+    stored up to then are kept
     """
-    activities = get_athlete_activities(user, per_page=max_activities)
-    if not activities:
-        return 0
+    started = time.perf_counter()
+    if backfill_days:
+        after = datetime.utcnow() - timedelta(days=backfill_days)
+    else:
+        after = get_sync_watermark(user)
     
+    per_page = app.config["STRAVA_PAGE_SIZE"]
     new_count = 0
-    for strava_activity in activities:
-        # Check if activity already exists
-        existing = Activity.query.filter_by(strava_id=strava_activity['id']).first()
-        if existing:
-            continue
-        
-        # Get full activity details with heart rate data if available
-        activity_detail, hr_stream = get_activity_details(user, strava_activity['id'])
-        if not activity_detail:
-            continue
-        
-        # Create new activity record
-        activity = Activity(
-            strava_id=strava_activity['id'],
-            user_id=user.id,
-            name=strava_activity['name'],
-            type=strava_activity['type'],
-            distance=strava_activity['distance'],
-            moving_time=strava_activity['moving_time'],
-            elapsed_time=strava_activity['elapsed_time'],
-            start_date=datetime.strptime(strava_activity['start_date'], '%Y-%m-%dT%H:%M:%SZ'),
-            has_heartrate=strava_activity.get('has_heartrate', False),
-            average_hr=strava_activity.get('average_heartrate'),
-            max_hr=strava_activity.get('max_heartrate')
-        )
+    newest_seen = None
+    failed_dates = []
+    complete = False
+    
+    pages = 0
+    for page in range(1, app.config["STRAVA_MAX_PAGES"] + 1):
+        activities = get_athlete_activities(user, page=page, per_page=per_page, after=after)
+        pages = page
+        if activities is None:
+            break
         
-        # Store heart rate data if available
-        if hr_stream:
-            activity.set_hr_data(hr_stream)
-            
-            # Calculate and store heart rate zones
-            zones = calculate_activity_zones(user, hr_stream)
-            if zones:
-                activity.set_zone_data(zones)
+        if activities:
+            page_count, page_failures = store_new_activities(user, activities, concurrency)
+            new_count += page_count
+            failed_dates.extend(page_failures)
+            page_newest = max(parse_strava_date(a['start_date']) for a in activities)
+            newest_seen = max(newest_seen, page_newest) if newest_seen else page_newest
         
-        db.session.add(activity)
-        new_count += 1
+        if len(activities) < per_page:
+            complete = True
+            break
     
-    if new_count > 0:
-        db.session.commit()
+    # Only move the watermark forward when the listing was read to the end,
+    # and never past an activity whose details could not be fetched
+    if complete and newest_seen:
+        watermark = newest_seen
+        if failed_dates:
+            watermark = min(watermark, min(failed_dates) - timedelta(seconds=1))
+        if user.sync_watermark is None or watermark > user.sync_watermark:
+            user.sync_watermark = watermark
+            db.session.commit()
     
+    logger.info("Strava sync finished", extra={
+        "user_id": user.id,
+        "backfill_days": backfill_days,
+        "pages": pages,
+        "complete": complete,
+        "new_activities": new_count,
+        "failed": len(failed_dates),
+        "watermark": user.sync_watermark,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+    })
     return new_count
 
+def store_new_activities(user, activities, concurrency=None):
+    """
+    Fetch details for the activity summaries not stored yet and save them
+    Returns the number of new activities and the start dates of the ones
+    whose details could not be fetched
+    """
+    # Resolve which activities already exist with a single IN query
+    strava_ids = [strava_activity['id'] for strava_activity in activities]
+    existing_ids = {
+        strava_id for (strava_id,) in
+        db.session.query(Activity.strava_id).filter(Activity.strava_id.in_(strava_ids))
+    }
+    new_activities = [
+        strava_activity for strava_activity in activities
+        if strava_activity['id'] not in existing_ids
+    ]
+    if not new_activities:
+        return 0, []
+    
+    # Refresh the token once up front, worker threads only make HTTP requests
+    if not refresh_strava_token(user):
+        logger.error(f"Failed to refresh token for user {user.id}")
+        return 0, [parse_strava_date(a['start_date']) for a in new_activities]
+    
+    if concurrency is None:
+        concurrency = app.config["STRAVA_FETCH_CONCURRENCY"]
+    details = fetch_activity_details_concurrently(user.access_token, new_activities, concurrency)
+    
+    # Look up the user's zones once rather than for every activity
+    zones = get_or_create_user_zones(user).calculate_zones()
+    
+    stored = []
+    failed_dates = []
+    rate_limited = None
+    try:
+        for strava_activity, activity_details in zip(new_activities, details):
+            activity = build_activity(user, strava_activity, activity_details, zones)
+            if activity is None:
+                failed_dates.append(parse_strava_date(strava_activity['start_date']))
+                continue
+            stored.append(activity)
+    except RateLimitExceeded as e:
+        # Keep what was fetched before the quota ran out, the rest is
+        # fetched when the deferred job runs again
+        rate_limited = e
+    
+    # Commit each page so long backfills keep their progress
+    stored = insert_activities(stored)
+    if stored:
+        add_activities_to_rollups(stored)
+        db.session.commit()
+        invalidate_user(user.id)
+    
+    if rate_limited:
+        raise rate_limited
+    return len(stored), failed_dates
+
+def insert_activities(activities):
+    """
+    Add new activities to the session, skipping those another worker stored
+    since they were looked up (a sync, backfill and webhook for the same user
+    can run at the same time)
+    Returns the activities that were inserted
+    """
+    if not activities:
+        return []
+    
+    try:
+        with db.session.begin_nested():
+            db.session.add_all(activities)
+        return activities
+    except IntegrityError:
+        pass
+    
+    # Find the duplicates one savepoint at a time
+    inserted = []
+    for activity in activities:
+        try:
+            with db.session.begin_nested():
+                db.session.add(activity)
+            inserted.append(activity)
+        except IntegrityError:
+            logger.info(f"Activity {activity.strava_id} was stored by another worker")
+    return inserted
+
+def build_activity(user, strava_activity, activity_details, zones):
+    """
+    Create the Activity for a Strava summary from its fetched details and stream
+    Returns None if the details could not be fetched
+    """
+    activity_detail, hr_stream = activity_details
+    if not activity_detail:
+        return None
+    
+    # Create new activity record
+    activity = Activity(
+        strava_id=strava_activity['id'],
+        user_id=user.id,
+        name=strava_activity['name'],
+        type=strava_activity['type'],
+        distance=strava_activity['distance'],
+        moving_time=strava_activity['moving_time'],
+        elapsed_time=strava_activity['elapsed_time'],
+        start_date=parse_strava_date(strava_activity['start_date']),
+        has_heartrate=strava_activity.get('has_heartrate', False),
+        average_hr=strava_activity.get('average_heartrate'),
+        max_hr=strava_activity.get('max_heartrate')
+    )
+    
+    # Store heart rate data if available
+    if hr_stream:
+        activity.set_hr_data(hr_stream)
+        activity.stream_resolution = sync_stream_resolution()
+        
+        # Calculate and store heart rate zones
+        zone_data = calculate_activity_zones(user, hr_stream, zones)
+        if zone_data:
+            activity.set_zone_data(zone_data)
+    
+    return activity
+
+@timed("strava")
 def get_user_profile(user):
     """
     Fetch the user's profile from Strava
@@ -139,17 +378,17 @@ def get_user_profile(user):
     """
     # Refresh token if needed
     if not refresh_strava_token(user):
-        logging.error(f"Failed to refresh token for user {user.id}")
+        logger.error(f"Failed to refresh token for user {user.id}")
         return None
     
     try:
         headers = {"Authorization": f"Bearer {user.access_token}"}
-        response = requests.get(
-            "https://www.strava.com/api/v3/athlete",
+        response = get_session().get(
+            "/api/v3/athlete",
             headers=headers
         )
         response.raise_for_status()
         return response.json()
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching user profile: {str(e)}")
+    except (requests.exceptions.RequestException, RateLimitExceeded) as e:
+        logger.error(f"Error fetching user profile: {str(e)}")
         return None
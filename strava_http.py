@@ -0,0 +1,111 @@
+# Shared HTTP client for the Strava API
+#
+# All Strava calls go through one requests.Session per process, so TCP and
+# TLS connections to www.strava.com are pooled and kept alive across the
+# list, detail, stream, profile and token requests (including the concurrent
+# detail fetches during a sync, which share the pool).
+#
+# Every request gets a (connect, read) timeout, and connection errors and
+# 5xx responses of idempotent requests are retried with exponential backoff.
+# API requests (paths under /api/) draw from the shared rate limit budget of
+# rate_limit.py and raise RateLimitExceeded instead of being sent once it is
+# used up, or when Strava answers with a 429. Retries are made by the session
+# rather than by urllib3 inside the adapter, so each attempt takes its own
+# share of the budget.
+#
+# STRAVA_BASE_URL points the client at another server, e.g. a local fake
+# Strava for testing.
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from app import app
+import rate_limit
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+IDEMPOTENT_METHODS = frozenset(["GET"])  # Token POSTs are only retried when the connection failed
+
+def connection_failed(error):
+    """Check if a request error happened before anything was sent, so any method can be retried"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+class StravaSession(requests.Session):
+    """
+    Session that resolves paths against STRAVA_BASE_URL and always sets a timeout
+    Requests to /api/ paths go through the rate limit scheduler, once per attempt
+    """
+
+    def __init__(self, base_url, timeout, retries=0, backoff=0):
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def request(self, method, url, *args, **kwargs):
+        scheduled = url.startswith("/api/")
+        if url.startswith("/"):
+            url = self.base_url + url
+        kwargs.setdefault("timeout", self.timeout)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            if scheduled:
+                rate_limit.acquire()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.retries or not (idempotent or connection_failed(e)):
+                    raise
+                logger.warning(f"Retrying {method} {url} after {type(e).__name__}: {str(e)}")
+            else:
+                if scheduled:
+                    rate_limit.record_response(response)
+                if attempt >= self.retries or not idempotent or response.status_code not in RETRY_STATUSES:
+                    return response
+                logger.warning(f"Retrying {method} {url} after a {response.status_code} response")
+                response.close()
+
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+def create_session():
+    """Create a pooled session from the STRAVA_HTTP_* settings"""
+    # Enough connections for the concurrent detail fetches of a sync plus
+    # the requests of the web threads. The adapter doesn't retry, see
+    # StravaSession.request
+    pool_size = app.config["STRAVA_FETCH_CONCURRENCY"] + app.config["STRAVA_HTTP_POOL_SIZE"]
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+
+    session = StravaSession(
+        app.config["STRAVA_BASE_URL"],
+        (app.config["STRAVA_CONNECT_TIMEOUT"], app.config["STRAVA_READ_TIMEOUT"]),
+        retries=app.config["STRAVA_HTTP_RETRIES"],
+        backoff=app.config["STRAVA_HTTP_BACKOFF"]
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Return the process wide Strava session, created on first use
+    Created lazily so gunicorn workers don't share connections from before the fork
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
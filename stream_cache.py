@@ -0,0 +1,112 @@
+# In-process cache of decoded heart rate streams and zone data
+#
+# Decoding a stored stream (zlib + delta decoding, or json.loads for legacy
+# rows) and parsing zone_data happens on every activity page and chart API
+# call. Entries are kept per (kind, activity id) together with a digest of the
+# stored value they were decoded from, so a changed column is never served
+# stale even by another worker that didn't see the write.
+#
+# The cache is bounded by an approximate byte size and evicts the least
+# recently used entries. Each gunicorn worker process has its own cache; a
+# lock makes it safe for threaded workers and the sync worker thread.
+import hashlib
+import threading
+from collections import OrderedDict
+from app import app
+
+def content_digest(value):
+    """Return a short digest of a stored str or bytes column value"""
+    if isinstance(value, str):
+        value = value.encode()
+    return hashlib.blake2b(value, digest_size=16).digest()
+
+def _entry_size(value, source_size):
+    """Approximate memory used by a cached value"""
+    if isinstance(value, tuple):
+        return sum(getattr(array, "nbytes", 0) for array in value) + 128
+    # Parsed JSON takes a few times the size of its text
+    return source_size * 4 + 128
+
+class StreamCache:
+    """Thread-safe LRU cache with a byte budget and hit/miss/eviction counters"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (kind, activity_id) -> (digest, value, size)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, kind, activity_id, stored_value, load):
+        """
+        Return the cached value decoded from an activity's stored column value,
+        calling load() on a miss. Values are shared between requests and
+        threads, so callers must not modify them
+        """
+        if activity_id is None or not stored_value or self.max_bytes <= 0:
+            return load()
+
+        key = (kind, activity_id)
+        digest = content_digest(stored_value)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == digest:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Decode outside the lock so other threads aren't blocked
+        value = load()
+        if isinstance(value, tuple):
+            for array in value:
+                if hasattr(array, "flags"):  # NumPy arrays
+                    array.flags.writeable = False
+
+        size = _entry_size(value, len(stored_value))
+        if size > self.max_bytes:
+            return value
+
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (digest, value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+        return value
+
+    def invalidate(self, activity_id, kind=None):
+        """Drop an activity's cached entries, all kinds unless kind is given"""
+        with self._lock:
+            for entry_kind in ([kind] if kind else ["hr", "zones"]):
+                self._discard((entry_kind, activity_id))
+
+    def clear(self):
+        """Drop every entry, the counters are kept"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return the cache counters and current size"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def _discard(self, key):
+        """Remove one entry, the lock must be held"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+stream_cache = StreamCache(app.config["STREAM_CACHE_MAX_BYTES"])
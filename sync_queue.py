@@ -0,0 +1,252 @@
+# Background Strava sync queue
+#
+# Sync jobs are rows in the sync_job table, so the queue works on both
+# PostgreSQL and SQLite. Jobs are claimed with a conditional UPDATE, which
+# lets several workers (the in-process thread of every gunicorn worker and/or
+# worker.py processes) poll the same table safely.
+#
+# Incremental syncs are claimed before backfills and make their Strava
+# requests with interactive priority (see rate_limit.py). A job that runs out
+# of Strava quota goes back on the queue with run_after set to when the quota
+# refills.
+#
+# The workers also process the Strava webhook events stored by webhooks.py.
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from cache import purge_expired
+from models import SyncJob, User
+from rate_limit import BACKGROUND, INTERACTIVE, RateLimitExceeded, request_priority
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+ACTIVE_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+# Job kinds that run after incremental syncs and leave quota to them
+BACKGROUND_KINDS = ("backfill", "hydrate")
+
+def get_active_job(user_id, kind="sync"):
+    """Return the user's queued or running job of the given kind, if any"""
+    return SyncJob.query.filter(
+        SyncJob.user_id == user_id,
+        SyncJob.kind == kind,
+        SyncJob.status.in_(ACTIVE_STATUSES)
+    ).first()
+
+def get_latest_job(user_id, kind="sync"):
+    """Return the user's most recent job of the given kind"""
+    return SyncJob.query.filter_by(user_id=user_id, kind=kind).order_by(SyncJob.id.desc()).first()
+
+def enqueue_sync(user_id, kind="sync", payload=None):
+    """
+    Queue a sync job for a user
+    kind is "sync" for an incremental sync, "backfill" with a {"days": N}
+    payload or "hydrate" to prefetch recent detail streams (see hydration.py)
+    If the user already has an active job of this kind it is returned instead
+    """
+    existing = get_active_job(user_id, kind)
+    if existing:
+        return existing
+
+    job = SyncJob(
+        user_id=user_id,
+        kind=kind,
+        status=JOB_QUEUED,
+        payload=json.dumps(payload) if payload else None
+    )
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request queued the same job first
+        db.session.rollback()
+        return get_active_job(user_id, kind)
+
+    return job
+
+def request_sync(user_id):
+    """
+    Queue a sync unless one is already active or finished recently
+    Returns the job that represents the user's current sync state, or None
+    """
+    latest = get_latest_job(user_id)
+    if latest and latest.status in ACTIVE_STATUSES:
+        return latest
+
+    # With a webhook subscription new activities are pushed to us, polling
+    # only catches events that were missed
+    if app.config["STRAVA_WEBHOOK_SUBSCRIPTION_ID"]:
+        min_interval = timedelta(seconds=app.config["SYNC_WEBHOOK_POLL_INTERVAL"])
+    else:
+        min_interval = timedelta(seconds=app.config["SYNC_MIN_INTERVAL"])
+    if latest and latest.finished_at and datetime.utcnow() - latest.finished_at < min_interval:
+        return latest
+
+    return enqueue_sync(user_id)
+
+def claim_next_job():
+    """
+    Atomically move the next queued job to running
+    Incremental syncs go before backfills, deferred jobs wait for their run_after
+    Returns the claimed job or None if no job is ready
+    """
+    while True:
+        job_id = db.session.query(SyncJob.id).filter(
+            SyncJob.status == JOB_QUEUED,
+            or_(SyncJob.run_after.is_(None), SyncJob.run_after <= datetime.utcnow())
+        ).order_by(SyncJob.kind.in_(BACKGROUND_KINDS), SyncJob.created_at, SyncJob.id).limit(1).scalar()
+        if job_id is None:
+            return None
+
+        result = db.session.execute(
+            update(SyncJob)
+            .where(SyncJob.id == job_id, SyncJob.status == JOB_QUEUED)
+            .values(status=JOB_RUNNING, started_at=datetime.utcnow())
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return db.session.get(SyncJob, job_id)
+        # Another worker claimed it first, try the next one
+
+def run_job(job):
+    """
+    Run a claimed job and record its outcome
+    A job stopped by the Strava rate limit is queued again for later
+    """
+    from hydration import prefetch_streams, queue_prefetch
+    from strava_client import sync_activities
+
+    try:
+        user = db.session.get(User, job.user_id)
+        if user is None:
+            raise ValueError(f"User {job.user_id} no longer exists")
+
+        if job.kind == "hydrate":
+            with request_priority(BACKGROUND):
+                job.new_activities = prefetch_streams(user)  # Hydrated, not new, activities
+        elif job.kind == "backfill":
+            days = job.get_payload().get("days", app.config["STRAVA_BACKFILL_DAYS"])
+            with request_priority(BACKGROUND):
+                job.new_activities = sync_activities(user, backfill_days=days)
+        else:
+            with request_priority(INTERACTIVE):
+                job.new_activities = sync_activities(user)
+        job.status = JOB_DONE
+    except RateLimitExceeded as e:
+        logger.info(f"Sync job {job.id} deferred: {str(e)}")
+        db.session.rollback()
+        job.status = JOB_QUEUED
+        job.started_at = None
+        job.run_after = e.retry_at
+        db.session.commit()
+        return job
+    except Exception as e:
+        logger.exception(f"Sync job {job.id} failed")
+        db.session.rollback()
+        job.status = JOB_FAILED
+        job.error = str(e)
+
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+    # Fetch the detail streams of new recent activities before anyone opens them
+    if job.status == JOB_DONE and job.kind != "hydrate" and job.new_activities:
+        queue_prefetch(job.user_id)
+    return job
+
+def requeue_stale_jobs(timeout):
+    """Put jobs back on the queue whose worker died while running them"""
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    result = db.session.execute(
+        update(SyncJob)
+        .where(SyncJob.status == JOB_RUNNING, SyncJob.started_at < cutoff)
+        .values(status=JOB_QUEUED, started_at=None)
+    )
+    db.session.commit()
+    return result.rowcount
+
+def purge_finished_jobs(older_than):
+    """Delete finished jobs older than the given number of seconds"""
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+    deleted = SyncJob.query.filter(
+        SyncJob.status.in_((JOB_DONE, JOB_FAILED)),
+        SyncJob.finished_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+def run_pending_jobs(max_jobs=None):
+    """Run queued jobs until the queue is empty, returns the number of jobs run"""
+    count = 0
+    while max_jobs is None or count < max_jobs:
+        job = claim_next_job()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+def run_worker(stop_event=None, poll_interval=None):
+    """
+    Poll the queue and run jobs until stop_event is set
+    Must be called inside an app context
+    """
+    from webhooks import purge_processed_events, requeue_stale_events, run_pending_events
+
+    poll_interval = poll_interval or app.config["SYNC_POLL_INTERVAL"]
+    last_maintenance = 0
+
+    logger.info("Sync worker started")
+    while not (stop_event and stop_event.is_set()):
+        try:
+            if time.monotonic() - last_maintenance > 600:
+                requeue_stale_jobs(app.config["SYNC_JOB_TIMEOUT"])
+                requeue_stale_events(app.config["SYNC_JOB_TIMEOUT"])
+                purge_finished_jobs(86400)
+                purge_processed_events(86400)
+                purge_expired()
+                last_maintenance = time.monotonic()
+
+            # Webhook events first, they are single activities users just uploaded
+            if run_pending_events() + run_pending_jobs() == 0:
+                time.sleep(poll_interval)
+        except Exception:
+            logger.exception("Sync worker error")
+            db.session.rollback()
+            time.sleep(poll_interval)
+        finally:
+            db.session.remove()
+    logger.info("Sync worker stopped")
+
+_worker_thread = None
+_worker_lock = threading.Lock()
+
+def ensure_worker_thread():
+    """
+    Start the in-process worker on a daemon thread if it isn't running yet
+    Used when SYNC_WORKER is "thread", so no separate worker process is needed
+    """
+    global _worker_thread
+
+    if _worker_thread is not None and _worker_thread.is_alive():
+        return _worker_thread
+
+    with _worker_lock:
+        if _worker_thread is not None and _worker_thread.is_alive():
+            return _worker_thread
+
+        def target():
+            with app.app_context():
+                run_worker()
+
+        _worker_thread = threading.Thread(target=target, name="sync-worker", daemon=True)
+        _worker_thread.start()
+        return _worker_thread
@@ -0,0 +1,117 @@
+# Shared test fixtures
+#
+# The app reads its configuration when app.py is imported, so the test
+# database and settings are put in the environment before anything imports
+# it. Tests run against a throwaway SQLite database migrated with
+# migrations.upgrade(), the same way flask --app main db-upgrade does.
+import itertools
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+_db_dir = tempfile.mkdtemp(prefix="zone-wizard-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ.setdefault("SESSION_SECRET", "tests")
+os.environ["SYNC_WORKER"] = "external"
+os.environ["DASHBOARD_CACHE"] = "none"
+
+import pytest
+from app import app as flask_app, create_app, db
+
+_user_numbers = itertools.count(1)
+
+@pytest.fixture(scope="session")
+def app():
+    """The app with a migrated test database"""
+    from migrations import upgrade
+
+    create_app()
+    with flask_app.app_context():
+        upgrade(log=lambda message: None)
+    return flask_app
+
+@pytest.fixture
+def app_context(app):
+    """An app context whose session is rolled back and removed afterwards"""
+    with app.app_context():
+        yield
+        db.session.rollback()
+        db.session.remove()
+
+@pytest.fixture
+def make_user(app_context):
+    """Create users with heart rate zones, deleting them and their data afterwards"""
+    from models import Activity, DailyZoneRollup, HeartRateZones, SyncJob, User
+
+    created = []
+
+    def make(max_hr=190, **fields):
+        number = next(_user_numbers)
+        user = User(
+            strava_id=900000 + number,
+            username=f"athlete{number}",
+            access_token=f"token-{number}",
+            refresh_token=f"refresh-{number}",
+            token_expiry=datetime.utcnow() + timedelta(hours=6),
+            **fields
+        )
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(HeartRateZones(user_id=user.id, max_hr=max_hr, resting_hr=60, zone_method="percentage"))
+        db.session.commit()
+        created.append(user.id)
+        return user
+
+    yield make
+
+    db.session.rollback()
+    for model in (Activity, DailyZoneRollup, HeartRateZones, SyncJob):
+        model.query.filter(model.user_id.in_(created)).delete(synchronize_session=False)
+    User.query.filter(User.id.in_(created)).delete(synchronize_session=False)
+    db.session.commit()
+
+@pytest.fixture
+def statements(app_context):
+    """Record the SQL statements the app executes while the test runs"""
+    from sqlalchemy import event
+
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(engine, "before_cursor_execute", record)
+
+@pytest.fixture
+def login(app):
+    """Return a test client logged in as the given user"""
+    def client_for(user):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user.id)
+            session["_fresh"] = True
+        return client
+    return client_for
+
+@pytest.fixture
+def fake_strava(app_context, monkeypatch):
+    """Route Strava requests to a FakeStrava with an empty rate limit budget"""
+    import strava_http
+    from models import StravaRateLimit
+    from tests.fake_strava import FakeStrava
+
+    fake = FakeStrava()
+    session = strava_http.StravaSession("https://strava.test", (1, 1))
+    session.mount("https://", fake)
+    monkeypatch.setattr(strava_http, "_session", session)
+    StravaRateLimit.query.delete()
+    db.session.commit()
+
+    yield fake
+
+    db.session.rollback()
+    StravaRateLimit.query.delete()
+    db.session.commit()
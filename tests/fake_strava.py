@@ -0,0 +1,171 @@
+# A fake Strava API for the tests
+#
+# FakeStrava is a requests transport adapter, mounted on a real StravaSession
+# so requests still go through the rate limit scheduler. It serves the
+# activity list, activity detail, stream and token endpoints from in-memory
+# athletes and activities, and enforces its own 15 minute and daily limits
+# with the same X-RateLimit-* headers and 429 responses as Strava.
+# Server errors and network failures can be queued with fail_next().
+import calendar
+import json
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.exceptions import ConnectTimeout
+from requests.structures import CaseInsensitiveDict
+
+# Samples Strava returns per stream resolution, at most what was recorded
+RESOLUTION_SAMPLES = {"low": 100, "medium": 1000, "high": 10000}
+
+class FakeStrava(BaseAdapter):
+
+    def __init__(self, limit_15min=100, limit_daily=1000):
+        super().__init__()
+        self.limit_15min = limit_15min
+        self.limit_daily = limit_daily
+        self.usage_15min = 0
+        self.usage_daily = 0
+        self.tokens = {}  # access token -> athlete id
+        self.refresh_tokens = {}  # refresh token -> athlete id, revoked ones are removed
+        self.activities = {}  # activity id -> summary, with the owner in ["athlete"]["id"]
+        self.samples = {}  # activity id -> number of recorded stream samples
+        self.requests = []  # (method, path, query) of every request
+        self.rejected = 0  # requests answered with a 429
+        self.timeouts = []  # timeout of every request
+        self.failures = []  # HTTP statuses or exceptions for the next requests
+
+    def add_athlete(self, user):
+        """Accept the user's tokens"""
+        self.tokens[user.access_token] = user.strava_id
+        self.refresh_tokens[user.refresh_token] = user.strava_id
+
+    def add_activity(self, owner, activity_id, start_date, has_heartrate=True, samples=3600, **fields):
+        """Record an activity of the athlete with Strava id owner, returns its summary"""
+        self.activities[activity_id] = {
+            "id": activity_id,
+            "athlete": {"id": owner},
+            "name": f"Activity {activity_id}",
+            "type": "Ride",
+            "distance": 20000.0,
+            "moving_time": samples,
+            "elapsed_time": samples,
+            "start_date": start_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "has_heartrate": has_heartrate,
+            "average_heartrate": 140.0 if has_heartrate else None,
+            "max_heartrate": 180.0 if has_heartrate else None,
+            **fields
+        }
+        self.samples[activity_id] = samples
+        return self.activities[activity_id]
+
+    def fail_next(self, *failures):
+        """
+        Answer the next requests with these HTTP statuses or raise these
+        exceptions, one per request. Connect timeouts never reach Strava, so
+        they aren't counted against its limits
+        """
+        self.failures.extend(failures)
+
+    def new_window(self):
+        """Start the next 15 minute window"""
+        self.usage_15min = 0
+
+    def api_requests(self, path_part=""):
+        """The API requests whose path contains path_part"""
+        return [r for r in self.requests if r[1].startswith("/api/") and path_part in r[1]]
+
+    def stream(self, activity_id, resolution):
+        """Return the time and heart rate streams at a resolution"""
+        recorded = self.samples[activity_id]
+        count = min(RESOLUTION_SAMPLES.get(resolution, recorded), recorded)
+        return {
+            "time": {"data": [i * recorded // count for i in range(count)]},
+            "heartrate": {"data": [100 + i * 80 // count for i in range(count)]}
+        }
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.timeouts.append(kwargs.get("timeout"))
+        failure = self.failures.pop(0) if self.failures else None
+        if isinstance(failure, ConnectTimeout):
+            raise failure
+        self.requests.append((request.method, url.path, query))
+
+        if url.path == "/oauth/token":
+            if failure is not None:
+                return self.fail(request, failure)
+            form = {key: values[-1] for key, values in parse_qs(request.body or "").items()}
+            athlete = self.refresh_tokens.get(form.get("refresh_token"))
+            if athlete is None:
+                return self.respond(request, 400, {"message": "Bad Request"})
+            access_token = f"access-{athlete}-{len(self.requests)}"
+            self.tokens[access_token] = athlete
+            return self.respond(request, 200, {
+                "access_token": access_token,
+                "refresh_token": form["refresh_token"],
+                "expires_at": calendar.timegm(datetime.utcnow().timetuple()) + 6 * 3600
+            })
+
+        self.usage_15min += 1
+        self.usage_daily += 1
+        if self.usage_15min > self.limit_15min or self.usage_daily > self.limit_daily:
+            self.rejected += 1
+            return self.respond(request, 429, {"message": "Rate Limit Exceeded"})
+        if failure is not None:
+            return self.fail(request, failure)
+
+        athlete = self.tokens.get(request.headers.get("Authorization", "").removeprefix("Bearer "))
+        if athlete is None:
+            return self.respond(request, 401, {"message": "Authorization Error"})
+
+        parts = url.path.strip("/").split("/")
+        if url.path == "/api/v3/athlete/activities":
+            after = int(query.get("after", 0))
+            page, per_page = int(query.get("page", 1)), int(query.get("per_page", 30))
+            listed = sorted(
+                (a for a in self.activities.values()
+                 if a["athlete"]["id"] == athlete and self.timestamp(a) > after),
+                key=self.timestamp
+            )
+            return self.respond(request, 200, listed[(page - 1) * per_page:page * per_page])
+
+        if parts[:3] == ["api", "v3", "activities"] and len(parts) in (4, 5):
+            activity = self.activities.get(int(parts[3]))
+            # Other athletes' activities are visible unless they are private
+            if activity is None or (activity["athlete"]["id"] != athlete and activity.get("private")):
+                return self.respond(request, 404, {"message": "Record Not Found"})
+            if len(parts) == 4:
+                return self.respond(request, 200, activity)
+            if parts[4] == "streams" and activity["has_heartrate"]:
+                return self.respond(request, 200, self.stream(activity["id"], query.get("resolution")))
+            return self.respond(request, 200, {})
+
+        return self.respond(request, 404, {"message": "Record Not Found"})
+
+    def fail(self, request, failure):
+        """Raise a queued exception or answer with a queued status"""
+        if isinstance(failure, Exception):
+            raise failure
+        return self.respond(request, failure, {"message": "Server Error"})
+
+    def timestamp(self, activity):
+        return calendar.timegm(datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ").timetuple())
+
+    def respond(self, request, status, body):
+        response = Response()
+        response.status_code = status
+        response.request = request
+        response.url = request.url
+        response.encoding = "utf-8"
+        response._content = json.dumps(body).encode()
+        response.headers = CaseInsensitiveDict({
+            "Content-Type": "application/json",
+            "X-RateLimit-Limit": f"{self.limit_15min},{self.limit_daily}",
+            "X-RateLimit-Usage": f"{self.usage_15min},{self.usage_daily}"
+        })
+        return response
+
+    def close(self):
+        pass
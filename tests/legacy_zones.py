@@ -0,0 +1,64 @@
+# The per-sample zone loop calculate_activity_zones used before the NumPy
+# engine, kept as the reference for the parity tests and zone_benchmark.py
+import numpy as np
+
+def legacy_zone_data(hr_data, zones):
+    """Return the zone data the old loop computed for a list of [time, hr] pairs"""
+    if not zones or not hr_data:
+        return None
+
+    times = [point[0] for point in hr_data]
+    hr_values = [point[1] for point in hr_data]
+
+    time_diffs = np.diff(times, prepend=0)
+    time_diffs[0] = 0  # First point has no time difference
+
+    zone_times = {
+        "zone1": 0,
+        "zone2": 0,
+        "zone3": 0,
+        "zone4": 0,
+        "zone5": 0,
+        "below": 0,
+        "total": sum(time_diffs[1:])
+    }
+
+    for i, hr in enumerate(hr_values):
+        if i == 0:
+            continue
+
+        if hr < zones["zone1"]["min"]:
+            zone_times["below"] += time_diffs[i]
+        elif hr < zones["zone2"]["min"]:
+            zone_times["zone1"] += time_diffs[i]
+        elif hr < zones["zone3"]["min"]:
+            zone_times["zone2"] += time_diffs[i]
+        elif hr < zones["zone4"]["min"]:
+            zone_times["zone3"] += time_diffs[i]
+        elif hr < zones["zone5"]["min"]:
+            zone_times["zone4"] += time_diffs[i]
+        else:
+            zone_times["zone5"] += time_diffs[i]
+
+    zone_percentages = {}
+    if zone_times["total"] > 0:
+        for zone in ["zone1", "zone2", "zone3", "zone4", "zone5", "below"]:
+            zone_percentages[zone] = round((zone_times[zone] / zone_times["total"]) * 100, 1)
+
+    return {
+        "times": zone_times,
+        "percentages": zone_percentages,
+        "zone_ranges": zones
+    }
+
+def synthetic_stream(samples, seed=0, float_times=False, float_hr=False):
+    """Return a ride-like list of [time, hr] pairs with pauses and HR drift"""
+    rng = np.random.default_rng(seed)
+    steps = rng.choice([1, 1, 1, 2, 3, 7], size=samples)
+    times = np.cumsum(steps) - steps[0]
+    hr_values = np.clip(120 + np.cumsum(rng.normal(0, 2, size=samples)), 60, 205)
+    if float_times:
+        times = times + rng.uniform(0, 0.9, size=samples).round(2)
+    if not float_hr:
+        hr_values = hr_values.round().astype(int)
+    return [[t, hr] for t, hr in zip(times.tolist(), hr_values.tolist())]
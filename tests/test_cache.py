@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+import pytest
+import cache
+from sync_queue import JOB_DONE, claim_next_job, enqueue_sync, run_job
+
+class Clock:
+    """Stands in for the time module in cache.py"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+class FakeRedis:
+    """The subset of the redis client RedisBackend uses, expiring keys like the server"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.data = {}  # key -> (value, expires_at or None)
+
+    def _live(self, key):
+        entry = self.data.get(key)
+        if entry and entry[1] is not None and entry[1] <= self.clock.time():
+            del self.data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        entry = self._live(key)
+        return entry[0] if entry else None
+
+    def set(self, key, value, ex=None):
+        self.data[key] = (value, self.clock.time() + ex if ex else None)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def incr(self, key):
+        entry = self._live(key)
+        value = int(entry[0]) + 1 if entry else 1
+        self.data[key] = (str(value), entry[1] if entry else None)
+        return value
+
+    def scan_iter(self, match):
+        return [key for key in list(self.data) if self._live(key) and fnmatchcase(key, match)]
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, clock, tmp_path, monkeypatch):
+    """Each backend in turn, installed as the configured dashboard cache"""
+    if request.param == "memory":
+        backend = cache.MemoryBackend()
+    elif request.param == "sqlite":
+        backend = cache.create_backend(f"sqlite:///{tmp_path / 'cache.db'}")
+    else:
+        backend = cache.RedisBackend(client=FakeRedis(clock))
+    monkeypatch.setattr(cache, "_backend", backend)
+    return backend
+
+class Counter:
+    """A compute function counting its calls"""
+
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+def test_round_trip(app, backend):
+    compute = Counter({"zone1": 60.0, "total": 60.0, "types": ["Run", "Ride"]})
+
+    first = cache.cached(1, "totals", (30, "all"), compute, ttl=60)
+    second = cache.cached(1, "totals", (30, "all"), compute, ttl=60)
+
+    assert first == second == compute.value
+    assert compute.calls == 1
+    # Other params are other entries
+    cache.cached(1, "totals", (7, "all"), compute, ttl=60)
+    assert compute.calls == 2
+
+def test_entries_expire_after_their_ttl(app, backend, clock):
+    compute = Counter([1, 2, 3])
+
+    cache.cached(1, "totals", (), compute, ttl=60)
+    clock.now += 59
+    cache.cached(1, "totals", (), compute, ttl=60)
+    assert compute.calls == 1
+
+    clock.now += 2
+    cache.cached(1, "totals", (), compute, ttl=60)
+    assert compute.calls == 2
+
+def test_invalidation_bumps_only_that_users_generation(app, backend):
+    first_user, other_user = Counter("first"), Counter("other")
+    cache.cached(1, "types", (), first_user, ttl=60)
+    cache.cached(2, "types", (), other_user, ttl=60)
+
+    cache.invalidate_user(1)
+    cache.invalidate_user(1)
+    cache.cached(1, "types", (), first_user, ttl=60)
+    cache.cached(2, "types", (), other_user, ttl=60)
+
+    assert (first_user.calls, other_user.calls) == (2, 1)
+    assert cache._generation(backend, 1) == 2
+    assert cache._generation(backend, 2) == 0
+
+def test_generations_outlive_the_ttl(app, backend, clock):
+    cache.invalidate_user(1)
+    clock.now += 10 * 24 * 3600
+
+    assert cache._generation(backend, 1) == 1
+
+def test_purge_expired(app, backend, clock):
+    compute = Counter("value")
+    cache.cached(1, "short", (), compute, ttl=10)
+    cache.cached(1, "long", (), compute, ttl=1000)
+    cache.invalidate_user(2)
+    clock.now += 100
+
+    removed = cache.purge_expired()
+
+    if isinstance(backend, cache.RedisBackend):
+        assert removed == 0  # The server expires keys itself
+    else:
+        assert removed == 1
+    assert backend.get("short:1:0") is None
+    assert backend.get("long:1:0") == '"value"'
+    assert cache._generation(backend, 2) == 1
+
+def test_clear_removes_everything(app, backend):
+    cache.cached(1, "totals", (), Counter("value"), ttl=60)
+    cache.invalidate_user(1)
+
+    cache.clear_cache()
+
+    assert backend.get("totals:1:1") is None
+    assert cache._generation(backend, 1) == 0
+
+def test_failing_backend_falls_back_to_computing(app, backend, monkeypatch):
+    def broken(*args, **kwargs):
+        raise OSError("cache unreachable")
+
+    monkeypatch.setattr(backend, "get", broken)
+    monkeypatch.setattr(backend, "incr", broken)
+
+    assert cache.cached(1, "totals", (), Counter("value"), ttl=60) == "value"
+    cache.invalidate_user(1)
+
+@pytest.fixture
+def cached_dashboard(app, monkeypatch):
+    """The shared memory backend for the dashboard, conftest disables caching"""
+    backend = cache.MemoryBackend()
+    monkeypatch.setattr(cache, "_backend", backend)
+    return backend
+
+def sync(user):
+    job = enqueue_sync(user.id)
+    assert claim_next_job().id == job.id
+    assert run_job(job).status == JOB_DONE
+
+def test_sync_invalidates_cached_dashboard_data(cached_dashboard, make_user, fake_strava, login):
+    user = make_user()
+    fake_strava.add_athlete(user)
+    fake_strava.add_activity(user.strava_id, user.strava_id * 10, datetime.utcnow() - timedelta(days=1), type="Run")
+    sync(user)
+    client = login(user)
+    before = client.get("/api/dashboard/zone_summary?days=7").get_json()
+    assert b"Swim" not in client.get("/dashboard").data
+
+    fake_strava.add_activity(user.strava_id, user.strava_id * 10 + 1, datetime.utcnow() - timedelta(hours=1), type="Swim")
+    sync(user)
+
+    assert cache._generation(cached_dashboard, user.id) >= 1
+    after = client.get("/api/dashboard/zone_summary?days=7").get_json()
+    assert sum(after["datasets"][0]["data"]) > sum(before["datasets"][0]["data"])
+    # The activity type list is only keyed by the generation
+    assert b"Swim" in client.get("/dashboard").data
+
+def test_zone_change_invalidates_cached_totals(cached_dashboard, make_user, fake_strava, login):
+    user = make_user(max_hr=190)
+    fake_strava.add_athlete(user)
+    fake_strava.add_activity(user.strava_id, user.strava_id * 10, datetime.utcnow() - timedelta(days=1))
+    sync(user)
+    client = login(user)
+    before = client.get("/api/dashboard/zone_summary?days=7").get_json()
+    generation = cache._generation(cached_dashboard, user.id)
+
+    assert client.post("/profile", data={"max_hr": "150"}).status_code == 302
+
+    assert cache._generation(cached_dashboard, user.id) == generation + 1
+    after = client.get("/api/dashboard/zone_summary?days=7").get_json()
+    assert after["datasets"][0]["data"] != before["datasets"][0]["data"]
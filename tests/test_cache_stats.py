@@ -0,0 +1,42 @@
+from datetime import datetime
+import pytest
+from app import app, db
+from models import Activity
+from stream_cache import stream_cache
+from tests.legacy_zones import synthetic_stream
+from zone_calculator import calculate_activity_zones
+
+@pytest.fixture
+def activity(make_user):
+    user = make_user()
+    activity = Activity(strava_id=8_300_000 + user.id, user_id=user.id, name="Run", type="Run",
+                        start_date=datetime.utcnow(), has_heartrate=True)
+    hr_data = synthetic_stream(600)
+    activity.set_hr_data(hr_data)
+    activity.set_zone_data(calculate_activity_zones(user, hr_data))
+    db.session.add(activity)
+    db.session.commit()
+    return activity
+
+def test_counters_count_hits_and_misses(app, activity, login):
+    client = login(activity.user)
+    stats = app.test_client().get("/api/cache/stats").get_json()
+
+    client.get(f"/activity/{activity.id}")
+    after_miss = app.test_client().get("/api/cache/stats").get_json()
+    client.get(f"/activity/{activity.id}")
+    after_hit = app.test_client().get("/api/cache/stats").get_json()
+
+    assert (after_miss["misses"], after_miss["hits"]) == (stats["misses"] + 1, stats["hits"])
+    assert (after_hit["misses"], after_hit["hits"]) == (stats["misses"] + 1, stats["hits"] + 1)
+    assert after_hit["entries"] >= 1 and after_hit["bytes"] > 0
+
+def test_stats_require_the_metrics_token(app, monkeypatch):
+    monkeypatch.setitem(app.config, "METRICS_TOKEN", "secret")
+    client = app.test_client()
+
+    assert client.get("/api/cache/stats").status_code == 401
+    assert client.get("/api/cache/stats", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    response = client.get("/api/cache/stats", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert response.get_json() == stream_cache.stats()
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+import pytest
+import rollups
+from sync_queue import JOB_DONE, claim_next_job, enqueue_sync, run_job
+
+ENDPOINTS = ["/api/dashboard/zone_summary?days=7", "/api/dashboard/zone_trends?days=30"]
+
+@pytest.fixture
+def athlete(make_user, fake_strava):
+    """A synced user with one heart rate activity"""
+    user = make_user()
+    fake_strava.add_athlete(user)
+    fake_strava.add_activity(user.strava_id, user.strava_id * 10, datetime.utcnow() - timedelta(days=1))
+    sync(user)
+    return user
+
+def sync(user):
+    job = enqueue_sync(user.id)
+    assert claim_next_job().id == job.id
+    assert run_job(job).status == JOB_DONE
+
+def freeze_utcnow(monkeypatch, now):
+    class FrozenDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return now
+
+    monkeypatch.setattr(rollups, "datetime", FrozenDatetime)
+
+@pytest.mark.parametrize("url", ENDPOINTS)
+def test_unchanged_dashboard_is_not_modified(athlete, login, url):
+    client = login(athlete)
+
+    first = client.get(url)
+    again = client.get(url, headers={"If-None-Match": first.headers["ETag"]})
+
+    assert first.status_code == 200
+    assert again.status_code == 304
+    assert again.headers["ETag"] == first.headers["ETag"]
+
+@pytest.mark.parametrize("url", ENDPOINTS)
+def test_sync_changes_the_etag(athlete, login, fake_strava, url):
+    client = login(athlete)
+    before = client.get(url)
+
+    fake_strava.add_activity(athlete.strava_id, athlete.strava_id * 10 + 1, datetime.utcnow() - timedelta(hours=2))
+    sync(athlete)
+    after = client.get(url, headers={"If-None-Match": before.headers["ETag"]})
+
+    assert after.status_code == 200
+    assert after.headers["ETag"] != before.headers["ETag"]
+    assert after.get_json() != before.get_json()
+
+@pytest.mark.parametrize("url", ENDPOINTS)
+def test_zone_change_changes_the_etag(athlete, login, url):
+    client = login(athlete)
+    before = client.get(url)
+
+    assert client.post("/profile", data={"max_hr": "170"}).status_code == 302
+    after = client.get(url, headers={"If-None-Match": before.headers["ETag"]})
+
+    assert after.status_code == 200
+    assert after.headers["ETag"] != before.headers["ETag"]
+    assert after.get_json() != before.get_json()
+
+def test_window_moves_with_the_etag_at_midnight(athlete, login, monkeypatch):
+    client = login(athlete)
+    today = datetime.utcnow().date()
+    url = ENDPOINTS[0]
+
+    freeze_utcnow(monkeypatch, datetime.combine(today, datetime.min.time()) + timedelta(hours=1))
+    morning = client.get(url)
+    freeze_utcnow(monkeypatch, datetime.combine(today, datetime.min.time()) + timedelta(hours=23, minutes=59))
+    evening = client.get(url, headers={"If-None-Match": morning.headers["ETag"]})
+    # Yesterday's activity is in the 7 day window until the 6th day from now
+    freeze_utcnow(monkeypatch, datetime.combine(today + timedelta(days=5), datetime.min.time()))
+    last_day = client.get(url)
+    freeze_utcnow(monkeypatch, datetime.combine(today + timedelta(days=6), datetime.min.time()))
+    day_after = client.get(url, headers={"If-None-Match": last_day.headers["ETag"]})
+
+    assert evening.status_code == 304
+    assert last_day.get_json() == morning.get_json()
+    assert last_day.headers["ETag"] != morning.headers["ETag"]
+    assert day_after.status_code == 200
+    assert sum(day_after.get_json()["datasets"][0]["data"]) == 0
+
+def test_window_covers_whole_days():
+    start, end = rollups.last_days_window(7)
+
+    assert start.time() == datetime.min.time()
+    assert end.date() == datetime.utcnow().date()
+    assert (end - start) == timedelta(days=7, microseconds=-1)
@@ -0,0 +1,74 @@
+import re
+from datetime import datetime, timedelta
+from app import db
+from models import Activity
+from tests.legacy_zones import synthetic_stream
+from zone_calculator import calculate_activity_zones
+
+BLOB_COLUMNS = ("hr_data", "hr_stream", "zone_data")
+
+def selected_columns(statement):
+    """The column list of a SELECT statement"""
+    match = re.match(r"\s*SELECT\s+(.*?)\s+FROM\s", statement, re.IGNORECASE | re.DOTALL)
+    return match.group(1) if match else ""
+
+def blob_selects(statements):
+    """The SELECT statements that load a stream or zone blob of an activity"""
+    return [
+        statement for statement in statements
+        if any(f"activity.{column}" in selected_columns(statement) for column in BLOB_COLUMNS)
+    ]
+
+def add_activities(user, count):
+    now = datetime.utcnow()
+    for i in range(count):
+        hr_data = synthetic_stream(600, seed=i)
+        activity = Activity(
+            strava_id=7_000_000 + user.id * 1000 + i,
+            user_id=user.id,
+            name=f"Run {i}",
+            type="Run" if i % 2 else "Ride",
+            start_date=now - timedelta(days=i + 1),
+            has_heartrate=True,
+            moving_time=600,
+            elapsed_time=600,
+            distance=5000.0
+        )
+        activity.set_hr_data(hr_data)
+        activity.set_zone_data(calculate_activity_zones(user, hr_data))
+        db.session.add(activity)
+    db.session.commit()
+
+def test_default_activity_query_leaves_blobs_out(app_context):
+    compiled = str(Activity.query.filter(Activity.user_id == 1).statement)
+
+    assert "activity.name" in selected_columns(compiled)
+    for column in BLOB_COLUMNS:
+        assert f"activity.{column}" not in selected_columns(compiled)
+
+def test_dashboard_does_not_load_blobs(make_user, login, statements):
+    user = make_user()
+    add_activities(user, 5)
+    client = login(user)
+
+    for path in ("/dashboard", "/dashboard?days=90&type=Run", "/api/dashboard/zone_summary", "/api/dashboard/zone_trends"):
+        statements.clear()
+        response = client.get(path)
+
+        assert response.status_code == 200
+        assert blob_selects(statements) == [], path
+
+    # The dashboard did list the activities, just without their blobs
+    statements.clear()
+    assert b"Run 1" in client.get("/dashboard?days=90").data
+    assert any("FROM activity" in statement for statement in statements)
+
+def test_activity_detail_loads_blobs_in_one_query(make_user, login, statements):
+    user = make_user()
+    add_activities(user, 1)
+    activity_id = Activity.query.filter_by(user_id=user.id).one().id
+    client = login(user)
+    statements.clear()
+
+    assert client.get(f"/activity/{activity_id}").status_code == 200
+    assert len(blob_selects(statements)) == 1
@@ -0,0 +1,74 @@
+import math
+import numpy as np
+import pytest
+from downsampling import MIN_POINTS, lttb_indices
+
+def reference_lttb(x, y, threshold):
+    """Straightforward LTTB as originally described by Steinarsson, one point at a time"""
+    n = len(x)
+    if threshold >= n:
+        return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        next_start = math.floor((i + 1) * every) + 1
+        next_end = min(math.floor((i + 2) * every) + 1, n)
+        avg_x = sum(x[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(y[next_start:next_end]) / (next_end - next_start)
+
+        max_area, max_index = -1, None
+        for j in range(math.floor(i * every) + 1, math.floor((i + 1) * every) + 1):
+            area = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a])) * 0.5
+            if area > max_area:
+                max_area, max_index = area, j
+        selected.append(max_index)
+        a = max_index
+    selected.append(n - 1)
+    return selected
+
+def random_stream(samples, seed):
+    rng = np.random.default_rng(seed)
+    x = np.cumsum(rng.uniform(0.5, 1.5, samples))
+    y = 140 + np.cumsum(rng.normal(0, 1, samples))
+    return x, y
+
+@pytest.mark.parametrize("samples, max_points", [(10, 3), (100, 7), (1000, 50), (3601, 1000), (5000, 4999)])
+def test_matches_reference_lttb(samples, max_points):
+    x, y = random_stream(samples, seed=samples)
+
+    indices = lttb_indices(x, y, max_points)
+
+    assert indices.tolist() == reference_lttb(x.tolist(), y.tolist(), max_points)
+
+@pytest.mark.parametrize("max_points", [3, 4, 500])
+def test_first_and_last_points_are_kept(max_points):
+    x, y = random_stream(1000, seed=max_points)
+    # Make the ends unremarkable so only the rule keeps them
+    y[0] = y[-1] = y.mean()
+
+    indices = lttb_indices(x, y, max_points)
+
+    assert len(indices) == max_points
+    assert indices[0] == 0 and indices[-1] == len(x) - 1
+    assert np.all(np.diff(indices) > 0)
+
+def test_short_streams_are_returned_whole():
+    x, y = random_stream(20, seed=1)
+
+    assert lttb_indices(x, y, 20).tolist() == list(range(20))
+    assert lttb_indices(x, y, 100).tolist() == list(range(20))
+
+@pytest.mark.parametrize("max_points", [-1, 0, 1, MIN_POINTS - 1])
+def test_too_few_points_are_rejected(max_points):
+    x, y = random_stream(100, seed=2)
+
+    with pytest.raises(ValueError):
+        lttb_indices(x, y, max_points)
+
+def test_endpoint_rejects_too_few_points(make_user, login):
+    user = make_user()
+    client = login(user)
+
+    assert client.get("/api/activities/1/hr_data?max_points=2").status_code == 400
+    assert client.get("/api/activities/1/hr_data?max_points=-5").status_code == 400
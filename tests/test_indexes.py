@@ -0,0 +1,70 @@
+import re
+import pytest
+from sqlalchemy import event
+from app import db
+from tests.test_deferred_columns import add_activities
+
+@pytest.fixture
+def query_plans(app_context):
+    """Record the activity and rollup SELECTs the test runs, with their parameters"""
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and (
+            "FROM activity" in statement or "FROM daily_zone_rollup" in statement
+        ):
+            executed.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(db.engine, "before_cursor_execute", record)
+
+def explain(statement, parameters):
+    with db.engine.connect() as connection:
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    return " / ".join(row[-1] for row in rows)
+
+# Query kind -> the index its plan must search
+ALL_TYPES = {
+    "list": "ix_activity_user_hr_start",
+    "totals": "ix_activity_user_hr_start",
+    "types": "ix_activity_user_hr_type_start",
+    "fingerprint": "ix_activity_user_id",
+    "rollup": "sqlite_autoindex_daily_zone_rollup_1",
+}
+ONE_TYPE = dict(ALL_TYPES, list="ix_activity_user_hr_type_start", totals="ix_activity_user_hr_type_start")
+
+def query_kind(statement):
+    if "FROM daily_zone_rollup" in statement:
+        return "rollup"
+    if "DISTINCT activity.type" in statement:
+        return "types"
+    if "count(activity.id)" in statement:
+        return "fingerprint"
+    if "sum(activity.zone1_s)" in statement:
+        return "totals"
+    return "list"
+
+@pytest.mark.parametrize("path,kinds,indexes", [
+    ("/dashboard", {"list", "types", "fingerprint", "rollup", "totals"}, ALL_TYPES),
+    ("/dashboard?days=90&type=Run", {"list", "types", "fingerprint", "rollup", "totals"}, ONE_TYPE),
+    ("/api/dashboard/zone_summary", {"fingerprint", "rollup", "totals"}, ALL_TYPES),
+    ("/api/dashboard/zone_summary?days=7&type=Run", {"fingerprint", "rollup", "totals"}, ONE_TYPE),
+    ("/api/dashboard/zone_trends", {"fingerprint", "rollup"}, ALL_TYPES),
+    ("/api/dashboard/zone_trends?period=month&type=Ride", {"fingerprint", "rollup"}, ONE_TYPE),
+])
+def test_dashboard_queries_search_indexes(make_user, login, query_plans, path, kinds, indexes):
+    user = make_user()
+    add_activities(user, 3)
+    client = login(user)
+    query_plans.clear()
+
+    assert client.get(path).status_code == 200
+
+    plans = {query_kind(statement): explain(statement, parameters) for statement, parameters in query_plans}
+    assert set(plans) == kinds
+    for kind, plan in plans.items():
+        assert re.search(rf"SEARCH \w+ USING (COVERING )?INDEX {indexes[kind]} ", plan), f"{kind}: {plan}"
+        # No full scans, and the list is read in index order without a sort
+        assert not re.search(r"SCAN (activity|daily_zone_rollup)\b", plan), f"{kind}: {plan}"
+        assert "TEMP B-TREE" not in plan, f"{kind}: {plan}"
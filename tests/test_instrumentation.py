@@ -0,0 +1,41 @@
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+import instrumentation
+
+@pytest.fixture
+def timed_engine(monkeypatch):
+    """An engine with the statement timing hooks, recording into a list"""
+    recorded = []
+    monkeypatch.setattr(instrumentation, "record", lambda operation, seconds: recorded.append((operation, seconds)))
+    engine = create_engine("sqlite://")
+    # With METRICS_ENABLED the hooks are already installed on every engine
+    if not event.contains(Engine, "before_cursor_execute", instrumentation._before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", instrumentation._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", instrumentation._after_cursor_execute)
+    yield engine, recorded
+    engine.dispose()
+
+def test_statements_are_timed(timed_engine):
+    engine, recorded = timed_engine
+
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        connection.execute(text("SELECT 2"))
+
+    assert [operation for operation, _ in recorded] == ["db", "db"]
+    assert all(seconds >= 0 for _, seconds in recorded)
+
+def test_failing_statements_leave_nothing_on_the_connection(timed_engine):
+    engine, recorded = timed_engine
+
+    with engine.connect() as connection:
+        info = dict(connection.info)
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM missing_table"))
+        connection.execute(text("SELECT 1"))
+
+        assert dict(connection.info) == info
+    assert len(recorded) == 1
@@ -0,0 +1,34 @@
+from sqlalchemy import select
+import zone_calculator
+from app import db
+from models import Activity, HeartRateZones
+from tests.legacy_zones import synthetic_stream
+
+def test_zone_version_is_published_with_recalculated_zones(make_user, login, monkeypatch):
+    user = make_user(max_hr=190)
+    activity = Activity(strava_id=8_000_000 + user.id, user_id=user.id, name="Ride", type="Ride", has_heartrate=True)
+    activity.set_hr_data(synthetic_stream(500))
+    db.session.add(activity)
+    db.session.commit()
+    old_version = HeartRateZones.query.filter_by(user_id=user.id).one().version
+
+    seen_during_recalculation = []
+    batch = zone_calculator.calculate_activity_zones_batch
+
+    def observe(zones, streams):
+        # What another worker serving a chart request would read right now
+        with db.engine.connect() as connection:
+            seen_during_recalculation.append(connection.execute(
+                select(HeartRateZones.version).where(HeartRateZones.user_id == user.id)
+            ).scalar())
+        return batch(zones, streams)
+
+    monkeypatch.setattr(zone_calculator, "calculate_activity_zones_batch", observe)
+    response = login(user).post("/profile", data={"max_hr": "175"})
+
+    assert response.status_code == 302
+    assert seen_during_recalculation == [old_version]
+    db.session.expire_all()
+    zones = HeartRateZones.query.filter_by(user_id=user.id).one()
+    assert (zones.max_hr, zones.version) == (175, old_version + 1)
+    assert db.session.get(Activity, activity.id).get_zone_data()["zone_ranges"]["zone5"]["min"] == 155
@@ -0,0 +1,125 @@
+from datetime import datetime, time, timedelta
+import pytest
+import rate_limit
+from app import app, db
+from models import Activity, StravaRateLimit
+from sync_queue import JOB_DONE, JOB_QUEUED, claim_next_job, enqueue_sync, run_job
+
+@pytest.fixture(autouse=True)
+def sequential_fetches(monkeypatch):
+    # One stream request at a time, so the stored activities are deterministic
+    monkeypatch.setitem(app.config, "STRAVA_FETCH_CONCURRENCY", 1)
+    monkeypatch.setitem(app.config, "STRAVA_RATE_LIMIT_RESERVE", 0.25)
+
+def add_history(fake, user, count, days=30):
+    start = datetime.utcnow() - timedelta(days=days)
+    fake.add_athlete(user)
+    for i in range(count):
+        fake.add_activity(user.strava_id, user.strava_id * 1000 + i, start + timedelta(hours=6 * i), samples=600)
+
+def run(user_id, kind, **payload):
+    job = enqueue_sync(user_id, kind=kind, payload=payload or None)
+    assert claim_next_job().id == job.id
+    return run_job(job)
+
+def next_window(fake, job):
+    """Let 15 minutes pass for the budget, Strava and the deferred job"""
+    row = db.session.get(StravaRateLimit, rate_limit.ROW_ID)
+    row.window_start -= timedelta(minutes=15)
+    job.run_after = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    fake.new_window()
+
+def test_backfill_is_deferred_within_its_share_and_resumes(make_user, fake_strava):
+    fake_strava.limit_15min = 10
+    user = make_user()
+    add_history(fake_strava, user, 20)
+
+    job = run(user.id, "backfill", days=60)
+
+    # Background work stops at 75% of the window: the list and 7 streams
+    assert len(fake_strava.api_requests()) == 8
+    assert fake_strava.rejected == 0
+    assert job.status == JOB_QUEUED
+    window_start, _ = rate_limit.window_bounds(datetime.utcnow())
+    assert job.run_after == window_start + timedelta(minutes=15)
+    # Activities fetched before the budget ran out are kept
+    assert Activity.query.filter_by(user_id=user.id).count() == 7
+    assert claim_next_job() is None
+
+    rounds = 1
+    while job.status == JOB_QUEUED:
+        next_window(fake_strava, job)
+        requests_before = len(fake_strava.api_requests())
+        assert claim_next_job().id == job.id
+        run_job(job)
+        assert len(fake_strava.api_requests()) - requests_before <= 8
+        rounds += 1
+
+    assert job.status == JOB_DONE and rounds == 3
+    assert fake_strava.rejected == 0
+    assert Activity.query.filter_by(user_id=user.id).count() == 20
+    # Every activity's stream was fetched exactly once
+    assert len(fake_strava.api_requests("/streams")) == 20
+
+def test_interactive_sync_uses_the_reserve(make_user, fake_strava):
+    fake_strava.limit_15min = 10
+    backfilled, interactive = make_user(), make_user()
+    add_history(fake_strava, backfilled, 20)
+    add_history(fake_strava, interactive, 1, days=2)
+
+    assert run(backfilled.id, "backfill", days=60).status == JOB_QUEUED
+    job = run(interactive.id, "sync")
+
+    assert job.status == JOB_DONE and job.new_activities == 1
+    assert fake_strava.usage_15min == 10
+
+    # The window is now used up for everyone, without a request being sent
+    with pytest.raises(rate_limit.RateLimitExceeded):
+        rate_limit.acquire(rate_limit.INTERACTIVE)
+    assert fake_strava.usage_15min == 10
+
+def test_daily_limit_defers_until_midnight(make_user, fake_strava):
+    fake_strava.limit_daily = 5
+    user = make_user()
+    add_history(fake_strava, user, 10)
+
+    job = run(user.id, "sync")
+
+    assert job.status == JOB_QUEUED
+    assert job.run_after == datetime.combine(datetime.utcnow().date() + timedelta(days=1), time.min)
+    assert len(fake_strava.api_requests()) == 5 and fake_strava.rejected == 0
+
+def test_usage_reported_by_strava_corrects_the_budget(make_user, fake_strava):
+    # Another app sharing the client id already used most of the window
+    fake_strava.limit_15min = 10
+    fake_strava.usage_15min = 8
+    user = make_user()
+    add_history(fake_strava, user, 5)
+
+    job = run(user.id, "sync")
+
+    # The first response reports 9 of 10 used, so only one more request goes out
+    assert job.status == JOB_QUEUED
+    assert len(fake_strava.api_requests()) == 2
+    assert fake_strava.usage_15min == 10
+    budget = rate_limit.get_budget()
+    assert (budget["limit_15min"], budget["usage_15min"]) == (10, 10)
+
+def test_429_defers_the_job(make_user, fake_strava):
+    # Our budget believes in a larger quota than Strava grants
+    db.session.add(StravaRateLimit(
+        id=rate_limit.ROW_ID, window_start=rate_limit.window_bounds(datetime.utcnow())[0],
+        day=datetime.utcnow().date(), usage_15min=0, usage_daily=0, limit_15min=100, limit_daily=1000
+    ))
+    db.session.commit()
+    fake_strava.limit_15min = 3
+    fake_strava.usage_15min = 3
+    user = make_user()
+    add_history(fake_strava, user, 5)
+
+    job = run(user.id, "sync")
+
+    assert job.status == JOB_QUEUED and job.run_after > datetime.utcnow()
+    assert len(fake_strava.api_requests()) == 1 and fake_strava.rejected == 1
+    assert rate_limit.get_budget()["limit_15min"] == 3
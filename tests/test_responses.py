@@ -0,0 +1,157 @@
+import gzip
+import json
+import struct
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pytest
+import responses
+from app import db
+from models import Activity
+from rollups import add_activities_to_rollups
+from zone_calculator import calculate_activity_zones
+
+def add_activity(user, samples, strava_id):
+    times = np.arange(samples, dtype=np.int64)
+    hr_values = (140 + 30 * np.sin(times / 300)).astype(np.int64)
+    activity = Activity(
+        strava_id=strava_id,
+        user_id=user.id,
+        name="Run",
+        type="Run",
+        start_date=datetime.utcnow(),
+        has_heartrate=True,
+        stream_resolution="full"
+    )
+    activity.set_hr_data((times, hr_values))
+    activity.set_zone_data(calculate_activity_zones(user, (times, hr_values)))
+    db.session.add(activity)
+    add_activities_to_rollups([activity])
+    db.session.commit()
+    return activity
+
+@pytest.fixture
+def user(make_user):
+    return make_user()
+
+@pytest.fixture
+def activity(user):
+    return add_activity(user, 5000, 8_000_000 + user.id)
+
+def hr_data(client, activity, query="", **headers):
+    return client.get(f"/api/activities/{activity.id}/hr_data{query}", headers=headers)
+
+def decode_columnar(payload):
+    """Decode the columnar binary format the way charts.js does"""
+    header_length, = struct.unpack_from("<I", payload)
+    header = json.loads(payload[4:4 + header_length])
+    columns = {}
+    offset = 4 + header_length
+    for column in header["columns"]:
+        columns[column["name"]] = np.frombuffer(payload, dtype="<f4", count=column["length"], offset=offset)
+        offset += column["length"] * 4
+    assert offset == len(payload)
+    return header["meta"], columns
+
+def test_gzip_is_negotiated(user, activity, login):
+    client = login(user)
+
+    plain = hr_data(client, activity, "?max_points=0")
+    compressed = hr_data(client, activity, "?max_points=0", **{"Accept-Encoding": "gzip, deflate"})
+
+    assert "Content-Encoding" not in plain.headers
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in compressed.headers["Vary"]
+    assert gzip.decompress(compressed.get_data()) == plain.get_data()
+    assert len(compressed.get_data()) < len(plain.get_data()) / 2
+    assert compressed.headers["ETag"] != plain.headers["ETag"]
+
+def test_brotli_falls_back_to_gzip_when_not_installed(user, activity, login, monkeypatch):
+    monkeypatch.setattr(responses, "brotli", None)
+    client = login(user)
+
+    assert hr_data(client, activity, **{"Accept-Encoding": "br, gzip"}).headers["Content-Encoding"] == "gzip"
+    assert "Content-Encoding" not in hr_data(client, activity, **{"Accept-Encoding": "br"}).headers
+
+def test_brotli_is_preferred(user, activity, login):
+    brotli = pytest.importorskip("brotli")
+    client = login(user)
+
+    plain = hr_data(client, activity)
+    compressed = hr_data(client, activity, **{"Accept-Encoding": "gzip, br"})
+
+    assert compressed.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(compressed.get_data()) == plain.get_data()
+
+@pytest.mark.parametrize("query, headers", [
+    ("?format=binary", {}),
+    ("", {"Accept": "application/octet-stream"}),
+])
+def test_columnar_binary_matches_json(user, activity, login, query, headers):
+    client = login(user)
+
+    chart = hr_data(client, activity, "?max_points=0").get_json()
+    response = hr_data(client, activity, query + ("&" if query else "?") + "max_points=0", **headers)
+
+    assert response.mimetype == "application/octet-stream"
+    meta, columns = decode_columnar(response.get_data())
+    assert meta["total_points"] == 5000
+    assert meta["zone_lines"] == chart["datasets"][1:]
+    assert columns["time"].tolist() == chart["labels"]
+    assert columns["heartrate"].tolist() == chart["datasets"][0]["data"]
+
+def test_downsampled_binary_keeps_the_ends(user, activity, login):
+    client = login(user)
+
+    meta, columns = decode_columnar(hr_data(client, activity, "?format=binary&max_points=500").get_data())
+
+    assert len(columns["time"]) == 500
+    assert columns["time"][0] == 0 and columns["time"][-1] == 4999
+    assert meta["total_points"] == 5000
+
+def test_unchanged_stream_is_not_modified(user, activity, login):
+    client = login(user)
+
+    first = hr_data(client, activity)
+    again = hr_data(client, activity, **{"If-None-Match": first.headers["ETag"]})
+    binary = hr_data(client, activity, "?format=binary", **{"If-None-Match": first.headers["ETag"]})
+
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "private, no-cache"
+    assert again.status_code == 304
+    assert again.get_data() == b""
+    assert again.headers["ETag"] == first.headers["ETag"]
+    # Another representation has its own ETag
+    assert binary.status_code == 200
+
+def test_zone_trends_are_compressed(user, activity, login):
+    client = login(user)
+
+    plain = client.get("/api/dashboard/zone_trends")
+    compressed = client.get("/api/dashboard/zone_trends", headers={"Accept-Encoding": "gzip"})
+
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(compressed.get_data())) == plain.get_json()
+    assert plain.get_json()["activities"][-1] == 1
+    assert client.get("/api/dashboard/zone_trends", headers={
+        "Accept-Encoding": "gzip", "If-None-Match": compressed.headers["ETag"]
+    }).status_code == 304
+
+def peak_memory(client, activity, query):
+    tracemalloc.start()
+    try:
+        response = client.get(f"/api/activities/{activity.id}/hr_data{query}", buffered=False)
+        for _ in response.response:
+            pass
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+@pytest.mark.parametrize("query", ["?max_points=1000", "?max_points=0", "?max_points=0&format=binary"])
+def test_memory_does_not_grow_with_the_stream(user, login, query):
+    client = login(user)
+    short = add_activity(user, 20_000, 8_100_000 + user.id)
+    long = add_activity(user, 400_000, 8_200_000 + user.id)
+
+    # Decoded whole, the long stream alone would take 9 bytes per sample
+    assert peak_memory(client, long, query) < peak_memory(client, short, query) + 500_000
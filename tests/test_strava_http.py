@@ -0,0 +1,115 @@
+from datetime import datetime
+import pytest
+from requests.exceptions import ConnectTimeout, ReadTimeout
+import rate_limit
+import strava_http
+from rate_limit import RateLimitExceeded
+
+@pytest.fixture
+def strava(make_user, fake_strava, monkeypatch):
+    """The fake Strava behind a session retrying twice, with one activity of a user"""
+    session = strava_http.get_session()
+    monkeypatch.setattr(session, "retries", 2)
+    monkeypatch.setattr(session, "backoff", 0.5)
+    sleeps = []
+    monkeypatch.setattr(strava_http.time, "sleep", sleeps.append)
+
+    user = make_user()
+    fake_strava.add_athlete(user)
+    fake_strava.add_activity(user.strava_id, 4242, datetime.utcnow())
+    fake_strava.sleeps = sleeps
+    fake_strava.user = user
+    return fake_strava
+
+def get_activity(strava):
+    return strava_http.get_session().get(
+        "/api/v3/activities/4242", headers={"Authorization": f"Bearer {strava.user.access_token}"}
+    )
+
+def refresh_token(strava):
+    return strava_http.get_session().post("/oauth/token", data={"refresh_token": strava.user.refresh_token})
+
+def test_server_errors_are_retried_with_backoff(strava):
+    strava.fail_next(503, 502)
+
+    response = get_activity(strava)
+
+    assert response.status_code == 200
+    assert response.json()["id"] == 4242
+    assert len(strava.api_requests()) == 3
+    assert strava.sleeps == [0.5, 1.0]
+
+def test_retries_give_up_after_the_configured_attempts(strava):
+    strava.fail_next(500, 500, 500, 500)
+
+    assert get_activity(strava).status_code == 500
+    assert len(strava.api_requests()) == 3
+
+    strava.fail_next(ReadTimeout(), ReadTimeout(), ReadTimeout())
+    with pytest.raises(ReadTimeout):
+        get_activity(strava)
+    assert strava.sleeps == [0.5, 1.0] * 2
+
+def test_every_attempt_is_taken_from_the_budget(strava, monkeypatch):
+    acquired = []
+    acquire = rate_limit.acquire
+    monkeypatch.setattr(rate_limit, "acquire", lambda priority=None: acquired.append(priority) or acquire(priority))
+    strava.fail_next(503, ReadTimeout())
+
+    assert get_activity(strava).status_code == 200
+    assert len(acquired) == len(strava.api_requests()) == 3
+
+def test_retries_stop_when_the_budget_is_used_up(strava):
+    strava.limit_15min = 2
+    strava.fail_next(503, 503, 503)
+
+    with pytest.raises(RateLimitExceeded):
+        get_activity(strava)
+
+    # The third attempt is not sent, instead of being rejected by Strava
+    assert len(strava.api_requests()) == 2
+    assert strava.rejected == 0
+
+def test_read_timeouts_are_retried_for_gets_only(strava):
+    strava.fail_next(ReadTimeout())
+    assert get_activity(strava).status_code == 200
+    assert len(strava.api_requests()) == 2
+
+    # A token POST may have been processed, so it isn't sent twice
+    strava.fail_next(ReadTimeout())
+    with pytest.raises(ReadTimeout):
+        refresh_token(strava)
+    strava.fail_next(503)
+    assert refresh_token(strava).status_code == 503
+    assert len([r for r in strava.requests if r[1] == "/oauth/token"]) == 2
+
+def test_connect_timeouts_are_retried_for_any_method(strava):
+    strava.fail_next(ConnectTimeout())
+    assert refresh_token(strava).status_code == 200
+
+    strava.fail_next(ConnectTimeout(), ConnectTimeout())
+    assert get_activity(strava).status_code == 200
+
+    assert len([r for r in strava.requests if r[1] == "/oauth/token"]) == 1
+    assert len(strava.api_requests()) == 1
+    assert strava.sleeps == [0.5, 0.5, 1.0]
+
+def test_requests_get_the_session_timeout(strava):
+    get_activity(strava)
+    strava_http.get_session().get("/api/v3/activities/4242", timeout=(2, 60))
+    refresh_token(strava)
+
+    assert strava.timeouts == [(1, 1), (2, 60), (1, 1)]
+
+def test_session_uses_the_http_settings(app, monkeypatch):
+    monkeypatch.setitem(app.config, "STRAVA_CONNECT_TIMEOUT", 3)
+    monkeypatch.setitem(app.config, "STRAVA_READ_TIMEOUT", 20)
+    monkeypatch.setitem(app.config, "STRAVA_HTTP_RETRIES", 4)
+    monkeypatch.setitem(app.config, "STRAVA_HTTP_BACKOFF", 0.25)
+
+    session = strava_http.create_session()
+
+    assert session.timeout == (3, 20)
+    assert (session.retries, session.backoff) == (4, 0.25)
+    # urllib3 must not retry on its own, those attempts would bypass the budget
+    assert session.get_adapter("https://www.strava.com").max_retries.total == 0
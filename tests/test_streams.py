@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+import pytest
+from app import app, db
+from models import Activity
+from sync_queue import JOB_DONE, claim_next_job, enqueue_sync, run_job
+
+@pytest.fixture
+def history(make_user, fake_strava):
+    """A user with three heart rate activities of an hour (3600 samples) on Strava"""
+    user = make_user()
+    fake_strava.add_athlete(user)
+    for i in range(3):
+        fake_strava.add_activity(user.strava_id, user.strava_id * 10 + i, datetime.utcnow() - timedelta(days=i + 1))
+    return user
+
+def sync(user):
+    job = enqueue_sync(user.id)
+    assert claim_next_job().id == job.id
+    assert run_job(job).status == JOB_DONE
+
+def stream_requests(fake_strava):
+    return [query for _, path, query in fake_strava.api_requests("/streams")]
+
+def test_eager_sync_stores_detail_streams(history, fake_strava):
+    sync(history)
+
+    assert [query["resolution"] for query in stream_requests(fake_strava)] == ["high"] * 3
+    for activity in Activity.query.filter_by(user_id=history.id):
+        assert activity.stream_resolution == "high"
+        assert len(activity.get_hr_array()[0]) == 3600
+
+def test_full_detail_resolution_requests_every_sample(history, fake_strava, monkeypatch):
+    monkeypatch.setitem(app.config, "STRAVA_DETAIL_STREAM_RESOLUTION", "full")
+
+    sync(history)
+
+    assert all("resolution" not in query for query in stream_requests(fake_strava))
+    assert {a.stream_resolution for a in Activity.query.filter_by(user_id=history.id)} == {"full"}
+
+def test_lazy_sync_stores_coarse_streams(history, fake_strava, monkeypatch):
+    monkeypatch.setitem(app.config, "STRAVA_STREAM_HYDRATION", "lazy")
+    monkeypatch.setitem(app.config, "STRAVA_PREFETCH_DAYS", 0)
+
+    sync(history)
+
+    assert [query["resolution"] for query in stream_requests(fake_strava)] == ["medium"] * 3
+    for activity in Activity.query.filter_by(user_id=history.id):
+        assert activity.stream_resolution == "medium"
+        assert len(activity.get_hr_array()[0]) == 1000
+
+def test_lazy_sync_uses_low_resolution_only_when_configured(history, fake_strava, monkeypatch):
+    monkeypatch.setitem(app.config, "STRAVA_STREAM_HYDRATION", "lazy")
+    monkeypatch.setitem(app.config, "STRAVA_STREAM_RESOLUTION", "low")
+    monkeypatch.setitem(app.config, "STRAVA_PREFETCH_DAYS", 0)
+
+    sync(history)
+
+    assert [query["resolution"] for query in stream_requests(fake_strava)] == ["low"] * 3
+    for activity in Activity.query.filter_by(user_id=history.id):
+        assert activity.stream_resolution == "low"
+        assert len(activity.get_hr_array()[0]) == 100
+
+def test_coarse_streams_are_hydrated_on_view_in_eager_mode(history, fake_strava, login, monkeypatch):
+    # Stored by a lazy sync, or before sync stored detail streams
+    monkeypatch.setitem(app.config, "STRAVA_STREAM_HYDRATION", "lazy")
+    monkeypatch.setitem(app.config, "STRAVA_STREAM_RESOLUTION", "medium")
+    monkeypatch.setitem(app.config, "STRAVA_PREFETCH_DAYS", 0)
+    sync(history)
+    monkeypatch.setitem(app.config, "STRAVA_STREAM_HYDRATION", "eager")
+    activity = Activity.query.filter_by(user_id=history.id).first()
+    fake_strava.requests.clear()
+
+    response = login(history).get(f"/api/activities/{activity.id}/hr_data?max_points=0")
+
+    assert response.status_code == 200
+    assert [query["resolution"] for query in stream_requests(fake_strava)] == ["high"]
+    db.session.expire_all()
+    activity = db.session.get(Activity, activity.id)
+    assert activity.stream_resolution == "high" and len(activity.get_hr_array()[0]) == 3600
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+import pytest
+import strava_client
+from app import db
+from models import Activity
+
+def summary(strava_id, start_date, has_heartrate=False):
+    return {
+        "id": strava_id,
+        "name": f"Ride {strava_id}",
+        "type": "Ride",
+        "distance": 10000.0,
+        "moving_time": 1800,
+        "elapsed_time": 1900,
+        "start_date": start_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "has_heartrate": has_heartrate,
+    }
+
+def activity_lookups(statements):
+    """The statements that look up stored activities by Strava id"""
+    return [
+        statement for statement in statements
+        if statement.lstrip().upper().startswith("SELECT")
+        and "FROM activity" in statement and "activity.strava_id IN" in statement
+    ]
+
+@pytest.fixture
+def fake_fetch(monkeypatch):
+    """Answer detail fetches from the summaries without calling Strava"""
+    fetched = []
+
+    def fetch(access_token, activities, max_workers):
+        fetched.extend(a["id"] for a in activities)
+        return [(a, None) for a in activities]
+
+    monkeypatch.setattr(strava_client, "fetch_activity_details_concurrently", fetch)
+    monkeypatch.setattr(strava_client, "refresh_strava_token", lambda user: True)
+    return fetched
+
+@pytest.mark.parametrize("page_size", [1, 30, 200])
+def test_one_lookup_per_page(make_user, fake_fetch, statements, page_size):
+    user = make_user()
+    start = datetime(2026, 1, 1)
+    summaries = [summary(5_000_000 + i, start + timedelta(hours=i)) for i in range(page_size)]
+    # Half of the page is stored already
+    for strava_activity in summaries[::2]:
+        db.session.add(strava_client.build_activity(user, strava_activity, (strava_activity, None), None))
+    db.session.commit()
+    statements.clear()
+
+    new_count, failed = strava_client.store_new_activities(user, summaries, concurrency=1)
+
+    assert len(activity_lookups(statements)) == 1
+    assert new_count == len(summaries[1::2]) and failed == []
+    assert fake_fetch == [a["id"] for a in summaries[1::2]]
+    # Nothing else reads the activity table per summary
+    assert sum("FROM activity" in statement for statement in statements) <= 1
+
+def test_known_page_is_resolved_without_fetching(make_user, fake_fetch, statements):
+    user = make_user()
+    start = datetime(2026, 2, 1)
+    summaries = [summary(6_000_000 + i, start + timedelta(hours=i)) for i in range(50)]
+    for strava_activity in summaries:
+        db.session.add(strava_client.build_activity(user, strava_activity, (strava_activity, None), None))
+    db.session.commit()
+    statements.clear()
+
+    assert strava_client.store_new_activities(user, summaries) == (0, [])
+    assert statements == activity_lookups(statements) and len(statements) == 1
+    assert fake_fetch == []
+    assert Activity.query.filter_by(user_id=user.id).count() == 50
+
+def store_elsewhere(user, strava_activity):
+    """Commit an activity from another session, like a concurrent worker would"""
+    from sqlalchemy.orm import Session
+
+    with Session(db.engine) as other:
+        other.add(strava_client.build_activity(user, strava_activity, (strava_activity, None), None))
+        other.commit()
+
+def test_activities_stored_by_a_concurrent_worker_are_skipped(make_user, monkeypatch):
+    user = make_user()
+    start = datetime(2026, 3, 1)
+    summaries = [summary(9_000_000 + i, start + timedelta(hours=i)) for i in range(5)]
+
+    def fetch(access_token, activities, max_workers):
+        # Another job stores two of them after this page looked them up
+        store_elsewhere(user, activities[1])
+        store_elsewhere(user, activities[3])
+        return [(a, None) for a in activities]
+
+    monkeypatch.setattr(strava_client, "fetch_activity_details_concurrently", fetch)
+    monkeypatch.setattr(strava_client, "refresh_strava_token", lambda user: True)
+
+    new_count, failed = strava_client.store_new_activities(user, summaries)
+
+    assert (new_count, failed) == (3, [])
+    db.session.expire_all()
+    stored = Activity.query.filter_by(user_id=user.id).order_by(Activity.strava_id).all()
+    assert [a.strava_id for a in stored] == [a["id"] for a in summaries]
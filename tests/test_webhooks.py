@@ -0,0 +1,191 @@
+from datetime import datetime, timedelta
+import pytest
+from app import db
+from models import Activity, DailyZoneRollup, StravaEvent, User
+from sync_queue import JOB_DONE, JOB_FAILED
+from webhooks import run_pending_events
+
+@pytest.fixture(autouse=True)
+def clean_events(app_context):
+    yield
+    db.session.rollback()
+    StravaEvent.query.delete()
+    db.session.commit()
+
+_event_times = iter(range(1760000000, 1770000000))
+
+def post_event(app, owner, object_id, aspect_type, object_type="activity", **updates):
+    """Deliver an event to /webhook like Strava (or anyone else) would, then process it"""
+    response = app.test_client().post("/webhook", json={
+        "object_type": object_type,
+        "object_id": object_id,
+        "aspect_type": aspect_type,
+        "owner_id": owner.strava_id,
+        "event_time": next(_event_times),
+        "updates": updates,
+    })
+    assert response.status_code == 200
+    run_pending_events()
+    return StravaEvent.query.order_by(StravaEvent.id.desc()).first()
+
+def rollup_seconds(user):
+    return db.session.query(db.func.sum(DailyZoneRollup.total_s)).filter_by(user_id=user.id).scalar() or 0
+
+@pytest.fixture
+def synced(app, make_user, fake_strava):
+    """A user with one activity stored through a webhook create"""
+    user = make_user()
+    fake_strava.add_athlete(user)
+    fake_strava.add_activity(user.strava_id, user.strava_id * 10, datetime.utcnow() - timedelta(days=1))
+    assert post_event(app, user, user.strava_id * 10, "create").status == JOB_DONE
+    return user, Activity.query.filter_by(strava_id=user.strava_id * 10).one()
+
+def test_create_stores_the_owners_activity(synced):
+    user, activity = synced
+
+    assert activity.user_id == user.id and activity.has_heartrate
+    assert activity.total_s > 0 and rollup_seconds(user) == activity.total_s
+
+def test_forged_delete_keeps_the_activity(app, synced, fake_strava):
+    user, activity = synced
+
+    event = post_event(app, user, activity.strava_id, "delete")
+
+    assert event.status == JOB_FAILED and "still exists" in event.error
+    assert db.session.get(Activity, activity.id) is not None
+    assert rollup_seconds(user) == activity.total_s
+    # Confirmed with the owner's token
+    assert fake_strava.api_requests(f"/activities/{activity.strava_id}")
+
+def test_delete_confirmed_by_strava(app, synced, fake_strava):
+    user, activity = synced
+    del fake_strava.activities[activity.strava_id]
+
+    assert post_event(app, user, activity.strava_id, "delete").status == JOB_DONE
+    assert Activity.query.filter_by(strava_id=activity.strava_id).first() is None
+    assert rollup_seconds(user) == 0
+
+def test_forged_deauthorization_keeps_the_tokens(app, synced):
+    user, _ = synced
+
+    event = post_event(app, user, user.strava_id, "update", object_type="athlete", authorized="false")
+
+    assert event.status == JOB_FAILED
+    user = db.session.get(User, user.id)
+    assert user.access_token and user.refresh_token
+
+def test_deauthorization_confirmed_by_strava(app, synced, fake_strava):
+    user, _ = synced
+    fake_strava.refresh_tokens.pop(user.refresh_token)
+
+    assert post_event(app, user, user.strava_id, "update", object_type="athlete", authorized="false").status == JOB_DONE
+    user = db.session.get(User, user.id)
+    assert (user.access_token, user.refresh_token, user.token_expiry) == (None, None, None)
+
+def test_create_of_another_athletes_activity_is_rejected(app, synced, make_user, fake_strava):
+    victim, _ = synced
+    other = make_user()
+    fake_strava.add_athlete(other)
+    fake_strava.add_activity(other.strava_id, other.strava_id * 10, datetime.utcnow())
+
+    # A public activity of another athlete posted under the victim's id
+    event = post_event(app, victim, other.strava_id * 10, "create")
+
+    assert event.status == JOB_FAILED and "doesn't belong" in event.error
+    assert Activity.query.filter_by(strava_id=other.strava_id * 10).first() is None
+
+def test_update_applies_what_strava_has(app, synced, fake_strava):
+    user, activity = synced
+    fake_strava.activities[activity.strava_id].update(name="Morning Run", type="Run")
+
+    event = post_event(app, user, activity.strava_id, "update", title="Forged title", type="Swim")
+
+    assert event.status == JOB_DONE
+    activity = db.session.get(Activity, activity.id)
+    assert (activity.name, activity.type) == ("Morning Run", "Run")
+    counts = db.session.query(DailyZoneRollup.activity_type, DailyZoneRollup.activity_count).filter_by(user_id=user.id)
+    assert dict(counts.all()) == {"Ride": 0, "Run": 1}
+
+def test_create_racing_a_sync_is_not_a_failure(app, make_user, fake_strava, monkeypatch):
+    import strava_client
+    from sqlalchemy.orm import Session
+
+    user = make_user()
+    fake_strava.add_athlete(user)
+    summary = fake_strava.add_activity(user.strava_id, user.strava_id * 10, datetime.utcnow())
+    fetch = strava_client.fetch_activity_details
+
+    def fetch_while_a_sync_stores_it(access_token, activity_id, summary=None):
+        with Session(db.engine) as other:
+            other.add(strava_client.build_activity(user, fake_strava.activities[activity_id], (fake_strava.activities[activity_id], None), None))
+            other.commit()
+        return fetch(access_token, activity_id, summary)
+
+    monkeypatch.setattr(strava_client, "fetch_activity_details", fetch_while_a_sync_stores_it)
+
+    assert post_event(app, user, summary["id"], "create").status == JOB_DONE
+    assert Activity.query.filter_by(strava_id=summary["id"]).count() == 1
+
+@pytest.mark.parametrize("aspect_type", ["create", "update", "delete"])
+def test_events_are_confirmed_at_background_priority(app, synced, fake_strava, monkeypatch, aspect_type):
+    import rate_limit
+
+    user, activity = synced
+    priorities = []
+    acquire = rate_limit.acquire
+    monkeypatch.setattr(rate_limit, "acquire", lambda priority=None: priorities.append(
+        priority or rate_limit.current_priority()) or acquire(priority))
+
+    object_id = activity.strava_id
+    if aspect_type == "create":
+        object_id = fake_strava.add_activity(user.strava_id, object_id + 1, datetime.utcnow())["id"]
+
+    post_event(app, user, object_id, aspect_type)
+
+    assert priorities and set(priorities) == {rate_limit.BACKGROUND}
+
+def test_events_leave_the_interactive_reserve_alone(app, synced, fake_strava):
+    import rate_limit
+    from models import StravaRateLimit
+    from sync_queue import JOB_QUEUED
+
+    user, activity = synced
+    # 80 of 100 requests used: past the background share, within the reserve
+    now = datetime.utcnow()
+    window_start, day = rate_limit.window_bounds(now)
+    db.session.merge(StravaRateLimit(id=rate_limit.ROW_ID, window_start=window_start, day=day,
+                                     usage_15min=80, usage_daily=80, limit_15min=100, limit_daily=1000))
+    db.session.commit()
+    requests_before = len(fake_strava.api_requests())
+
+    event = post_event(app, user, activity.strava_id, "update", title="Forged")
+
+    assert event.status == JOB_QUEUED and event.run_after > now
+    assert len(fake_strava.api_requests()) == requests_before
+    rate_limit.acquire(rate_limit.INTERACTIVE)
+
+def test_redelivered_event_is_stored_and_processed_once(app, make_user, fake_strava):
+    user = make_user()
+    fake_strava.add_athlete(user)
+    summary = fake_strava.add_activity(user.strava_id, user.strava_id * 10, datetime.utcnow())
+    payload = {
+        "object_type": "activity",
+        "object_id": summary["id"],
+        "aspect_type": "create",
+        "owner_id": user.strava_id,
+        "event_time": next(_event_times),
+        "updates": {},
+    }
+    client = app.test_client()
+
+    first = client.post("/webhook", json=payload)
+    second = client.post("/webhook", json=payload)
+    processed = run_pending_events()
+    # Strava may also redeliver after the event was processed
+    third = client.post("/webhook", json=payload)
+
+    assert (first.get_json(), second.get_json(), third.get_json()) == ({"queued": True}, {"queued": False}, {"queued": False})
+    assert processed == 1 and run_pending_events() == 0
+    assert StravaEvent.query.filter_by(object_id=summary["id"]).count() == 1
+    assert len(fake_strava.api_requests(f"/activities/{summary['id']}")) == 2  # The detail and its stream
+    assert Activity.query.filter_by(strava_id=summary["id"]).count() == 1
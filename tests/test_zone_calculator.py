@@ -0,0 +1,73 @@
+import json
+import numpy as np
+import pytest
+from hr_stream import points_to_arrays
+from models import Activity, HeartRateZones, NumpyEncoder
+from tests.legacy_zones import legacy_zone_data, synthetic_stream
+from zone_calculator import calculate_activity_zones, calculate_activity_zones_batch
+
+def zones_for(max_hr):
+    return HeartRateZones(max_hr=max_hr).calculate_zones()
+
+def stored(zone_data):
+    """The zone data as Activity.set_zone_data stores it"""
+    return json.dumps(zone_data, cls=NumpyEncoder)
+
+# max HR 100 puts zone1's 90bpm floor above zone2's min
+@pytest.mark.parametrize("max_hr", [100, 150, 190])
+@pytest.mark.parametrize("samples", [1, 2, 10, 1000, 14000])
+@pytest.mark.parametrize("float_times,float_hr", [(False, False), (False, True), (True, False), (True, True)])
+def test_matches_legacy_loop(max_hr, samples, float_times, float_hr):
+    zones = zones_for(max_hr)
+    hr_data = synthetic_stream(samples, seed=samples + max_hr, float_times=float_times, float_hr=float_hr)
+
+    expected = stored(legacy_zone_data(hr_data, zones))
+    assert stored(calculate_activity_zones(None, hr_data, zones)) == expected
+    assert stored(calculate_activity_zones(None, points_to_arrays(hr_data), zones)) == expected
+
+def test_hr_on_zone_edges():
+    zones = zones_for(180)
+    edges = [zones[zone]["min"] for zone in ("zone1", "zone2", "zone3", "zone4", "zone5")]
+    hr_data = [[i, hr] for i, hr in enumerate([60] + [edge + offset for edge in edges for offset in (-1, 0, 1)])]
+
+    assert stored(calculate_activity_zones(None, hr_data, zones)) == stored(legacy_zone_data(hr_data, zones))
+
+def test_batch_of_ragged_streams_matches_legacy_loop():
+    zones = zones_for(185)
+    streams = [
+        synthetic_stream(5000, seed=1),
+        [],
+        synthetic_stream(1, seed=2),
+        synthetic_stream(37, seed=3, float_hr=True),
+        synthetic_stream(2, seed=4, float_times=True),
+        synthetic_stream(12000, seed=5, float_times=True, float_hr=True),
+    ]
+
+    results = calculate_activity_zones_batch(zones, [points_to_arrays(stream) for stream in streams])
+
+    assert [stored(result) for result in results] == [
+        stored(legacy_zone_data(stream, zones)) if stream else stored(None) for stream in streams
+    ]
+
+def test_points_with_extra_fields():
+    zones = zones_for(170)
+    hr_data = [(0, 100, "a"), [5, 130], (9, 150.5, None), [12, 171]]
+
+    assert stored(calculate_activity_zones(None, hr_data, zones)) == stored(legacy_zone_data(hr_data, zones))
+
+def test_points_to_arrays_keeps_column_types():
+    times, hr_values = points_to_arrays([[0, 120.5], [1, 121.0], [11, 130.0]])
+
+    assert np.issubdtype(times.dtype, np.integer)
+    assert hr_values.dtype == np.float64
+
+@pytest.mark.parametrize("hr_data", [
+    [[0, 120], [1, 121], [11, 130]],
+    [[0, 120.5], [1, 121.0], [11, 130.0]],
+    [[0.5, 120], [1.5, 121], [11.0, 130]],
+])
+def test_hr_data_round_trip(app_context, hr_data):
+    activity = Activity(strava_id=1)
+    activity.set_hr_data(hr_data)
+
+    assert json.dumps(activity.get_hr_data()) == json.dumps(hr_data)
@@ -0,0 +1,40 @@
+# URL rules of the views in routes.py
+#
+# Views are registered as LazyView objects (Flask's lazy loading pattern), so
+# routes.py and everything it imports (NumPy, the zone calculator, the sync
+# queue) is only loaded when the first request reaches one of its views
+# rather than when a worker boots.
+from werkzeug.utils import cached_property, import_string
+
+class LazyView:
+    """View function that is imported on its first call"""
+
+    def __init__(self, import_name):
+        self.__module__, self.__name__ = import_name.rsplit(".", 1)
+        self.import_name = import_name
+
+    @cached_property
+    def view(self):
+        return import_string(self.import_name)
+
+    def __call__(self, *args, **kwargs):
+        return self.view(*args, **kwargs)
+
+# (rule, view name in routes.py, options)
+URL_RULES = [
+    ('/', 'index', {}),
+    ('/dashboard', 'dashboard', {}),
+    ('/activity/<int:activity_id>', 'activity_detail', {}),
+    ('/profile', 'profile', {'methods': ['GET', 'POST']}),
+    ('/api/activities/<int:activity_id>/hr_data', 'get_activity_hr_data', {}),
+    ('/api/dashboard/zone_summary', 'zone_summary_data', {}),
+    ('/api/dashboard/zone_trends', 'zone_trends_data', {}),
+    ('/api/sync/status', 'sync_status', {}),
+    ('/api/cache/stats', 'cache_stats', {}),
+    ('/webhook', 'strava_webhook', {'methods': ['GET', 'POST']}),
+]
+
+def register_routes(app):
+    """Add the routes.py views to the app, imported lazily"""
+    for rule, name, options in URL_RULES:
+        app.add_url_rule(rule, name, view_func=LazyView(f"routes.{name}"), **options)
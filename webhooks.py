@@ -0,0 +1,305 @@
+# Strava webhook events
+#
+# With a push subscription (flask --app main webhook-subscribe) Strava posts
+# an event to /webhook whenever one of our athletes creates, edits or deletes
+# an activity, or deauthorizes the app. The view only stores the event, so it
+# answers within Strava's two second deadline; the sync workers then process
+# it, fetching details and streams for that one activity instead of listing
+# the athlete's recent activities.
+#
+# Strava doesn't sign its posts, so anyone can send us an event and the
+# payload is only a hint of what to look at. Every event is confirmed with
+# Strava using the owner's token before acting on it: created activities must
+# belong to the owner, edits are read from Strava rather than the payload,
+# an activity is only deleted once Strava answers 404 for it, and tokens are
+# only cleared once Strava rejects the owner's refresh token.
+#
+# Strava retries deliveries, so events are unique on (object, aspect, event
+# time) and duplicates are acknowledged without being stored again. Processing
+# is idempotent as well: a create for a stored activity or a delete of a
+# missing one does nothing.
+import json
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from cache import invalidate_user
+from hydration import queue_prefetch
+from models import Activity, StravaEvent, User
+from rate_limit import BACKGROUND, RateLimitExceeded, request_priority
+from rollups import add_activities_to_rollups, remove_activities_from_rollups
+from stream_cache import stream_cache
+from sync_queue import JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING
+
+logger = logging.getLogger(__name__)
+
+EVENT_IGNORED = "ignored"
+REQUIRED_FIELDS = ("object_type", "object_id", "aspect_type", "owner_id", "event_time")
+
+def verify_subscription(mode, verify_token, challenge):
+    """
+    Answer the validation request Strava sends when a subscription is created
+    Returns the challenge to echo back, None if the request isn't ours
+    """
+    expected = app.config["STRAVA_WEBHOOK_VERIFY_TOKEN"]
+    if mode != "subscribe" or not expected or verify_token != expected or not challenge:
+        return None
+    return challenge
+
+def record_event(payload):
+    """
+    Store a webhook event for the sync workers
+    Raises ValueError for payloads that aren't Strava events of our subscription
+    Returns the stored event, or None if it was delivered before
+    """
+    if not isinstance(payload, dict) or any(field not in payload for field in REQUIRED_FIELDS):
+        raise ValueError("Not a Strava event")
+
+    subscription_id = app.config["STRAVA_WEBHOOK_SUBSCRIPTION_ID"]
+    if subscription_id and str(payload.get("subscription_id")) != str(subscription_id):
+        raise ValueError(f"Unknown subscription {payload.get('subscription_id')}")
+
+    try:
+        event = StravaEvent(
+            object_type=str(payload["object_type"]),
+            object_id=int(payload["object_id"]),
+            aspect_type=str(payload["aspect_type"]),
+            owner_id=int(payload["owner_id"]),
+            event_time=int(payload["event_time"]),
+            updates=json.dumps(payload.get("updates") or {}),
+            status=JOB_QUEUED
+        )
+    except (TypeError, ValueError):
+        raise ValueError("Malformed Strava event")
+
+    db.session.add(event)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A retried delivery of an event we already have
+        db.session.rollback()
+        return None
+    return event
+
+def claim_next_event():
+    """
+    Atomically move the oldest ready event to running
+    Returns the claimed event or None if none is ready
+    """
+    while True:
+        event_id = db.session.query(StravaEvent.id).filter(
+            StravaEvent.status == JOB_QUEUED,
+            or_(StravaEvent.run_after.is_(None), StravaEvent.run_after <= datetime.utcnow())
+        ).order_by(StravaEvent.received_at, StravaEvent.id).limit(1).scalar()
+        if event_id is None:
+            return None
+
+        result = db.session.execute(
+            update(StravaEvent)
+            .where(StravaEvent.id == event_id, StravaEvent.status == JOB_QUEUED)
+            .values(status=JOB_RUNNING, started_at=datetime.utcnow())
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return db.session.get(StravaEvent, event_id)
+
+def ensure_token(user):
+    """
+    Refresh the user's token if needed before asking Strava about an event
+    Raises ValueError if it can't be refreshed
+    """
+    from auth import refresh_strava_token
+
+    if not refresh_strava_token(user):
+        raise ValueError(f"Could not refresh the Strava token of user {user.id}")
+
+def create_activity(user, strava_id):
+    """
+    Fetch and store one new activity
+    Raises ValueError if the activity belongs to another athlete
+    Returns False if Strava's details could not be fetched
+    """
+    from strava_client import build_activity, fetch_activity_details, insert_activities
+    from zone_calculator import get_or_create_user_zones
+
+    if Activity.query.filter_by(strava_id=strava_id).first():
+        return True
+
+    ensure_token(user)
+
+    # The detail response has every summary field build_activity needs
+    activity_detail, hr_stream = fetch_activity_details(user.access_token, strava_id)
+    if not activity_detail:
+        return False
+    # Other athletes' public activities are visible with the owner's token too
+    if activity_detail.get("athlete", {}).get("id") != user.strava_id:
+        raise ValueError(f"Activity {strava_id} doesn't belong to athlete {user.strava_id}")
+
+    zones = get_or_create_user_zones(user).calculate_zones()
+    activity = build_activity(user, activity_detail, (activity_detail, hr_stream), zones)
+    # A sync of the same user may have stored it while it was being fetched
+    if insert_activities([activity]):
+        add_activities_to_rollups([activity])
+        db.session.commit()
+    return True
+
+def update_activity(user, strava_id):
+    """
+    Apply the title and type Strava has for a stored activity
+    Raises ValueError if Strava doesn't show the activity to its owner
+    Returns False if the activity isn't stored, so the caller can fetch it
+    """
+    from strava_client import fetch_activity
+
+    activity = Activity.query.filter_by(strava_id=strava_id, user_id=user.id).first()
+    if activity is None:
+        return False
+
+    ensure_token(user)
+    activity_detail = fetch_activity(user.access_token, strava_id)
+    if activity_detail is None:
+        raise ValueError(f"Activity {strava_id} not found on Strava")
+
+    activity.name = activity_detail.get("name", activity.name)
+    new_type = activity_detail.get("type", activity.type)
+    if new_type != activity.type:
+        # Rollups are per activity type, move the activity's zone times along
+        remove_activities_from_rollups([activity])
+        activity.type = new_type
+        add_activities_to_rollups([activity])
+
+    user.activities_changed_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+def delete_activity(user, strava_id):
+    """
+    Delete a stored activity and take it out of the rollups
+    Raises ValueError if Strava still has the activity
+    """
+    from strava_client import fetch_activity
+
+    activity = Activity.query.filter_by(strava_id=strava_id, user_id=user.id).first()
+    if activity is None:
+        return
+
+    ensure_token(user)
+    if fetch_activity(user.access_token, strava_id) is not None:
+        raise ValueError(f"Activity {strava_id} still exists on Strava")
+
+    remove_activities_from_rollups([activity])
+    stream_cache.invalidate(activity.id)
+    db.session.delete(activity)
+    user.activities_changed_at = datetime.utcnow()
+    db.session.commit()
+
+def deauthorize(user):
+    """
+    Forget the user's Strava tokens
+    Raises ValueError if Strava still accepts them
+    """
+    from auth import strava_token_revoked
+
+    if not strava_token_revoked(user):
+        raise ValueError(f"Strava still accepts the token of user {user.id}")
+
+    user.access_token = None
+    user.refresh_token = None
+    user.token_expiry = None
+    db.session.commit()
+
+def process_event(event):
+    """
+    Apply a claimed event and record its outcome
+    An event stopped by the Strava rate limit is queued again for later
+    """
+    try:
+        user = User.query.filter_by(strava_id=event.owner_id).first()
+        updates = event.get_updates()
+        status = JOB_DONE
+
+        # Anyone can post events, so confirming them with Strava must not eat
+        # into the share of the budget kept for users waiting on a sync
+        with request_priority(BACKGROUND):
+            if user is None:
+                status = EVENT_IGNORED
+            elif event.object_type == "athlete":
+                if str(updates.get("authorized")).lower() == "false":
+                    # The athlete revoked our access, their tokens are no longer valid
+                    deauthorize(user)
+                else:
+                    status = EVENT_IGNORED
+            elif event.object_type != "activity":
+                status = EVENT_IGNORED
+            elif event.aspect_type == "delete":
+                delete_activity(user, event.object_id)
+            elif event.aspect_type in ("create", "update"):
+                # An update of an activity we don't have yet (e.g. one that was
+                # private) fetches it like a new one
+                if event.aspect_type == "create" or not update_activity(user, event.object_id):
+                    if not create_activity(user, event.object_id):
+                        raise ValueError(f"Could not fetch activity {event.object_id} from Strava")
+                    queue_prefetch(user.id)
+            else:
+                status = EVENT_IGNORED
+
+        if user is not None and status == JOB_DONE:
+            invalidate_user(user.id)
+        event.status = status
+    except RateLimitExceeded as e:
+        logger.info(f"Strava event {event.id} deferred: {str(e)}")
+        db.session.rollback()
+        event.status = JOB_QUEUED
+        event.started_at = None
+        event.run_after = e.retry_at
+        db.session.commit()
+        return event
+    except Exception as e:
+        logger.exception(f"Strava event {event.id} failed")
+        db.session.rollback()
+        event.status = JOB_FAILED
+        event.error = str(e)
+
+    event.processed_at = datetime.utcnow()
+    db.session.commit()
+    logger.info("Strava event processed", extra={
+        "event_id": event.id,
+        "object_type": event.object_type,
+        "aspect_type": event.aspect_type,
+        "object_id": event.object_id,
+        "status": event.status
+    })
+    return event
+
+def run_pending_events(max_events=None):
+    """Process ready events until there are none left, returns the number processed"""
+    count = 0
+    while max_events is None or count < max_events:
+        event = claim_next_event()
+        if event is None:
+            break
+        process_event(event)
+        count += 1
+    return count
+
+def requeue_stale_events(timeout):
+    """Put events back on the queue whose worker died while processing them"""
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    result = db.session.execute(
+        update(StravaEvent)
+        .where(StravaEvent.status == JOB_RUNNING, StravaEvent.started_at < cutoff)
+        .values(status=JOB_QUEUED, started_at=None)
+    )
+    db.session.commit()
+    return result.rowcount
+
+def purge_processed_events(older_than):
+    """Delete processed events received more than older_than seconds ago"""
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+    deleted = StravaEvent.query.filter(
+        StravaEvent.status.in_((JOB_DONE, JOB_FAILED, EVENT_IGNORED)),
+        StravaEvent.received_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
@@ -0,0 +1,8 @@
+from app import app
+from sync_queue import run_worker
+
+# Standalone sync worker, run with SYNC_WORKER=external for the web processes:
+#   python worker.py
+if __name__ == "__main__":
+    with app.app_context():
+        run_worker()
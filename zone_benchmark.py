@@ -0,0 +1,58 @@
+# Zone binning benchmark
+#
+# Times calculate_activity_zones against the per-sample loop it replaced
+# (tests/legacy_zones.py) on synthetic streams, and checks that both give the
+# same zone data. Exits with status 1 if any result differs:
+#   python zone_benchmark.py [--sizes 1000,10000,100000] [--repeat 5]
+import argparse
+import json
+import os
+import sys
+import timeit
+
+# Importing the app must not need a database or secrets
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("SESSION_SECRET", "zone-benchmark")
+
+from hr_stream import points_to_arrays
+from models import HeartRateZones, NumpyEncoder
+from tests.legacy_zones import legacy_zone_data, synthetic_stream
+from zone_calculator import calculate_activity_zones
+
+def best_ms(func, repeat):
+    """Return the fastest of repeat runs of func in milliseconds"""
+    number = 1
+    while timeit.timeit(func, number=number) < 0.2 and number < 1000:
+        number *= 10
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare zone binning with the old per-sample loop")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma separated stream lengths in samples")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing runs per stream, the fastest is reported")
+    parser.add_argument("--max-hr", type=int, default=185, help="Max HR the zones are derived from")
+    args = parser.parse_args()
+
+    zones = HeartRateZones(max_hr=args.max_hr).calculate_zones()
+    mismatches = []
+
+    print(f"{'samples':>8}  {'loop':>10}  {'points':>10}  {'arrays':>10}  {'speedup':>8}")
+    for samples in (int(size) for size in args.sizes.split(",")):
+        hr_data = synthetic_stream(samples, seed=samples)
+        arrays = points_to_arrays(hr_data)
+
+        expected = json.dumps(legacy_zone_data(hr_data, zones), cls=NumpyEncoder)
+        if json.dumps(calculate_activity_zones(None, hr_data, zones), cls=NumpyEncoder) != expected:
+            mismatches.append(samples)
+
+        loop_ms = best_ms(lambda: legacy_zone_data(hr_data, zones), args.repeat)
+        points_ms = best_ms(lambda: calculate_activity_zones(None, hr_data, zones), args.repeat)
+        arrays_ms = best_ms(lambda: calculate_activity_zones(None, arrays, zones), args.repeat)
+        print(f"{samples:>8}  {loop_ms:>7.2f} ms  {points_ms:>7.2f} ms  {arrays_ms:>7.2f} ms  {loop_ms / arrays_ms:>7.1f}x")
+
+    for samples in mismatches:
+        print(f"FAIL: zone data of the {samples} sample stream differs from the old loop")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
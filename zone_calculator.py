@@ -1,5 +1,7 @@
 import numpy as np
 from models import HeartRateZones
+from hr_stream import points_to_arrays
+from instrumentation import timed
 
 def calculate_max_hr(age, gender='male'):
     """
@@ -32,69 +34,141 @@ def get_or_create_user_zones(user):
     
     return zones
 
-def calculate_activity_zones(user, hr_data):
+ZONE_ORDER = ["below", "zone1", "zone2", "zone3", "zone4", "zone5"]
+
+def zone_edges(zones):
     """
-    Calculate time spent in each heart rate zone for an activity
-    Returns a dictionary with zone data
+    Return the lower bound of zones 1-5 as a sorted array for binning.
+    A running maximum keeps the edges monotonic so that searchsorted
+    matches the "first zone whose min is above hr" rule even when a
+    low max HR pushes zone1's 90bpm floor above zone2's min.
     """
-    # Get user's heart rate zones
-    user_zones = get_or_create_user_zones(user)
-    zones = user_zones.calculate_zones()
+    edges = np.array([zones[zone]["min"] for zone in ZONE_ORDER[1:]])
+    return np.maximum.accumulate(edges)
+
+def bin_zone_times(times, hr_values, zones):
+    """
+    Sum the time spent in each zone for a single stream using NumPy
+    Returns a dictionary with seconds per zone and the total
+    """
+    return bin_zone_times_batch([(times, hr_values)], zones)[0]
+
+def bin_zone_times_batch(streams, zones):
+    """
+    Sum the time spent in each zone for many streams in one vectorized pass
+    streams is a list of (times, hr_values) array pairs sharing one zone definition.
+    The streams are concatenated into a single ragged array with offsets, so the
+    cost is a handful of NumPy calls regardless of how many activities there are.
+    Returns a list of zone time dictionaries in the same order as streams.
+    """
+    if not streams:
+        return []
     
-    if not zones or not hr_data:
-        return None
+    times = [np.asarray(stream[0]) for stream in streams]
+    hr_values = [np.asarray(stream[1]) for stream in streams]
+    lengths = np.array([len(t) for t in times])
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
     
-    # Extract heart rate values and times
-    times = [point[0] for point in hr_data]
-    hr_values = [point[1] for point in hr_data]
-    
-    # Calculate time difference between consecutive points
-    time_diffs = np.diff(times, prepend=0)
-    time_diffs[0] = 0  # First point has no time difference
-    
-    # Initialize zone times
-    zone_times = {
-        "zone1": 0,
-        "zone2": 0,
-        "zone3": 0,
-        "zone4": 0,
-        "zone5": 0,
-        "below": 0,  # Below zone 1
-        "total": sum(time_diffs[1:])  # Total time excluding first point
-    }
+    all_times = np.concatenate(times)
+    all_hr = np.concatenate(hr_values)
+    segments = np.repeat(np.arange(len(streams)), lengths)
+    
+    # Time difference between consecutive points, the first point of each
+    # stream has no time difference and is left out of the sums
+    time_diffs = np.diff(all_times, prepend=0)
+    keep = np.ones(len(all_times), dtype=bool)
+    keep[offsets[lengths > 0]] = False
+    time_diffs = time_diffs[keep]
+    segments = segments[keep]
     
-    # Calculate time in each zone
-    for i, hr in enumerate(hr_values):
-        if i == 0:
-            continue  # Skip first point as we don't have a time difference
+    # Bin 0 is below zone 1, bins 1-5 are zones 1-5
+    bins = np.searchsorted(zone_edges(zones), all_hr[keep], side="right")
+    keys = segments * len(ZONE_ORDER) + bins
+    size = len(streams) * len(ZONE_ORDER)
+    sums = np.bincount(keys, weights=time_diffs, minlength=size).reshape(len(streams), -1)
+    counts = np.bincount(keys, minlength=size).reshape(len(streams), -1)
+    # bincount adds each stream's diffs in order, matching a sequential sum
+    totals = np.bincount(segments, weights=time_diffs, minlength=len(streams))
+    
+    results = []
+    for i, stream_times in enumerate(times):
+        # Integer time streams keep integer sums
+        cast = stream_times.dtype.type if np.issubdtype(stream_times.dtype, np.integer) else np.float64
         
-        if hr < zones["zone1"]["min"]:
-            zone_times["below"] += time_diffs[i]
-        elif hr < zones["zone2"]["min"]:
-            zone_times["zone1"] += time_diffs[i]
-        elif hr < zones["zone3"]["min"]:
-            zone_times["zone2"] += time_diffs[i]
-        elif hr < zones["zone4"]["min"]:
-            zone_times["zone3"] += time_diffs[i]
-        elif hr < zones["zone5"]["min"]:
-            zone_times["zone4"] += time_diffs[i]
-        else:
-            zone_times["zone5"] += time_diffs[i]
+        # Zones that were never entered stay as a plain 0
+        zone_times = {
+            zone: cast(sums[i, ZONE_ORDER.index(zone)]) if counts[i, ZONE_ORDER.index(zone)] else 0
+            for zone in ["zone1", "zone2", "zone3", "zone4", "zone5", "below"]
+        }
+        zone_times["total"] = cast(totals[i]) if lengths[i] > 1 else 0
+        results.append(zone_times)
     
-    # Calculate percentages
+    return results
+
+def build_zone_data(zone_times, zones):
+    """
+    Combine zone times with percentages and zone ranges
+    """
     zone_percentages = {}
     if zone_times["total"] > 0:
         for zone in ["zone1", "zone2", "zone3", "zone4", "zone5", "below"]:
             zone_percentages[zone] = round((zone_times[zone] / zone_times["total"]) * 100, 1)
     
-    # Combine all zone data
-    zone_data = {
+    return {
         "times": zone_times,
         "percentages": zone_percentages,
         "zone_ranges": zones
     }
+
+def split_hr_data(hr_data):
+    """
+    Split a list of [time, hr] pairs into separate time and HR arrays
+    """
+    if isinstance(hr_data, tuple) and len(hr_data) == 2 and isinstance(hr_data[0], np.ndarray):
+        return np.asarray(hr_data[0]), np.asarray(hr_data[1])
+    
+    return points_to_arrays(hr_data)
+
+@timed("zones")
+def calculate_activity_zones(user, hr_data, zones=None):
+    """
+    Calculate time spent in each heart rate zone for an activity
+    hr_data is either a list of [time, hr] pairs or a (times, hr_values) tuple of arrays
+    zones can be passed in to avoid looking up the user's zones for every activity
+    Returns a dictionary with zone data
+    """
+    # Get user's heart rate zones
+    if zones is None:
+        zones = get_or_create_user_zones(user).calculate_zones()
+    
+    if not zones or hr_data is None or len(hr_data) == 0:
+        return None
+    
+    times, hr_values = split_hr_data(hr_data)
+    if len(times) == 0:
+        return None
+    
+    zone_times = bin_zone_times(times, hr_values, zones)
+    return build_zone_data(zone_times, zones)
+
+@timed("zones")
+def calculate_activity_zones_batch(zones, streams):
+    """
+    Calculate zone data for many activities against one zone definition
+    zones is the output of HeartRateZones.calculate_zones() and streams is a
+    list of (times, hr_values) array pairs.
+    Returns a list of zone data dictionaries, None for streams without data
+    """
+    if not zones:
+        return [None] * len(streams)
+    
+    results = [None] * len(streams)
+    non_empty = [i for i, stream in enumerate(streams) if len(stream[0]) > 0]
+    zone_times = bin_zone_times_batch([streams[i] for i in non_empty], zones)
+    for i, times in zip(non_empty, zone_times):
+        results[i] = build_zone_data(times, zones)
     
-    return zone_data
+    return results
 
 def format_zone_times(zone_data):
     """